@@ -0,0 +1,87 @@
+'''
+Compare the grid layout engines on synthetic umap-like point clouds.
+
+Each engine assigns every point to a cell of a grid. The benchmark reports
+the time each engine takes and two distortion metrics:
+
+  displacement: mean distance between each point's position and its grid
+    position, with both layouts scaled 0:1 in each dimension
+  neighbors: mean fraction of each point's k nearest neighbors in the input
+    layout that are still among its k nearest neighbors in the grid layout
+
+Usage:
+  python benchmarks/grid_layout.py --sizes 1000 10000 100000
+'''
+
+from __future__ import division
+from scipy.spatial import cKDTree
+from pixplot.pixplot import bisect_grid, rasterfairy_grid, timestamp
+import numpy as np
+import argparse
+import time
+
+
+def get_points(n, seed=24):
+  '''Return `n` points scaled -1:1 drawn from clusters of different sizes and densities'''
+  rng = np.random.RandomState(seed)
+  n_clusters = 12
+  centers = rng.uniform(-10, 10, size=(n_clusters, 2))
+  scales = rng.uniform(0.2, 2, size=n_clusters)
+  labels = rng.choice(n_clusters, size=n, p=rng.dirichlet(np.ones(n_clusters)))
+  points = centers[labels] + rng.randn(n, 2) * scales[labels][:, None]
+  return (points - points.min(axis=0)) / np.ptp(points, axis=0) * 2 - 1
+
+
+def scale(points):
+  '''Return `points` scaled 0:1 in each dimension'''
+  points = np.asarray(points, dtype=float)
+  return (points - points.min(axis=0)) / np.maximum(np.ptp(points, axis=0), 1e-12)
+
+
+def get_displacement(points, grid):
+  '''Return the mean distance between `points` and their `grid` positions, each scaled 0:1'''
+  return np.linalg.norm(scale(points) - scale(grid), axis=1).mean()
+
+
+def get_neighbor_preservation(points, grid, k=10):
+  '''Return the mean share of each point's `k` nearest neighbors in `points` that remain so in `grid`'''
+  a = cKDTree(points).query(points, k=k+1)[1][:, 1:]
+  b = cKDTree(grid).query(grid, k=k+1)[1][:, 1:]
+  return np.mean([len(set(i).intersection(j)) / k for i, j in zip(a, b)])
+
+
+def get_engines(n, qualities, max_rasterfairy):
+  '''Return [name, function] for each engine to run on `n` points'''
+  engines = []
+  if n <= max_rasterfairy:
+    engines.append(['rasterfairy', rasterfairy_grid])
+  for q in qualities:
+    engines.append(['bisection-{}'.format(q), lambda points, q=q: bisect_grid(points, leaf_size=q)])
+  return engines
+
+
+def run(sizes, qualities, max_rasterfairy):
+  '''Print the time and distortion of each engine on each size of point cloud'''
+  print('{:>10} {:>18} {:>10} {:>14} {:>10}'.format('points', 'engine', 'seconds', 'displacement', 'neighbors'))
+  for n in sizes:
+    points = get_points(n)
+    for name, engine in get_engines(n, qualities, max_rasterfairy):
+      start = time.time()
+      try:
+        grid = engine(points)
+      except Exception as exc:
+        print(timestamp(), name, 'failed on', n, 'points', exc)
+        continue
+      elapsed = time.time() - start
+      print('{:>10} {:>18} {:>10.2f} {:>14.4f} {:>10.4f}'.format(n, name, elapsed,
+        get_displacement(points, grid),
+        get_neighbor_preservation(points, grid)))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark the grid layout engines')
+  parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 10000, 100000], help='the number of points in each benchmark')
+  parser.add_argument('--qualities', nargs='+', type=int, default=[64, 256, 1024], help='the grid_quality values to benchmark for the bisection engine')
+  parser.add_argument('--max_rasterfairy', type=int, default=20000, help='the largest number of points to pass to rasterfairy')
+  args = parser.parse_args()
+  run(args.sizes, args.qualities, args.max_rasterfairy)
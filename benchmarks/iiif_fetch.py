@@ -0,0 +1,153 @@
+'''
+Measure how fast remote images are downloaded from a local stand-in for a
+IIIF server.
+
+The server serves IIIF Presentation 2 and 3 manifests and the images they
+list. Each request waits --latency seconds before it is answered, and the
+first request for every --error_every-th image fails with a 503, so the
+benchmark also covers retries. The benchmark reports the urls downloaded per
+second, the requests served, and the connections the server accepted, which
+shows how well connections are reused. A second run over the same urls
+checks that finished downloads are not fetched again.
+
+Usage:
+  python benchmarks/iiif_fetch.py --urls 2000 --latency 0.05 --fetch_workers 1 32
+'''
+
+from __future__ import division
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pixplot.pixplot import download_remote_images, timestamp
+import numpy as np
+import threading
+import argparse
+import tempfile
+import PIL.Image
+import shutil
+import json
+import time
+import io
+
+
+class StandInServer(ThreadingHTTPServer):
+  '''A IIIF server that counts the connections it accepts and the requests it serves'''
+  daemon_threads = True
+
+  def __init__(self, latency, error_every):
+    super().__init__(('127.0.0.1', 0), StandInHandler)
+    self.latency = latency
+    self.error_every = error_every
+    self.lock = threading.Lock()
+    self.connections = 0
+    self.requests = 0
+    self.failed = set() # ids of the images whose first request has failed
+    im = PIL.Image.fromarray(np.random.RandomState(24).randint(0, 256, (300, 400, 3)).astype(np.uint8))
+    out = io.BytesIO()
+    im.save(out, 'JPEG')
+    self.image = out.getvalue()
+
+  def finish_request(self, request, client_address):
+    with self.lock: self.connections += 1
+    super().finish_request(request, client_address)
+
+  def get_url(self, path):
+    return 'http://{}:{}{}'.format(self.server_address[0], self.server_address[1], path)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1' # keep connections open between requests
+
+  def log_message(self, *args):
+    pass
+
+  def send(self, status, content_type, body):
+    self.send_response(status)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_GET(self):
+    server = self.server
+    with server.lock: server.requests += 1
+    time.sleep(server.latency)
+    parts = self.path.strip('/').split('/')
+    if parts[0] == 'manifest':
+      self.send(200, 'application/json', json.dumps(get_manifest(server, int(parts[1]))).encode('utf8'))
+    elif parts[0] == 'iiif':
+      idx = int(parts[1])
+      with server.lock:
+        fail = server.error_every and idx % server.error_every == 0 and idx not in server.failed
+        server.failed.add(idx)
+      if fail:
+        self.send(503, 'text/plain', b'try again')
+      else:
+        self.send(200, 'image/jpeg', server.image)
+    elif parts[0] == 'redirect':
+      self.send_response(302)
+      self.send_header('Location', '/iiif/{}/full/full/0/default.jpg'.format(parts[1]))
+      self.send_header('Content-Length', '0')
+      self.end_headers()
+    else:
+      self.send(404, 'text/plain', b'not found')
+
+
+def get_manifest(server, idx):
+  '''Return a IIIF Presentation 2 manifest for even `idx` and a Presentation 3 manifest for odd `idx`'''
+  service = server.get_url('/iiif/{}'.format(idx))
+  if idx % 2 == 0:
+    resource = {'@id': service + '/full/full/0/default.jpg', 'service': {'@id': service}}
+    return {'sequences': [{'canvases': [{'images': [{'resource': resource}]}]}]}
+  body = {'id': service + '/full/max/0/default.jpg', 'service': [{'id': service}]}
+  return {'items': [{'items': [{'items': [{'body': body}]}]}]}
+
+
+def get_urls(server, n):
+  '''Return `n` urls: mostly manifests, with some direct and redirected image urls'''
+  urls = []
+  for i in range(n):
+    if i % 10 == 0:
+      urls.append(server.get_url('/redirect/{}'.format(i)))
+    elif i % 10 == 1:
+      urls.append(server.get_url('/iiif/{}/full/full/0/default.jpg'.format(i)))
+    else:
+      urls.append(server.get_url('/manifest/{}'.format(i)))
+  return urls
+
+
+def run(n, latency, error_every, fetch_workers, fetch_per_host):
+  '''Print the throughput and connection use of each number of fetch workers'''
+  print('{:>8} {:>10} {:>10} {:>10} {:>12} {:>10} {:>8}'.format(
+    'workers', 'seconds', 'urls/s', 'requests', 'connections', 'images', 'resumed'))
+  for workers in fetch_workers:
+    server = StandInServer(latency, error_every)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    download_dir = tempfile.mkdtemp()
+    try:
+      urls = get_urls(server, n)
+      kwargs = {'download_dir': download_dir, 'fetch_workers': workers, 'fetch_per_host': fetch_per_host}
+      start = time.time()
+      paths = download_remote_images(urls, **kwargs)
+      elapsed = time.time() - start
+      requests, connections = server.requests, server.connections
+      # a second run should find every url already downloaded
+      download_remote_images(urls, **kwargs)
+      resumed = server.requests == requests
+      print('{:>8} {:>10.2f} {:>10.1f} {:>10} {:>12} {:>10} {:>8}'.format(
+        workers, elapsed, n / elapsed, requests, connections, len(paths), str(resumed)))
+      if len(paths) != n:
+        print(timestamp(), 'Expected {} images but downloaded {}'.format(n, len(paths)))
+    finally:
+      server.shutdown()
+      server.server_close()
+      shutil.rmtree(download_dir)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark downloading IIIF manifests and images')
+  parser.add_argument('--urls', type=int, default=2000, help='the number of urls to download')
+  parser.add_argument('--latency', type=float, default=0.05, help='the seconds the server waits before it answers each request')
+  parser.add_argument('--error_every', type=int, default=50, help='fail the first request for every nth image; 0 for none')
+  parser.add_argument('--fetch_workers', nargs='+', type=int, default=[1, 32], help='the fetch_workers values to benchmark')
+  parser.add_argument('--fetch_per_host', type=int, default=32, help='the most connections to open to the server')
+  args = parser.parse_args()
+  run(args.urls, args.latency, args.error_every, args.fetch_workers, args.fetch_per_host)
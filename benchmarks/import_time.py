@@ -0,0 +1,76 @@
+'''
+Measure how long it takes to start pixplot without processing any images.
+
+Each command runs in a fresh interpreter, so nothing is cached between runs.
+The benchmark reports the best time of each command over several runs and
+fails if any command is slower than --budget seconds or if importing pixplot
+loads any of the heavy dependencies, which should only be imported by the
+stages that use them.
+
+Usage:
+  python benchmarks/import_time.py --runs 5 --budget 1.0
+'''
+
+from __future__ import division
+import subprocess
+import argparse
+import json
+import time
+import sys
+
+
+# modules that should not be loaded until a stage needs them
+heavy_modules = [
+  'tensorflow',
+  'sklearn',
+  'scipy',
+  'umap',
+  'hdbscan',
+  'numba',
+  'pynndescent',
+  'iiif_downloader',
+  'rasterfairy',
+  'pointgrid',
+  'pkg_resources',
+]
+
+commands = [
+  ['import', [sys.executable, '-c', 'import pixplot.pixplot']],
+  ['--help', [sys.executable, '-c', 'import sys; from pixplot.pixplot import parse; sys.argv = ["pixplot", "--help"]; parse()']],
+]
+
+
+def get_time(command):
+  '''Return the seconds it takes to run `command` in a fresh process'''
+  start = time.time()
+  subprocess.run(command, stdout=subprocess.DEVNULL, check=True)
+  return time.time() - start
+
+
+def get_loaded_heavy_modules():
+  '''Return the heavy modules that are loaded by importing pixplot'''
+  script = 'import sys, json; import pixplot.pixplot; print(json.dumps(sorted(sys.modules)))'
+  loaded = json.loads(subprocess.check_output([sys.executable, '-c', script]))
+  return [i for i in heavy_modules if i in loaded]
+
+
+def run(runs, budget):
+  '''Print the best time of each command and return True if all are within `budget`'''
+  ok = True
+  print('{:>10} {:>10} {:>10}'.format('command', 'seconds', 'budget'))
+  for name, command in commands:
+    elapsed = min(get_time(command) for _ in range(runs))
+    ok = ok and elapsed <= budget
+    print('{:>10} {:>10.3f} {:>10.3f}'.format(name, elapsed, budget))
+  loaded = get_loaded_heavy_modules()
+  if loaded:
+    print('importing pixplot loaded', ', '.join(loaded))
+  return ok and not loaded
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark the startup time of pixplot')
+  parser.add_argument('--runs', type=int, default=5, help='the number of times to run each command')
+  parser.add_argument('--budget', type=float, default=1.0, help='the most seconds each command may take')
+  args = parser.parse_args()
+  sys.exit(0 if run(args.runs, args.budget) else 1)
@@ -0,0 +1,259 @@
+'''
+Run the full pixplot pipeline on synthetic image collections and compare the
+throughput and memory of each stage with a saved baseline.
+
+Each collection is generated deterministically from --seed and cached in
+--work_dir. It has images of varied sizes, aspect ratios and formats, a few
+corrupt, truncated and oblong files, and a metadata csv with categories,
+tags, dates in several formats and clustered lat/lng positions, some of
+them missing. Inception is replaced by a fixed random projection of each
+image's pixels, so the benchmark runs offline and without tensorflow.
+
+Each build runs in its own process with --profile, and the stage costs are
+read from the profile report. Stages that take less than --min_seconds are
+not compared, as their times are mostly noise. The committed baseline holds
+the 1,000 and 10,000 image collections measured on a single core; save a
+baseline on the machine that runs the comparison for meaningful ratios.
+
+Usage:
+  python benchmarks/pipeline.py --sizes 1000 10000 --save_baseline
+  python benchmarks/pipeline.py --sizes 1000 10000
+'''
+
+from __future__ import division
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+import numpy as np
+import argparse
+import PIL.Image
+import shutil
+import platform
+import json
+import csv
+import sys
+import os
+
+
+categories = ['portrait', 'landscape', 'still life', 'street', 'architecture', 'botany',
+  'maps', 'textiles', 'ceramics', 'sculpture', 'manuscripts', 'photographs']
+
+# [lat, lng] of the centers around which image positions are clustered
+places = [[40.7, -74.0], [51.5, -0.1], [48.9, 2.4], [35.7, 139.7], [-33.9, 151.2],
+  [19.4, -99.1], [-23.6, -46.6], [30.0, 31.2], [28.6, 77.2], [55.8, 37.6]]
+
+
+##
+# Synthetic collections
+##
+
+
+def get_collection(n, work_dir, seed):
+  '''Return the image glob and metadata path of the synthetic collection of `n` images'''
+  out_dir = os.path.join(work_dir, 'collection-{}-{}'.format(n, seed))
+  images = os.path.join(out_dir, 'images', '*')
+  metadata = os.path.join(out_dir, 'metadata.csv')
+  if not os.path.exists(metadata):
+    write_collection(n, out_dir, seed)
+  return images, metadata
+
+
+def write_collection(n, out_dir, seed):
+  '''Write `n` synthetic images and their metadata to `out_dir`'''
+  print('Writing a synthetic collection of {} images to {}'.format(n, out_dir))
+  image_dir = os.path.join(out_dir, 'images')
+  if os.path.exists(out_dir): shutil.rmtree(out_dir)
+  os.makedirs(image_dir)
+  rng = np.random.RandomState(seed)
+  # draw every random value up front so the collection doesn't depend on thread order
+  kinds = rng.choice(['image', 'corrupt', 'truncated', 'oblong'], size=n, p=[0.985, 0.005, 0.005, 0.005])
+  formats = rng.choice(['jpg', 'png'], size=n, p=[0.9, 0.1])
+  heights = rng.randint(120, 800, size=n)
+  aspects = np.exp(rng.uniform(np.log(1/4), np.log(4), size=n))
+  labels = np.minimum(rng.zipf(1.6, size=n) - 1, len(categories) - 1)
+  seeds = rng.randint(0, 2**31, size=n)
+  rows = []
+  with ThreadPoolExecutor(max_workers=multiprocessing.cpu_count()) as pool:
+    args = zip(range(n), kinds, formats, heights, aspects, labels, seeds)
+    for row in pool.map(lambda a: write_image(image_dir, *a), args):
+      rows.append(row)
+  with open(os.path.join(out_dir, 'metadata.csv'), 'w', newline='') as out:
+    writer = csv.writer(out)
+    writer.writerow(['filename', 'category', 'tags', 'description', 'permalink', 'year', 'lat', 'lng'])
+    writer.writerows(rows)
+
+
+def write_image(image_dir, idx, kind, fmt, height, aspect, label, seed):
+  '''Write one synthetic image and return its metadata row'''
+  rng = np.random.RandomState(seed)
+  filename = 'image-{:07d}.{}'.format(idx, fmt)
+  path = os.path.join(image_dir, filename)
+  width = max(1, int(height * aspect))
+  if kind == 'oblong':
+    width, height = height * 80, 20
+  if kind == 'corrupt':
+    with open(path, 'wb') as out:
+      out.write(rng.bytes(2048))
+  else:
+    # a coarse grid of colors tinted by the category, so images of a category look alike
+    tint = np.random.RandomState(label).randint(0, 256, size=3)
+    grid = (rng.randint(0, 256, size=(4, 4, 3)) + tint * 2) // 3
+    im = PIL.Image.fromarray(grid.astype(np.uint8)).resize((width, height), PIL.Image.BILINEAR)
+    im.save(path, 'JPEG' if fmt == 'jpg' else 'PNG', quality=85)
+    if kind == 'truncated':
+      with open(path, 'rb') as f:
+        data = f.read()
+      with open(path, 'wb') as out:
+        out.write(data[:len(data)//2])
+  year = 1850 + int(rng.randint(0, 170))
+  date = rng.choice(['{}', 'c. {}', '{}-06-01', 'ca {}s', ''], p=[0.6, 0.1, 0.1, 0.1, 0.1]).format(year)
+  place = places[rng.randint(len(places))]
+  lat, lng = (np.array(place) + rng.randn(2) * 2).round(4)
+  if rng.rand() < 0.05: lat, lng = '', ''
+  tags = '|'.join(rng.choice(['red', 'green', 'blue', 'old', 'new', 'large', 'small'], size=rng.randint(0, 4), replace=False))
+  return [filename, categories[label], tags, 'Synthetic image {}'.format(idx),
+    'https://example.org/images/{}'.format(idx), date, lat, lng]
+
+
+##
+# Stub feature extractor
+##
+
+
+class StubModel:
+  '''Project each image's pixels onto fixed random directions in place of Inception'''
+  def __init__(self, dim=2048, seed=24):
+    self.weights = np.random.RandomState(seed).randn(32*32*3, dim).astype(np.float32) / 32
+
+  def predict(self, ims, batch_size=None):
+    return np.maximum(ims.reshape(len(ims), -1) @ self.weights, 0)
+
+
+def use_stub_model(pixplot):
+  '''Make the VectorWriter of module `pixplot` create vectors with StubModel'''
+  class StubVectorWriter(pixplot.VectorWriter):
+    def get_model(self):
+      if self.model is None: self.model = StubModel(seed=self.seed)
+      return self.model
+
+    def get_input(self, i):
+      return i.resize((32, 32)).astype(np.float32) / 255
+
+  pixplot.VectorWriter = StubVectorWriter
+
+
+##
+# Builds
+##
+
+
+def build(images, metadata, out_dir, n_workers):
+  '''Build a plot of `images` in `out_dir` with --profile and the stub model'''
+  import pixplot.pixplot as pixplot
+  use_stub_model(pixplot)
+  if os.path.exists(out_dir): shutil.rmtree(out_dir)
+  pixplot.process_images(**dict(pixplot.config,
+    images=images,
+    metadata=metadata,
+    out_dir=out_dir,
+    plot_id='benchmark',
+    n_workers=n_workers,
+    use_cache=False,
+    copy_web_only=False,
+    profile=True,
+  ))
+
+
+def run_build(n, args):
+  '''Build the collection of `n` images in a fresh process and return its profile report'''
+  images, metadata = get_collection(n, args.work_dir, args.seed)
+  out_dir = os.path.join(args.work_dir, 'output-{}'.format(n))
+  process = multiprocessing.get_context('spawn').Process(target=build,
+    args=(images, metadata, out_dir, args.n_workers))
+  process.start()
+  process.join()
+  if process.exitcode != 0:
+    raise Exception('The build of {} images failed'.format(n))
+  with open(os.path.join(out_dir, 'data', 'profile', 'profile-benchmark.json')) as f:
+    return json.load(f)
+
+
+def get_results(report):
+  '''Return d[stage] = {seconds, images_per_second, peak_rss_bytes, bytes_written} from a profile `report`'''
+  return {i['stage']: {
+    'seconds': i['wall_seconds'],
+    'images_per_second': i['images_per_second'],
+    'peak_rss_bytes': max(i['peak_rss_bytes'] or 0, i['child_peak_rss_bytes'] or 0),
+    'bytes_written': i['bytes_written'],
+  } for i in report['stages']}
+
+
+def compare(results, baseline, tolerance, min_seconds):
+  '''Print the change of each stage from `baseline` and return the stages that regressed'''
+  regressions = []
+  print('{:>10} {:>22} {:>10} {:>10} {:>10} {:>10} {:>8}'.format(
+    'images', 'stage', 'seconds', 'images/s', 'vs base', 'peak MB', 'vs base'))
+  for n in sorted(results, key=int):
+    for stage, r in results[n].items():
+      b = baseline.get(n, {}).get(stage)
+      speed = mem = ''
+      if b and max(r['seconds'], b['seconds']) >= min_seconds:
+        ratio = r['images_per_second'] / max(b['images_per_second'], 1e-6)
+        speed = '{:.2f}x'.format(ratio)
+        if ratio < 1 - tolerance: regressions.append([n, stage, 'throughput', ratio])
+      if b and b['peak_rss_bytes']:
+        ratio = r['peak_rss_bytes'] / b['peak_rss_bytes']
+        mem = '{:.2f}x'.format(ratio)
+        if ratio > 1 + tolerance: regressions.append([n, stage, 'memory', ratio])
+      print('{:>10} {:>22} {:>10.2f} {:>10.1f} {:>10} {:>10.0f} {:>8}'.format(
+        n, stage, r['seconds'], r['images_per_second'], speed, r['peak_rss_bytes'] / 2**20, mem))
+  return regressions
+
+
+def get_machine():
+  '''Return a description of the machine the benchmark runs on'''
+  return {
+    'cpu_count': multiprocessing.cpu_count(),
+    'processor': platform.machine(),
+    'python': platform.python_version(),
+  }
+
+
+def run(args):
+  '''Build each collection, compare it with the baseline, and return True if nothing regressed'''
+  results = {str(n): get_results(run_build(n, args)) for n in args.sizes}
+  baseline = {}
+  if os.path.exists(args.baseline):
+    with open(args.baseline) as f:
+      baseline = json.load(f)
+  machine = baseline.pop('machine', None)
+  print('Comparing with the baseline in', args.baseline)
+  if machine and machine != get_machine():
+    print('The baseline was measured on a different machine ({}), so its ratios are only a guide'.format(
+      ', '.join('{}: {}'.format(i, machine[i]) for i in sorted(machine))))
+  for n in sorted(results, key=int):
+    if n not in baseline:
+      print('There is no baseline for {} images; run with --save_baseline to add one'.format(n))
+  regressions = compare(results, baseline, args.tolerance, args.min_seconds)
+  for n, stage, kind, ratio in regressions:
+    print('Regression: the {} of {} on {} images is {:.2f}x the baseline'.format(kind, stage, n, ratio))
+  if args.save_baseline:
+    baseline.update(results)
+    baseline['machine'] = get_machine()
+    with open(args.baseline, 'w') as out:
+      json.dump(baseline, out, indent=2)
+    print('Saved the baseline to', args.baseline)
+  return not regressions
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark each stage of the pixplot pipeline on synthetic collections')
+  parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 10000], help='the number of images in each collection')
+  parser.add_argument('--seed', type=int, default=24, help='the seed of the synthetic collections')
+  parser.add_argument('--work_dir', type=str, default='benchmark-data', help='the directory in which collections and outputs are saved')
+  parser.add_argument('--n_workers', type=int, default=None, help='the n_workers argument for each build')
+  parser.add_argument('--baseline', type=str, default=os.path.join('benchmarks', 'pipeline-baseline.json'), help='the path to the saved baseline')
+  parser.add_argument('--save_baseline', action='store_true', help='save the results of this run as the baseline')
+  parser.add_argument('--tolerance', type=float, default=0.2, help='the share by which throughput may fall or memory may grow before a stage has regressed')
+  parser.add_argument('--min_seconds', type=float, default=0.5, help='stages faster than this are not compared for throughput')
+  args = parser.parse_args()
+  sys.exit(0 if run(args) else 1)
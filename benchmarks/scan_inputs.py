@@ -0,0 +1,71 @@
+'''
+Compare the time it takes to find the input images with glob2 and with
+pixplot's parallel scanner, and to find duplicate filenames among them.
+
+The benchmark writes a tree of --files empty files spread over nested
+directories, then times:
+
+  glob2: sorted(glob2.glob(pattern))
+  scan (cold): scan_files(pattern) with no cached directory listings
+  scan (warm): scan_files(pattern) reusing the cached directory listings
+  duplicates: get_duplicate_names over the scanned paths
+
+Usage:
+  python benchmarks/scan_inputs.py --files 100000 200000
+'''
+
+from __future__ import division
+from pixplot.pixplot import scan_files, get_duplicate_names
+import argparse
+import tempfile
+import shutil
+import glob2
+import time
+import os
+
+
+def write_tree(root, n, files_per_dir=500):
+  '''Write `n` empty .jpg files to nested directories below `root` and return the glob that matches them'''
+  for i in range(n):
+    d = os.path.join(root, 'part-{}'.format(i // (files_per_dir * 20)), 'dir-{}'.format(i // files_per_dir))
+    if i % files_per_dir == 0: os.makedirs(d, exist_ok=True)
+    # give every 1000th file the name of a file in another directory so there are duplicates to find
+    name = 'image-{}.jpg'.format(i - files_per_dir if i % 1000 == 999 else i)
+    open(os.path.join(d, name), 'w').close()
+  return os.path.join(root, '**', '*.jpg')
+
+
+def get_time(fn):
+  '''Return the result of fn() and the seconds it took'''
+  start = time.time()
+  result = fn()
+  return result, time.time() - start
+
+
+def run(sizes, n_workers):
+  '''Print the time each method takes on each size of tree'''
+  print('{:>10} {:>14} {:>10} {:>10}'.format('files', 'method', 'seconds', 'found'))
+  for n in sizes:
+    root = tempfile.mkdtemp()
+    try:
+      pattern = write_tree(os.path.join(root, 'images'), n)
+      kwargs = {'out_dir': os.path.join(root, 'output'), 'n_workers': n_workers}
+      for name, fn in [
+          ['glob2', lambda: sorted(glob2.glob(pattern))],
+          ['scan (cold)', lambda: scan_files(pattern, **kwargs)],
+          ['scan (warm)', lambda: scan_files(pattern, **kwargs)],
+        ]:
+        paths, elapsed = get_time(fn)
+        print('{:>10} {:>14} {:>10.2f} {:>10}'.format(n, name, elapsed, len(paths)))
+      duplicates, elapsed = get_time(lambda: get_duplicate_names(list(paths)))
+      print('{:>10} {:>14} {:>10.2f} {:>10}'.format(n, 'duplicates', elapsed, len(duplicates)))
+    finally:
+      shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark scanning the input images')
+  parser.add_argument('--files', nargs='+', type=int, default=[100000], help='the number of files in each tree')
+  parser.add_argument('--n_workers', type=int, default=None, help='the n_workers argument for the scanner')
+  args = parser.parse_args()
+  run(args.files, args.n_workers)
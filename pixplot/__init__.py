@@ -1,6 +1,5 @@
 from __future__ import absolute_import
-from pixplot.pixplot import process_images, parse
+from pixplot.pixplot import process_images, parse, get_version
 
 # specify version number
-import pkg_resources
-__version__ = pkg_resources.get_distribution('pixplot').version
\ No newline at end of file
+__version__ = get_version()
@@ -6,14 +6,32 @@ import warnings; warnings.filterwarnings('ignore')
 ##
 
 from os.path import basename, join, exists, dirname, realpath
-from distutils.dir_util import copy_tree
-import pkg_resources
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import defaultdict, deque
+from PIL import ImageFile
+from tqdm import tqdm
+import multiprocessing
+import numpy as np
+import PIL.Image
+import threading
+import itertools
 import datetime
 import argparse
+import operator
+import hashlib
 import shutil
+import pickle
+import random
+import array
 import glob2
+import math
+import gzip
+import json
+import time
 import uuid
+import csv
 import sys
+import re
 import os
 
 def timestamp():
@@ -21,95 +39,27 @@ def timestamp():
   return str(datetime.datetime.now()) + ':'
 
 ##
-# Image processing imports
+# Python 2 vs 3 imports
 ##
 
-if '--copy_web_only' not in sys.argv:
+try:
+  from urllib.parse import unquote # python 3
+except:
+  from urllib import unquote # python 2
 
-  from tensorflow.keras.preprocessing.image import save_img, img_to_array, array_to_img
-  from tensorflow.keras.applications.inception_v3 import preprocess_input
-  from tensorflow.keras.applications import InceptionV3, imagenet_utils
-  from sklearn.metrics import pairwise_distances_argmin_min
-  from tensorflow.keras.preprocessing.image import load_img
-  from collections import defaultdict, namedtuple
-  from dateutil.parser import parse as parse_date
-  from sklearn.preprocessing import minmax_scale
-  from pointgrid import align_points_to_grid
-  from tensorflow.keras.models import Model
-  from scipy.spatial.distance import cdist
-  from sklearn.decomposition import PCA
-  import tensorflow.keras.backend as K
-  from iiif_downloader import Manifest
-  from rasterfairy import coonswarp
-  from tensorflow import compat
-  from scipy.stats import kde
-  from PIL import ImageFile
-  import multiprocessing
-  from tqdm import tqdm
-  import rasterfairy
-  import numpy as np
-  import itertools
-  import operator
-  import pickle
-  import random
-  import copy
-  import math
-  import gzip
-  import json
-  import csv
-
-  ##
-  # Python 2 vs 3 imports
-  ##
-
-  try:
-    from urllib.parse import unquote # python 3
-  except:
-    from urllib import unquote # python 2
-
-  try:
-    from urllib.request import retrieve as download_function # python 3
-  except:
-    from urllib.request import urlretrieve as download_function # python 2
-
-  ##
-  # Optional install imports
-  ##
-
-  try:
-    from MulticoreTSNE import MulticoreTSNE as TSNE
-  except:
-    from sklearn.manifold import TSNE
-
-  try:
-    from hdbscan import HDBSCAN
-    cluster_method = 'hdbscan'
-  except:
-    print(timestamp(), 'HDBSCAN not available; using sklearn KMeans')
-    from sklearn.cluster import KMeans
-    cluster_method = 'kmeans'
-
-  try:
-    from cuml.manifold.umap import UMAP
-    print(timestamp(), 'Using cuml UMAP')
-    cuml_ready = True
-    from umap import AlignedUMAP
-  except:
-    from umap import UMAP, AlignedUMAP
-    print(timestamp(), 'CUML not available; using umap-learn UMAP')
-    cuml_ready = False
+##
+# Heavy imports
+##
 
-  # handle dynamic GPU memory allocation
-  tf_config = compat.v1.ConfigProto()
-  tf_config.gpu_options.allow_growth = True
-  tf_config.log_device_placement = True
-  sess = compat.v1.Session(config=tf_config)
+# tensorflow, sklearn, scipy, umap, hdbscan and the other heavy dependencies
+# are imported by the stages that use them, so `pixplot --help`, --copy_web_only
+# and cached builds don't pay to load them (see benchmarks/import_time.py)
 
-  # handle truncated images in PIL (managed by Pillow)
-  ImageFile.LOAD_TRUNCATED_IMAGES = True
+# handle truncated images in PIL (managed by Pillow)
+ImageFile.LOAD_TRUNCATED_IMAGES = True
 
 '''
-NB: Keras Image class objects return image.size as w,h
+NB: PIL Image objects return image.size as w,h
     Numpy array representations of images return image.shape as h,w,c
 '''
 
@@ -138,8 +88,35 @@ config = {
   'seed': 24,
   'n_clusters': 12,
   'geojson': None,
+  'batch_size': 32,
+  'vector_dtype': 'float32',
+  'layout_format': 'json',
+  'n_similar': 20,
+  'umap_variants': 'aligned',
+  'grid_engine': 'bisection',
+  'grid_quality': 256,
+  'cluster_vectors': 'reduced',
+  'cluster_threshold': 50000,
+  'heightmap_size': 500,
+  'heightmap_bandwidth': 1.0,
+  'metadata_format': 'files',
+  'image_format': 'source',
+  'image_quality': 90,
+  'n_workers': None,
+  'n_shards': 1,
+  'shard': None,
+  'reduce': False,
+  'shard_timeout': 86400,
+  'append': False,
+  'profile': False,
+  'profile_stacks': False,
+  'fetch_workers': 32,
+  'fetch_per_host': 4,
 }
 
+# the plot_id used when none is given, which differs in every process
+default_plot_id = config['plot_id']
+
 
 ##
 # Entry
@@ -149,15 +126,33 @@ config = {
 def process_images(**kwargs):
   '''Main method for processing user images and metadata'''
   kwargs = preprocess_kwargs(**kwargs)
-  copy_web_assets(**kwargs)
+  # shards share an output directory, so only the reduce step copies the web assets
+  if kwargs.get('shard') is None: copy_web_assets(**kwargs)
   np.random.seed(kwargs['seed'])
-  compat.v1.set_random_seed(kwargs['seed'])
   kwargs['out_dir'] = join(kwargs['out_dir'], 'data')
-  kwargs['image_paths'], kwargs['metadata'] = filter_images(**kwargs)
-  kwargs['atlas_dir'] = get_atlas_data(**kwargs)
-  kwargs['vecs'] = get_inception_vectors(**kwargs)
+  kwargs['profiler'] = Profiler(**kwargs) if kwargs.get('profile', False) else None
+  if kwargs.get('shard') is not None:
+    run_stage('process_shard', process_shard, **kwargs)
+    if kwargs['profiler']: kwargs['profiler'].close()
+    print(timestamp(), 'Done!')
+    return
+  kwargs['build_cache'] = BuildCache(**kwargs)
+  if kwargs.get('reduce', False):
+    kwargs.update(run_stage('reduce_shards', reduce_shards, **kwargs))
+  else:
+    kwargs['file_stats'] = run_stage('scan_images', scan_images, **kwargs)
+    kwargs['image_paths'], kwargs['metadata'] = run_stage('filter_images', filter_images, **kwargs)
+    kwargs['image_hashes'] = run_stage('hash_images', hash_images, kwargs['image_paths'], **kwargs)
+    if kwargs.get('append', False):
+      kwargs.update(run_stage('append_images', append_images, **kwargs))
+      # rewrite the layouts of the plot in place to include the new images
+      kwargs['use_cache'] = False
+    else:
+      kwargs.update(run_stage('image_pass', process_image_pass, **kwargs))
+  kwargs['neighbor_graph'] = NeighborGraph(**kwargs)
+  kwargs['metadata_index'] = run_stage('write_metadata', write_metadata, **kwargs)
   get_manifest(**kwargs)
-  write_images(**kwargs)
+  if kwargs['profiler']: kwargs['profiler'].close()
   print(timestamp(), 'Done!')
 
 
@@ -166,11 +161,20 @@ def preprocess_kwargs(**kwargs):
   for i in ['n_neighbors', 'min_dist']:
     if not isinstance(kwargs[i], list):
       kwargs[i] = [kwargs[i]]
+  if kwargs.get('shard') is not None and not 0 <= kwargs['shard'] < kwargs.get('n_shards', 1):
+    raise Exception('--shard must be between 0 and --n_shards - 1')
+  if kwargs.get('shard') is not None and kwargs.get('reduce', False):
+    raise Exception('--shard and --reduce should be run as separate processes')
+  if kwargs.get('n_shards', 1) > 1 and kwargs.get('plot_id') == default_plot_id:
+    raise Exception('--plot_id must be given when --n_shards is above 1, so the shards and the reduce step share a directory')
+  if kwargs.get('grid_quality', config['grid_quality']) < 1:
+    raise Exception('--grid_quality must be at least 1')
   return kwargs
 
 
 def copy_web_assets(**kwargs):
   '''Copy the /web directory from the pixplot source to the users cwd'''
+  from distutils.dir_util import copy_tree
   src = join(dirname(realpath(__file__)), 'web')
   dest = join(os.getcwd(), kwargs['out_dir'])
   copy_tree(src, dest)
@@ -192,99 +196,173 @@ def copy_web_assets(**kwargs):
 
 
 def filter_images(**kwargs):
-  '''Main method for filtering images given user metadata (if provided)'''
+  '''
+  Main method for filtering images given user metadata (if provided). Images
+  are only checked by name here; the pixel checks run in process_image_pass
+  '''
+  if not kwargs.get('file_stats'): kwargs['file_stats'] = scan_images(**kwargs)
+  image_paths = set(get_image_paths(images=kwargs["images"], out_dir=kwargs["out_dir"], file_stats=kwargs['file_stats']))
   # validate that input image names are unique
-  image_paths = set(get_image_paths(images=kwargs["images"], out_dir=kwargs["out_dir"]))
-  image_names = list(map(clean_filename,image_paths))
-  duplicates = set([x for x in image_names if image_names.count(x) > 1])
-
+  duplicates = get_duplicate_names(image_paths)
   if duplicates:
     raise Exception('''
-      Image filenames should be unique, but the following filenames are duplicated\n
+      Image filenames should be unique, but the following {} filenames are duplicated\n
       {}
-      '''.format('\n'.join(duplicates)))
+      '''.format(len(duplicates), '\n      '.join('{}: {}'.format(k, ', '.join(sorted(v))) for k, v in sorted(duplicates.items())[:100])))
   if not kwargs.get('shuffle', False):
     image_paths = sorted(image_paths)
-  # process and filter the images
+  else:
+    image_paths = list(image_paths)
+  # when processing one shard of the images, keep only the images in that shard
+  if kwargs.get('shard') is not None:
+    image_paths = [i for i in image_paths if get_shard(i, **kwargs) == kwargs['shard']]
+    print(timestamp(), 'Processing {} images in shard {} of {}'.format(len(image_paths), kwargs['shard'], kwargs['n_shards']))
+  # remove images whose headers show they can't be plotted
+  probes = probe_images(image_paths, **kwargs)
   filtered_image_paths = []
-  for i in stream_images(image_paths=image_paths):
-    # get image height and width
-    w, h = i.original.size
-    # remove images with 0 height or width when resized to lod height
-    if (h == 0) or (w == 0):
-      print(timestamp(), 'Skipping {} because it contains 0 height or width'.format(i.path))
-      continue
-    # remove images that have 0 height or width when resized
-    try:
-      resized = i.resize_to_max(kwargs['lod_cell_height'])
-    except ValueError:
-      print(timestamp(), 'Skipping {} because it contains 0 height or width when resized'.format(i.path))
-      continue
-    except OSError:
-      print(timestamp(), 'Skipping {} because it could not be resized'.format(i.path))
-      continue
-    # remove images that are too wide for the atlas
-    if (w/h) > (kwargs['atlas_size']/kwargs['cell_size']):
-      print(timestamp(), 'Skipping {} because its dimensions are oblong'.format(i.path))
+  for i in image_paths:
+    error = probes[i]['error'] or get_size_error(probes[i]['size'], **kwargs)
+    if error:
+      print(timestamp(), 'Skipping {} because {}'.format(i, error))
       continue
-    filtered_image_paths.append(i.path)
-  # if there are no remaining images, throw an error
-  if len(filtered_image_paths) == 0:
+    filtered_image_paths.append(i)
+  image_paths = filtered_image_paths
+  # if there are no remaining images, throw an error (a shard of a small collection may be empty)
+  if len(image_paths) == 0 and kwargs.get('shard') is None:
     raise Exception('No images were found! Please check your input image glob.')
+  return join_metadata(image_paths, **kwargs)
+
+
+def join_metadata(image_paths, **kwargs):
+  '''Return [images, metadata] for the `image_paths` with user metadata (or all `image_paths` if none was provided)'''
   # handle the case user provided no metadata
   if not kwargs.get('metadata', False):
-    return [filtered_image_paths, []]
+    return [image_paths, []]
   # handle user metadata: retain only records with image and metadata
-  l = get_metadata_list(**kwargs)
-  meta_bn = set([clean_filename(i.get('filename', '')) for i in l])
-  img_bn = set([clean_filename(i, **kwargs) for i in filtered_image_paths])
-  # identify images with metadata and those without metadata
-  meta_present = img_bn.intersection(meta_bn)
-  meta_missing = list(img_bn - meta_bn)
+  table = get_metadata_table(**kwargs)
+  images = []
+  rows = []
+  meta_missing = []
+  for i in image_paths:
+    row = table.rows.get(clean_filename(i, **kwargs))
+    if row is None:
+      meta_missing.append(clean_filename(i, **kwargs))
+    else:
+      images.append(i)
+      rows.append(row)
   # notify the user of images that are missing metadata
   if meta_missing:
     print(timestamp(), ' ! Some images are missing metadata:\n  -', '\n  - '.join(meta_missing[:10]))
     if len(meta_missing) > 10: print(timestamp(), ' ...', len(meta_missing)-10, 'more')
     with open('missing-metadata.txt', 'w') as out: out.write('\n'.join(meta_missing))
-  # get the sorted lists of images and metadata
-  d = {clean_filename(i['filename']): i for i in l}
-  images = []
-  metadata = []
-  for i in filtered_image_paths:
-    if clean_filename(i, **kwargs) in meta_present:
-      images.append(i)
-      metadata.append(copy.deepcopy(d[clean_filename(i, **kwargs)]))
-  kwargs['metadata'] = metadata
-  write_metadata(**kwargs)
-  return [images, metadata]
+  return [images, Metadata(table, rows)]
+
+
+def get_image_error(i, **kwargs):
+  '''Return a string describing why Image `i` can\'t be plotted, or None if it can'''
+  error = get_size_error(i.size, **kwargs)
+  if error: return error
+  # remove images that can't be resized
+  try:
+    i.resize_to_max(kwargs['lod_cell_height'])
+  except ValueError:
+    return 'it contains 0 height or width when resized'
+  except OSError:
+    return 'it could not be resized'
+  return None
+
+
+def get_size_error(size, **kwargs):
+  '''Return a string describing why an image of size (w, h) can\'t be plotted, or None if it can'''
+  w, h = size
+  # remove images with 0 height or width
+  if (h == 0) or (w == 0):
+    return 'it contains 0 height or width'
+  # remove images that have 0 height or width when resized to lod height
+  if 0 in get_max_size(size, kwargs['lod_cell_height']):
+    return 'it contains 0 height or width when resized'
+  # remove images that are too wide for the atlas
+  if (w/h) > (kwargs['atlas_size']/kwargs['cell_size']):
+    return 'its dimensions are oblong'
+  return None
+
+
+def probe_images(paths, **kwargs):
+  '''
+  Return d[path] = {'size': [w, h], 'error': str or None} for each of `paths`
+  using only the image headers
+  '''
+  print(timestamp(), 'Reading headers for {} images'.format(len(paths)))
+  # earlier versions verified the whole file, which rejected truncated images that can be decoded
+  return map_files(probe_image, paths, 'image-headers', **kwargs)
+
+
+def probe_image(path):
+  '''
+  Return the size of the image at `path` and any error raised reading its
+  header. Only the header is read, as truncated images can still be decoded;
+  the decoding pass reports images that can't
+  '''
+  result = {'size': [0, 0], 'error': None}
+  try:
+    with PIL.Image.open(path) as f:
+      result['size'] = list(f.size)
+  except Exception as exc:
+    result['error'] = 'its header could not be read -- {}'.format(exc)
+  return result
+
+
+def hash_images(paths, **kwargs):
+  '''Return d[path] = the sha1 digest of the content of the file at path'''
+  print(timestamp(), 'Hashing {} images'.format(len(paths)))
+  return map_files(hash_file, paths, 'image-hashes', **kwargs)
+
+
+def hash_file(path):
+  '''Return the sha1 digest of the content of the file at `path` (or None if it can\'t be read)'''
+  digest = hashlib.sha1()
+  try:
+    with open(path, 'rb') as f:
+      for chunk in iter(lambda: f.read(2**20), b''):
+        digest.update(chunk)
+  except OSError:
+    return None
+  return digest.hexdigest()
+
+
+def map_files(fn, paths, cache_name, **kwargs):
+  '''
+  Return d[path] = fn(path) for each of `paths`. `fn` runs on a pool of threads
+  and its results are cached by path, file size and modification time, which
+  are taken from kwargs['file_stats'] when the paths were scanned
+  '''
+  cache_path = join(kwargs.get('cache_dir') or join(kwargs['out_dir'], 'cache'), cache_name + '.json')
+  cache = {}
+  if os.path.exists(cache_path) and kwargs.get('use_cache', True):
+    with open(cache_path) as f:
+      cache = json.load(f)
+  file_stats = kwargs.get('file_stats') or {}
+  def run(path):
+    # reuse the size and mtime found when the inputs were scanned
+    key = file_stats.get(path) or get_file_stat(path)
+    if key and cache.get(path, {}).get('key') == key:
+      return cache[path]
+    return {'key': key, 'value': fn(path)}
+  def run_chunk(chunk):
+    return [run(i) for i in chunk]
+  chunks = [paths[i:i+1000] for i in range(0, len(paths), 1000)]
+  results = {}
+  with ThreadPoolExecutor(max_workers=4 * get_n_workers(**kwargs)) as pool:
+    for chunk, values in zip(chunks, pool.map(run_chunk, chunks)):
+      results.update(zip(chunk, values))
+  cache.update({k: v for k, v in results.items() if v['key']})
+  write_json(cache_path, cache, gzip=False, indent=None)
+  return {k: v['value'] for k, v in results.items()}
 
 
 def get_image_paths(**kwargs):
-  '''Called once to provide a list of image paths--handles IIIF manifest input'''
-  # handle case where --images points to iiif manifest
-  image_paths = None
-  if not kwargs['images']:
-    print('\nError: please provide an images argument, e.g.:')
-    print('pixplot --images "cat_pictures/*.jpg"\n')
-    sys.exit()
-  # handle list of IIIF image inputs
-  if os.path.exists(kwargs['images']):
-    with open(kwargs['images']) as f:
-      f = [i.strip() for i in f.read().split('\n') if i.strip()]
-      for i in f:
-        if i.startswith('http'):
-          try:
-            Manifest(url=i).save_images(limit=1)
-          except:
-            print(timestamp(), 'Could not download url ' + i)
-      image_paths = sorted(glob2.glob(os.path.join('iiif-downloads', 'images', '*')))
-  # handle case where images flag points to a glob of images
-  if not image_paths:
-    image_paths = sorted(glob2.glob(kwargs['images']))
-  # handle case user provided no images
-  if not image_paths:
-    print('\nError: No input images were found. Please check your --images glob\n')
-    sys.exit()
+  '''Return the sorted paths of the input images, optionally shuffled and limited to max_images'''
+  image_paths = sorted(kwargs.get('file_stats') or scan_images(**kwargs))
   # optionally shuffle the image_paths
   if kwargs.get('shuffle', False):
     print(timestamp(), 'Shuffling input images')
@@ -295,16 +373,335 @@ def get_image_paths(**kwargs):
   return image_paths
 
 
-def stream_images(**kwargs):
-  '''Read in all images from args[0], a list of image paths'''
-  for idx, i in enumerate(kwargs['image_paths']):
+def scan_images(**kwargs):
+  '''Return d[path] = [size, mtime] for each input image--handles IIIF manifest input'''
+  if not kwargs['images']:
+    print('\nError: please provide an images argument, e.g.:')
+    print('pixplot --images "cat_pictures/*.jpg"\n')
+    sys.exit()
+  pattern = kwargs['images']
+  # handle list of IIIF manifest and image urls
+  if os.path.isfile(pattern):
+    with open(pattern) as f:
+      urls = [i.strip() for i in f.read().split('\n') if i.strip().startswith('http')]
+    if urls:
+      download_remote_images(urls, **kwargs)
+      pattern = join('iiif-downloads', 'images', '*')
+  print(timestamp(), 'Scanning', pattern)
+  stats = scan_files(pattern, **kwargs)
+  # handle case user provided no images
+  if not stats:
+    print('\nError: No input images were found. Please check your --images glob\n')
+    sys.exit()
+  return stats
+
+
+def scan_files(pattern, **kwargs):
+  '''
+  Return d[path] = [size, mtime] for each file that matches the glob `pattern`,
+  in which ** matches any number of directories. Directories are listed on a
+  pool of threads, and the listing of each directory is cached by the
+  directory's mtime, so a rescan only lists the directories that changed.
+  Files are always stat-ed again, since a file can change in place
+  '''
+  import glob
+  if not glob.has_magic(pattern):
+    return {pattern: get_file_stat(pattern)} if os.path.isfile(pattern) else {}
+  # walk from the deepest directory in the pattern without wildcards
+  segments = pattern.replace(os.sep, '/').split('/')
+  n_static = next(idx for idx, i in enumerate(segments) if glob.has_magic(i))
+  root = '/'.join(segments[:n_static]) if n_static else ''
+  if n_static == 1 and segments[0] == '': root = '/'
+  segments = segments[n_static:]
+  regex = get_glob_regex(segments)
+  max_depth = None if '**' in segments else len(segments) - 1
+  cache_path = join(kwargs.get('cache_dir') or join(kwargs['out_dir'], 'cache'), 'image-scan.json')
+  cache = {}
+  if os.path.exists(cache_path) and kwargs.get('use_cache', True):
+    with open(cache_path) as f:
+      cache = json.load(f)
+  listings = {} # d[directory] = {mtime, files, dirs} for each directory visited in this scan
+  visited = set() # (device, inode) of each directory visited, which guards against symlink loops
+  matches = []
+  with ThreadPoolExecutor(max_workers=4 * get_n_workers(**kwargs)) as pool:
+    level = [root]
+    depth = 0
+    while level:
+      results = list(pool.map(lambda i: list_dir(i, cache.get(i)), level))
+      next_level = []
+      for path, (inode, listing) in zip(level, results):
+        if listing is None or inode in visited: continue
+        visited.add(inode)
+        listings[path] = listing
+        rel = path[len(root):].lstrip('/') if root else path
+        prefix = rel + '/' if rel else ''
+        matches += [join(path, i) for i in listing['files'] if regex.match(prefix + i)]
+        if max_depth is None or depth < max_depth:
+          next_level += [join(path, i) for i in listing['dirs']]
+      level = next_level
+      depth += 1
+    chunks = [matches[i:i+1000] for i in range(0, len(matches), 1000)]
+    stats = {}
+    for chunk, values in zip(chunks, pool.map(lambda c: [get_file_stat(i) for i in c], chunks)):
+      stats.update({k: v for k, v in zip(chunk, values) if v})
+  write_json(cache_path, listings, gzip=False, indent=None)
+  return stats
+
+
+def list_dir(path, cached=None):
+  '''
+  Return [(device, inode), {mtime, files, dirs}] of the directory at `path`, or
+  [None, None] if it can't be read. The `cached` listing is returned if the
+  directory's mtime hasn't changed since it was made
+  '''
+  try:
+    stat = os.stat(path or '.')
+    if cached and cached['mtime'] == stat.st_mtime:
+      return [(stat.st_dev, stat.st_ino), cached]
+    files, dirs = [], []
+    for i in os.scandir(path or '.'):
+      try:
+        (dirs if i.is_dir() else files).append(i.name)
+      except OSError:
+        continue
+  except OSError:
+    return [None, None]
+  return [(stat.st_dev, stat.st_ino), {'mtime': stat.st_mtime, 'files': files, 'dirs': dirs}]
+
+
+def get_file_stat(path):
+  '''Return [size, mtime] of the file at `path`, or None if it can't be read'''
+  try:
+    stat = os.stat(path)
+  except OSError:
+    return None
+  return [stat.st_size, stat.st_mtime]
+
+
+def get_glob_regex(segments):
+  '''
+  Return a regex that matches the '/'-separated paths matched by the glob
+  path `segments`. Names are matched case-insensitively, as glob2 does, and
+  wildcards don't match names that start with '.', as glob does
+  '''
+  parts = []
+  for idx, segment in enumerate(segments):
+    last = idx == len(segments) - 1
+    if segment == '**':
+      parts.append('(?:(?!\\.)[^/]*/)*' if not last else '(?:(?!\\.)[^/]*/)*(?!\\.)[^/]*')
+      continue
+    regex = '' if segment.startswith('.') else '(?!\\.)'
+    i = 0
+    while i < len(segment):
+      c = segment[i]
+      end = segment.find(']', i + 2) if c == '[' else -1
+      if c == '*':
+        regex += '[^/]*'
+      elif c == '?':
+        regex += '[^/]'
+      elif end != -1:
+        chars = segment[i+1:end]
+        regex += '[' + ('^' + chars[1:] if chars.startswith('!') else chars).replace('\\', '\\\\') + ']'
+        i = end
+      else:
+        regex += re.escape(c)
+      i += 1
+    parts.append(regex + ('' if last else '/'))
+  # glob2 matches names case-insensitively
+  return re.compile(''.join(parts) + '\\Z', re.IGNORECASE)
+
+
+def get_duplicate_names(image_paths):
+  '''Return d[filename] = [paths] for each clean filename shared by more than one of `image_paths`'''
+  names = defaultdict(list)
+  for i in image_paths:
+    names[clean_filename(i)].append(i)
+  return {k: v for k, v in names.items() if len(v) > 1}
+
+
+def stream_images(prepare=None, **kwargs):
+  '''
+  Read in all images from kwargs['image_paths'], a list of image paths. Images
+  are decoded ahead of the consumer on a pool of threads (and passed to
+  `prepare` there, if provided) with a bounded number of images in flight
+  '''
+  def load(idx, path):
+    metadata = None
+    if kwargs.get('metadata', False) and kwargs['metadata'][idx]:
+      metadata = kwargs['metadata'][idx]
+    i = Image(path, metadata=metadata, decode_size=kwargs.get('decode_size'))
+    if prepare: prepare(i)
+    return i
+  def result(path, future):
     try:
-      metadata = None
-      if kwargs.get('metadata', False) and kwargs['metadata'][idx]:
-        metadata = kwargs['metadata'][idx]
-      yield Image(i, metadata=metadata)
+      return future.result()
     except Exception as exc:
-      print(timestamp(), 'Image', i, 'could not be processed --', exc)
+      print(timestamp(), 'Image', path, 'could not be processed --', exc)
+  n_workers = get_n_workers(**kwargs)
+  prefetch = 2 * n_workers
+  with ThreadPoolExecutor(max_workers=n_workers) as pool:
+    queue = deque()
+    for idx, i in enumerate(kwargs['image_paths']):
+      queue.append((i, pool.submit(load, idx, i)))
+      if len(queue) < prefetch: continue
+      i = result(*queue.popleft())
+      if i: yield i
+    while queue:
+      i = result(*queue.popleft())
+      if i: yield i
+
+
+def stream_filtered_images(prepare=None, **kwargs):
+  '''
+  Read in all images from kwargs['image_paths'] that can be plotted. The
+  filter checks and `prepare` run on the threads that decode each image
+  '''
+  def check(i):
+    i.error = get_image_error(i, **kwargs)
+    if not i.error and prepare: prepare(i)
+  for i in stream_images(prepare=check, **kwargs):
+    if i.error:
+      print(timestamp(), 'Skipping {} because {}'.format(i.path, i.error))
+      continue
+    yield i
+
+
+def process_image_pass(**kwargs):
+  '''
+  Decode each image once and hand that decoded image to every stage that
+  needs pixels: the filter checks, atlases, vectors, thumbs and originals.
+  At most 2 * n_workers decoded images are held in memory while the
+  decoding threads read ahead. Stages whose inputs are unchanged since the
+  last build are left out of the pass
+  '''
+  atlas = get_build_record('atlas', **kwargs)
+  vectors = get_build_record('vectors', **kwargs)
+  images = get_build_record('images', **kwargs)
+  # if no stage needs pixels, reuse the images kept by the last pass
+  if None not in [atlas, vectors, images]:
+    return {
+      'image_paths': vectors['image_paths'],
+      'metadata': select_metadata(vectors['image_paths'], **kwargs),
+      'atlas_dir': atlas['atlas_dir'],
+      'vecs': VectorWriter(**kwargs).load(vectors['image_paths']),
+    }
+  print(timestamp(), 'Processing {} images'.format(len(kwargs['image_paths'])))
+  writers = {'vectors': VectorWriter(**kwargs)}
+  if atlas is None: writers['atlas'] = AtlasWriter(**kwargs)
+  if images is None: writers['images'] = ImageWriter(**kwargs)
+  image_paths, metadata = write_image_stream(list(writers.values()), **kwargs)
+  vecs = writers['vectors'].close()
+  set_build_record('vectors', {'image_paths': image_paths}, writers['vectors'].get_paths(), **kwargs)
+  if atlas is None:
+    atlas_dir = writers['atlas'].close()
+    atlas = set_build_record('atlas', {'atlas_dir': atlas_dir}, [join(atlas_dir, 'atlas_positions.json')], **kwargs)
+  if images is None:
+    writers['images'].close()
+    set_build_record('images', {}, writers['images'].get_paths(), **kwargs)
+  return {
+    'image_paths': image_paths,
+    'metadata': metadata,
+    'atlas_dir': atlas['atlas_dir'],
+    'vecs': vecs,
+  }
+
+
+def append_images(**kwargs):
+  '''
+  Add the input images that aren't yet in the plot with kwargs['plot_id'] to
+  that plot. Only the new images are decoded; their cells are packed after
+  the last cell in the plot's atlases, and the stored vectors are reused
+  '''
+  manifest_path = get_path('manifests', 'manifest', **dict(kwargs, gzip=False))
+  if not os.path.exists(manifest_path):
+    print(timestamp(), 'Could not find plot {} to append to; processing all images'.format(kwargs['plot_id']))
+    return process_image_pass(**kwargs)
+  manifest = read_json(manifest_path)
+  imagelist = read_json(manifest['imagelist'], **kwargs)
+  # find the input paths of images in the plot and the images to add to it
+  paths = {clean_filename(i): i for i in kwargs['image_paths']}
+  missing = [i for i in imagelist['images'] if i not in paths]
+  if missing:
+    raise Exception('''
+      Images can only be appended if all images in the plot are also input images,
+      but the following images in plot {} were not found\n
+      {}
+      '''.format(kwargs['plot_id'], '\n'.join(missing[:10])))
+  plot_paths = [paths[i] for i in imagelist['images']]
+  plotted = set(imagelist['images'])
+  new_paths = [i for i in kwargs['image_paths'] if clean_filename(i) not in plotted]
+  if not new_paths:
+    print(timestamp(), 'No new images to append to plot', kwargs['plot_id'])
+    return process_image_pass(**kwargs)
+  print(timestamp(), 'Appending {} images to plot {}'.format(len(new_paths), kwargs['plot_id']))
+  new_kwargs = dict(kwargs, image_paths=new_paths, metadata=select_metadata(new_paths, **kwargs))
+  # compute the digests of each stage's inputs so the results are recorded
+  for i in ['atlas', 'vectors', 'images']:
+    get_build_record(i, **kwargs)
+  atlas = AtlasWriter(**new_kwargs)
+  probes = probe_images(plot_paths, **kwargs)
+  atlas.resume(manifest['atlas_dir'], [probes[i]['size'] for i in plot_paths])
+  vectors = VectorWriter(**new_kwargs)
+  images = ImageWriter(**new_kwargs)
+  new_paths, _ = write_image_stream([atlas, vectors, images], **new_kwargs)
+  atlas_dir = atlas.close()
+  vectors.close()
+  images.close()
+  image_paths = plot_paths + new_paths
+  set_build_record('atlas', {'atlas_dir': atlas_dir}, [join(atlas_dir, 'atlas_positions.json')], **kwargs)
+  set_build_record('vectors', {'image_paths': image_paths}, vectors.get_paths(), **kwargs)
+  set_build_record('images', {}, images.get_paths(), **kwargs)
+  return {
+    'image_paths': image_paths,
+    'metadata': select_metadata(image_paths, **kwargs),
+    'atlas_dir': atlas_dir,
+    'vecs': vectors.load(image_paths),
+    'plot_manifest': manifest,
+  }
+
+
+def write_image_stream(writers, **kwargs):
+  '''Pass each plottable image to each of `writers` and return the plotted paths and metadata'''
+  image_paths = []
+  # decode each image at the lowest resolution that all writers can use
+  decode_size = max([kwargs['lod_cell_height']] + [j.decode_size for j in writers])
+  def prepare(i):
+    for j in writers:
+      start = time.time()
+      j.prepare(i)
+      add_stage_time(type(j).__name__ + '.prepare', time.time() - start, **kwargs)
+  with tqdm(total=len(kwargs['image_paths'])) as progress_bar:
+    for i in stream_filtered_images(prepare=prepare, **dict(kwargs, decode_size=decode_size)):
+      for j in writers:
+        start = time.time()
+        j.add(i)
+        add_stage_time(type(j).__name__ + '.add', time.time() - start, **kwargs)
+      image_paths.append(i.path)
+      progress_bar.update(1)
+  # if there are no remaining images, throw an error
+  if len(image_paths) == 0:
+    raise Exception('No images were found! Please check your input image glob.')
+  return image_paths, select_metadata(image_paths, **kwargs)
+
+
+def stream_metadata(**kwargs):
+  '''
+  Yield the metadata record for each path in kwargs['image_paths'] without
+  opening the image itself ({} for images without metadata)
+  '''
+  metadata = kwargs.get('metadata', False) or []
+  for idx, _ in enumerate(kwargs['image_paths']):
+    yield (metadata[idx] if idx < len(metadata) else None) or {}
+
+
+def select_metadata(paths, **kwargs):
+  '''Return the metadata of each of `paths`, which are a subset of kwargs['image_paths']'''
+  metadata = kwargs.get('metadata', False)
+  if not metadata: return []
+  idx = {j: i for i, j in enumerate(kwargs['image_paths'])}
+  if isinstance(metadata, Metadata):
+    return metadata.select([idx[i] for i in paths])
+  return [metadata[idx[i]] for i in paths]
 
 
 def clean_filename(s, **kwargs):
@@ -315,55 +712,596 @@ def clean_filename(s, **kwargs):
   return s
 
 
+##
+# Remote images
+##
+
+
+# d[content type] = file extension of downloaded images
+image_extensions = {
+  'image/jpeg': '.jpg',
+  'image/png': '.png',
+  'image/gif': '.gif',
+  'image/tiff': '.tif',
+  'image/webp': '.webp',
+  'image/jp2': '.jp2',
+}
+
+
+def download_remote_images(urls, download_dir='iiif-downloads', **kwargs):
+  '''
+  Download the image at each of `urls` to download_dir/images. Each url may be an
+  image or a IIIF manifest, in which case the first image of the manifest is
+  downloaded. Urls are fetched concurrently, with at most fetch_per_host open
+  connections to each host, and the urls that were downloaded are recorded in
+  download_dir/downloads.jsonl so an interrupted download resumes where it stopped.
+  Returns the sorted paths of the images downloaded for `urls` by this or earlier runs
+  '''
+  image_dir = join(download_dir, 'images')
+  if not os.path.exists(image_dir): os.makedirs(image_dir)
+  state_path = join(download_dir, 'downloads.jsonl')
+  done = get_downloaded_urls(state_path)
+  todo = [i for i in dict.fromkeys(urls) if i not in done]
+  print(timestamp(), 'Downloading {} urls; {} were already downloaded'.format(len(todo), len(urls) - len(todo)))
+  pool = HostPool(size=kwargs.get('fetch_per_host', config['fetch_per_host']))
+  lock = threading.Lock()
+  errors = []
+  def fetch(url):
+    try:
+      paths = download_remote_image(pool, url, image_dir)
+    except Exception as exc:
+      with lock: errors.append([url, str(exc)])
+      return
+    with lock:
+      with open(state_path, 'a') as out:
+        out.write(json.dumps({'url': url, 'paths': paths}) + '\n')
+      done[url] = paths
+  n_workers = kwargs.get('fetch_workers', config['fetch_workers'])
+  with ThreadPoolExecutor(max_workers=n_workers) as executor:
+    for _ in tqdm(executor.map(fetch, todo), total=len(todo)):
+      pass
+  pool.close()
+  if errors:
+    print(timestamp(), 'Could not download {} urls:'.format(len(errors)))
+    for url, error in errors[:10]:
+      print('  -', url, '--', error)
+    if len(errors) > 10: print(timestamp(), ' ...', len(errors)-10, 'more')
+  return sorted(set(j for i in urls if i in done for j in done[i]))
+
+
+def get_downloaded_urls(state_path):
+  '''Return d[url] = saved paths for the urls recorded in `state_path` whose images are all on disk'''
+  done = {}
+  if not os.path.exists(state_path): return done
+  with open(state_path) as f:
+    for line in f:
+      try:
+        record = json.loads(line)
+      except ValueError: # a line cut short by an interrupted run
+        continue
+      if all(os.path.exists(i) for i in record['paths']):
+        done[record['url']] = record['paths']
+  return done
+
+
+def download_remote_image(pool, url, image_dir):
+  '''Download the image at `url`, or the first image of the IIIF manifest at `url`, and return the saved paths'''
+  response, body = fetch_url(pool, url)
+  content_type = (response.getheader('Content-Type') or '').split(';')[0].strip().lower()
+  if 'json' in content_type or body.lstrip()[:1] == b'{':
+    image_urls = get_manifest_image_urls(json.loads(body.decode('utf8')))[:1]
+    if not image_urls:
+      raise Exception('the manifest lists no images')
+    return [download_remote_image(pool, i, image_dir)[0] for i in image_urls]
+  if not content_type.startswith('image/') and content_type not in ['', 'application/octet-stream']:
+    raise Exception('the response has content type {}'.format(content_type))
+  path = join(image_dir, get_download_filename(url, content_type))
+  with open(path + '.part', 'wb') as out:
+    out.write(body)
+  os.replace(path + '.part', path)
+  return [path]
+
+
+def get_download_filename(url, content_type):
+  '''Return a filename for the image downloaded from `url` that is unique to `url`'''
+  from urllib.parse import urlsplit
+  parts = urlsplit(url)
+  ext = image_extensions.get(content_type) or os.path.splitext(parts.path)[1].lower() or '.jpg'
+  name = ''.join(i if i.isalnum() else '-' for i in (parts.netloc + parts.path).rsplit('.', 1)[0])
+  return '{}-{}{}'.format(name.strip('-')[-80:], hashlib.sha1(url.encode('utf8')).hexdigest()[:8], ext)
+
+
+def get_manifest_image_urls(manifest):
+  '''Return the url of the full image of each canvas in a IIIF Presentation 2 or 3 `manifest`'''
+  urls = []
+  # presentation 2: sequences > canvases > images > resource
+  for sequence in manifest.get('sequences', []):
+    for canvas in sequence.get('canvases', []):
+      for image in canvas.get('images', []):
+        urls.append(get_iiif_image_url(image.get('resource', {}), 'full'))
+  # presentation 3: items (canvases) > items (annotation pages) > items (annotations) > body
+  for canvas in manifest.get('items', []):
+    for page in canvas.get('items', []):
+      for annotation in page.get('items', []):
+        body = annotation.get('body', {})
+        urls.append(get_iiif_image_url(body[0] if isinstance(body, list) else body, 'max'))
+  return [i for i in urls if i]
+
+
+def get_iiif_image_url(resource, size):
+  '''Return the url of the full image of IIIF `resource`, preferring its image service'''
+  service = resource.get('service', [])
+  service = service[0] if isinstance(service, list) and service else service
+  if isinstance(service, dict) and (service.get('@id') or service.get('id')):
+    return '{}/full/{}/0/default.jpg'.format((service.get('@id') or service.get('id')).rstrip('/'), size)
+  return resource.get('@id') or resource.get('id')
+
+
+def fetch_url(pool, url, retries=4, backoff=1):
+  '''
+  Return the response and body of a GET request for `url`. Connection errors,
+  timeouts, 429 and 5xx responses are retried with exponential backoff;
+  other errors are raised at once
+  '''
+  import http.client
+  for attempt in range(retries + 1):
+    wait = backoff * 2**attempt * (0.5 + random.random())
+    try:
+      response, body = pool.request(url)
+      if response.status == 200: return response, body
+      if response.status != 429 and response.status < 500:
+        raise Exception('HTTP {} {}'.format(response.status, response.reason))
+      error = 'HTTP {} {}'.format(response.status, response.reason)
+      retry_after = response.getheader('Retry-After')
+      if retry_after and retry_after.isdigit(): wait = max(wait, int(retry_after))
+    except (OSError, http.client.HTTPException) as exc:
+      error = str(exc) or type(exc).__name__
+    if attempt < retries: time.sleep(wait)
+  raise Exception('{} after {} attempts'.format(error, retries + 1))
+
+
+class HostPool:
+  '''
+  Keep open connections to each host and reuse them between requests. At most
+  `size` requests to a host run at once, so one host never gets more than
+  `size` connections however many threads share the pool
+  '''
+  def __init__(self, size=4, timeout=30):
+    self.size = size
+    self.timeout = timeout
+    self.lock = threading.Lock()
+    self.slots = {} # d[(scheme, host)] = semaphore that bounds the requests to host
+    self.idle = defaultdict(list) # d[(scheme, host)] = open connections not in use
+
+  def request(self, url, max_redirects=5):
+    '''Return the response and body of a GET request for `url`, following redirects'''
+    from urllib.parse import urlsplit, urljoin
+    for _ in range(max_redirects + 1):
+      parts = urlsplit(url)
+      key = (parts.scheme, parts.netloc)
+      with self.lock:
+        slot = self.slots.setdefault(key, threading.Semaphore(self.size))
+      with slot:
+        response, body = self.send(key, parts.path + ('?' + parts.query if parts.query else ''))
+      location = response.getheader('Location')
+      if response.status in [301, 302, 303, 307, 308] and location:
+        url = urljoin(url, location)
+        continue
+      return response, body
+    raise Exception('too many redirects')
+
+  def send(self, key, path):
+    '''Send a GET request for `path` to host `key` on an idle connection if there is one'''
+    import http.client
+    with self.lock:
+      conn = self.idle[key].pop() if self.idle[key] else None
+    reused = conn is not None
+    while True:
+      if conn is None:
+        cls = http.client.HTTPSConnection if key[0] == 'https' else http.client.HTTPConnection
+        conn = cls(key[1], timeout=self.timeout)
+      try:
+        conn.request('GET', path or '/', headers={'User-Agent': 'pixplot'})
+        response = conn.getresponse()
+        body = response.read()
+        break
+      except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+        conn.close()
+        # the server closed an idle connection; try once more on a new one
+        if not reused: raise
+        conn, reused = None, False
+      except:
+        conn.close()
+        raise
+    if response.will_close:
+      conn.close()
+    else:
+      with self.lock:
+        self.idle[key].append(conn)
+    return response, body
+
+  def close(self):
+    '''Close all idle connections'''
+    with self.lock:
+      for conns in self.idle.values():
+        for conn in conns:
+          conn.close()
+      self.idle.clear()
+
+
+##
+# Shards
+##
+
+
+def get_shard(path, **kwargs):
+  '''
+  Return the shard that contains the image at `path`. Shards are assigned by
+  a hash of the clean filename, so every node agrees wherever its images are mounted
+  '''
+  digest = hashlib.sha1(clean_filename(path).encode('utf8')).hexdigest()
+  return int(digest[:8], 16) % kwargs['n_shards']
+
+
+def get_shard_dir(idx, **kwargs):
+  '''Return the directory in which shard `idx` of the input images is saved'''
+  run = get_digest({i: kwargs.get(i) for i in ['plot_id', 'images', 'metadata', 'n_shards',
+    'atlas_size', 'cell_size', 'lod_cell_height', 'vector_dtype']})
+  return join(kwargs['out_dir'], 'shards', run[:12], 'shard-{}'.format(idx))
+
+
+def process_shard(**kwargs):
+  '''
+  Map step of a sharded build: filter the images in kwargs['shard'], create
+  their vectors, thumbs, originals and atlas cells, then write shard.json,
+  which tells the reduce step this shard is finished. The shard's vectors and
+  cells are kept in its own directory, so shards never write to the same file
+  '''
+  out_dir = get_shard_dir(kwargs['shard'], **kwargs)
+  marker_path = join(out_dir, 'shard.json')
+  if os.path.exists(marker_path): os.remove(marker_path)
+  kwargs['cache_dir'] = join(out_dir, 'cache')
+  try:
+    kwargs['file_stats'] = scan_images(**kwargs)
+    kwargs['image_paths'], kwargs['metadata'] = filter_images(**kwargs)
+    kwargs['image_hashes'] = hash_images(kwargs['image_paths'], **kwargs)
+    vectors = VectorWriter(**dict(kwargs, out_dir=out_dir))
+    cells = CellWriter(**dict(kwargs, out_dir=out_dir))
+    images = ImageWriter(**kwargs)
+    if kwargs['image_paths']:
+      write_image_stream([vectors, cells, images], **kwargs)
+    vectors.close()
+    images.close()
+    marker = {'cells': cells.close(), 'error': None}
+  except Exception as exc:
+    write_json(marker_path, {'cells': [], 'error': str(exc)}, gzip=False)
+    raise
+  # write the marker in one rename so the reduce step never reads a partial file
+  write_json(marker_path + '.tmp', marker, gzip=False, indent=None)
+  os.replace(marker_path + '.tmp', marker_path)
+
+
+class CellWriter:
+  '''
+  Append the atlas cell of each image passed to add() to a file of raw uint8
+  pixels so the reduce step can pack the cells of all shards into atlases
+  '''
+  def __init__(self, **kwargs):
+    self.cell_size = kwargs['cell_size']
+    self.decode_size = self.cell_size
+    self.hashes = kwargs.get('image_hashes') or {}
+    self.path = join(kwargs['out_dir'], 'cells.bin')
+    self.out = open(self.path, 'wb')
+    self.offset = 0
+    self.cells = [] # l[cell_idx] = [image path, content hash, w, h, cell offset, cell width]
+
+  def prepare(self, i):
+    '''Resize Image `i` to its cell size on the decoding thread'''
+    i.resize_to_height(self.cell_size)
+
+  def add(self, i):
+    '''Append the cell of Image `i` to the cell file'''
+    cell_data = np.ascontiguousarray(i.resize_to_height(self.cell_size), dtype=np.uint8)
+    w, h = i.size
+    self.cells.append([i.path, self.hashes.get(i.path), w, h, self.offset, cell_data.shape[1]])
+    self.out.write(cell_data.tobytes())
+    self.offset += cell_data.nbytes
+
+  def close(self):
+    '''Close the cell file and return the list of cells written to it'''
+    self.out.close()
+    return self.cells
+
+
+def wait_for_shards(**kwargs):
+  '''
+  Return the shard.json of each of the kwargs['n_shards'] shards, waiting for
+  the shards that are still running. The shared output directory is the only
+  channel between the nodes, so the reduce step polls for each shard's marker
+  and gives up after kwargs['shard_timeout'] seconds
+  '''
+  paths = [join(get_shard_dir(i, **kwargs), 'shard.json') for i in range(kwargs['n_shards'])]
+  timeout = kwargs.get('shard_timeout', config['shard_timeout'])
+  start = time.time()
+  waiting = None
+  while True:
+    pending = [i for i, path in enumerate(paths) if not os.path.exists(path)]
+    if not pending: break
+    if timeout and time.time() - start > timeout:
+      missing = ['shard {}: {}'.format(i, paths[i]) for i in pending]
+      raise Exception('The following shards did not finish within {} seconds:\n  '.format(timeout) + '\n  '.join(missing))
+    if pending != waiting:
+      print(timestamp(), 'Waiting for shards', ', '.join(str(i) for i in pending))
+      waiting = pending
+    time.sleep(10)
+  markers = [read_json(i) for i in paths]
+  errors = ['shard {}: {}'.format(i, j['error']) for i, j in enumerate(markers) if j['error']]
+  if errors:
+    raise Exception('The following shards failed:\n  ' + '\n  '.join(errors))
+  return markers
+
+
+def reduce_shards(**kwargs):
+  '''
+  Reduce step of a sharded build: merge the vectors of each shard into the
+  plot's vector store and pack the cells of each shard into the plot's
+  atlases, then return the plotted images as process_image_pass does
+  '''
+  shard_dirs = [get_shard_dir(i, **kwargs) for i in range(kwargs['n_shards'])]
+  markers = wait_for_shards(**kwargs)
+  print(timestamp(), 'Merging {} shards'.format(kwargs['n_shards']))
+  # order the images as an unsharded build would
+  cells = {} # d[image path] = [shard, image path, content hash, w, h, cell offset, cell width]
+  for shard, marker in enumerate(markers):
+    for i in marker['cells']:
+      cells[i[0]] = [shard] + i
+  image_paths = sorted(cells)
+  if kwargs.get('shuffle', False):
+    random.Random(kwargs['seed']).shuffle(image_paths)
+  if not image_paths:
+    raise Exception('No images were found! Please check your input image glob.')
+  image_paths, metadata = join_metadata(image_paths, **kwargs)
+  kwargs.update({
+    'image_paths': image_paths,
+    'metadata': metadata,
+    'image_hashes': {i: cells[i][2] for i in image_paths},
+  })
+  # compute the digests of each stage's inputs so the results are recorded
+  atlas = get_build_record('atlas', **kwargs)
+  for i in ['vectors', 'images']:
+    get_build_record(i, **kwargs)
+  # append the vectors of each shard that the plot's store doesn't yet hold
+  vectors = VectorWriter(**kwargs)
+  for shard_dir in shard_dirs:
+    store = VectorStore(join(shard_dir, 'image-vectors', 'inception'), dtype=vectors.store.dtype)
+    keys = [i for i in store.rows if i not in vectors.store]
+    for j in range(0, len(keys), 10000):
+      vectors.store.append(keys[j:j+10000], store.get(keys[j:j+10000]))
+  # pack the cells of each shard into atlases in the order of image_paths
+  if atlas is None:
+    writer = AtlasWriter(**kwargs)
+    data = {}
+    for shard, marker in enumerate(markers):
+      if marker['cells']:
+        data[shard] = np.memmap(join(shard_dirs[shard], 'cells.bin'), dtype=np.uint8, mode='r')
+    for i in tqdm(image_paths):
+      shard, _, _, w, h, offset, v = cells[i]
+      cell_data = data[shard][offset:offset + kwargs['cell_size'] * v * 3]
+      writer.add_cell((w, h), cell_data.reshape(kwargs['cell_size'], v, 3))
+    atlas_dir = writer.close()
+    atlas = set_build_record('atlas', {'atlas_dir': atlas_dir}, [join(atlas_dir, 'atlas_positions.json')], **kwargs)
+  set_build_record('vectors', {'image_paths': image_paths}, vectors.get_paths(), **kwargs)
+  set_build_record('images', {}, ImageWriter(**kwargs).get_paths(), **kwargs)
+  return {
+    'image_paths': image_paths,
+    'metadata': metadata,
+    'image_hashes': kwargs['image_hashes'],
+    'atlas_dir': atlas['atlas_dir'],
+    'vecs': vectors.load(image_paths),
+  }
+
+
 ##
 # Metadata
 ##
 
 
-def get_metadata_list(**kwargs):
-  '''Return a list of objects with image metadata'''
-  if not kwargs.get('metadata', False): return []
+def get_metadata_table(**kwargs):
+  '''Stream the user metadata into a MetadataTable'''
+  table = MetadataTable()
   # handle csv metadata
-  l = []
   if kwargs['metadata'].endswith('.csv'):
     with open(kwargs['metadata']) as f:
       reader = csv.reader(f)
-      headers = [i.lower() for i in next(reader)]
-      for i in reader:
-        l.append({headers[j]: i[j] if len(i) > j and i[j] else '' for j, _ in enumerate(headers)})
+      table.append_rows([i.lower() for i in next(reader)], reader)
   # handle json metadata
   else:
     for i in glob2.glob(kwargs['metadata']):
       with open(i) as f:
-        l.append(json.load(f))
-  # if the user provided a category but not a tag, use the category as the tag
-  for i in l:
-    if i.get('category', False) and not i.get('tags', False):
-      i.update({'tags': i['category']})
-  return l
+        table.append(json.load(f))
+  table.close()
+  return table
+
+
+class MetadataTable:
+  '''
+  Store user metadata as columns. Each column holds the code of each row's
+  value in a list of the column's distinct values, so repeated strings are
+  stored once and each row costs a few bytes per column. Rows are indexed by
+  the clean filename of their image
+  '''
+  def __init__(self):
+    self.codes = {} # d[column] = array of the code of each row's value, or -1 if the row has none
+    self.values = {} # d[column] = list of the distinct values in column
+    self.lookup = {} # d[column] = d[(type, value)] = code of value, while rows are appended
+    self.rows = {} # d[clean filename] = row index
+    self.n = 0 # number of rows
+
+  def add_column(self, name):
+    '''Add an empty column `name` if the table doesn't have one'''
+    if name not in self.codes:
+      self.codes[name] = array.array('i', [-1]) * self.n
+      self.values[name] = []
+      self.lookup[name] = {}
+
+  def append_rows(self, headers, rows):
+    '''Add each of `rows`, lists of string values in the order of `headers` (e.g. CSV rows)'''
+    for i in headers: self.add_column(i)
+    columns = [(self.codes[i], self.values[i], self.lookup[i]) for i in headers]
+    missing = [self.codes[i] for i in self.codes if i not in headers]
+    filename = headers.index('filename') if 'filename' in headers else None
+    for row in rows:
+      if len(row) < len(headers): row = row + [''] * (len(headers) - len(row))
+      for (codes, values, lookup), v in zip(columns, row):
+        code = lookup.get(v)
+        if code is None:
+          code = lookup[v] = len(values)
+          values.append(v)
+        codes.append(code)
+      for codes in missing: codes.append(-1)
+      self.rows[clean_filename(row[filename] if filename is not None else '')] = self.n
+      self.n += 1
+
+  def append(self, record):
+    '''Add the row `record`, a dict of column: value (e.g. a JSON record)'''
+    for k, v in record.items():
+      self.add_column(k)
+      self.codes[k].append(self.intern(k, v))
+    # give the columns this record lacks an empty value
+    for k in self.codes:
+      if len(self.codes[k]) == self.n: self.codes[k].append(-1)
+    self.rows[clean_filename(record.get('filename', ''))] = self.n
+    self.n += 1
+
+  def intern(self, column, value):
+    '''Return the code of `value` in `column`, adding it to the column's values if it is new'''
+    # strings are keyed by themselves; other JSON values also by type, so 1 and True stay distinct
+    key = value if type(value) is str else (type(value), value)
+    try:
+      code = self.lookup[column].get(key)
+    except TypeError: # unhashable values from JSON metadata are each stored once per row
+      key = code = None
+    if code is None:
+      code = len(self.values[column])
+      self.values[column].append(value)
+      if key is not None: self.lookup[column][key] = code
+    return code
+
+  def close(self):
+    '''Convert the codes to arrays once all rows are appended'''
+    self.codes = {k: np.frombuffer(v, dtype=np.intc) for k, v in self.codes.items()}
+    self.lookup = {}
+
+  def get(self, row):
+    '''Return the record of row index `row` as a dict'''
+    record = {}
+    for k, codes in self.codes.items():
+      if codes[row] >= 0: record[k] = self.values[k][codes[row]]
+    # if the user provided a category but not a tag, use the category as the tag
+    if record.get('category', False) and not record.get('tags', False):
+      record['tags'] = record['category']
+    return record
+
+  def column(self, name, rows):
+    '''Return an array of the value of column `name` in each of `rows` (None where missing)'''
+    if name not in self.codes: return np.full(len(rows), None, dtype=object)
+    values = np.empty(len(self.values[name]) + 1, dtype=object)
+    values[:-1] = self.values[name]
+    return values[self.codes[name][rows]]
+
+  def float_column(self, name, rows):
+    '''Return an array of the numeric value of column `name` in each of `rows` (nan where missing)'''
+    if name not in self.codes: return np.full(len(rows), np.nan)
+    values = np.array([to_float(i) for i in self.values[name]] + [np.nan])
+    return values[self.codes[name][rows]]
+
+
+class Metadata:
+  '''
+  The metadata records of a list of images, read from a MetadataTable on
+  demand. Indexing or iterating yields one dict per image, while column()
+  and float_column() return a single field for all images as an array
+  '''
+  def __init__(self, table, rows):
+    self.table = table
+    self.rows = np.asarray(rows, dtype=np.int64)
+
+  def __len__(self):
+    return len(self.rows)
+
+  def __getitem__(self, idx):
+    return self.table.get(self.rows[idx])
+
+  def __iter__(self):
+    for i in self.rows:
+      yield self.table.get(i)
+
+  def select(self, indices):
+    '''Return the Metadata of the images at `indices` in this list'''
+    return Metadata(self.table, self.rows[np.asarray(indices, dtype=np.int64)])
+
+  def column(self, name):
+    return self.table.column(name, self.rows)
+
+  def float_column(self, name):
+    return self.table.float_column(name, self.rows)
+
+
+def get_metadata_column(name, **kwargs):
+  '''Return an array of metadata field `name` for each of kwargs['image_paths'] (None where missing)'''
+  metadata = kwargs.get('metadata', False)
+  if isinstance(metadata, Metadata): return metadata.column(name)
+  return np.array([i.get(name) for i in stream_metadata(**kwargs)], dtype=object)
+
+
+def get_metadata_floats(name, **kwargs):
+  '''Return an array of the numeric metadata field `name` for each of kwargs['image_paths'] (nan where missing)'''
+  metadata = kwargs.get('metadata', False)
+  if isinstance(metadata, Metadata): return metadata.float_column(name)
+  return np.array([to_float(i.get(name)) for i in stream_metadata(**kwargs)])
+
+
+def to_float(value):
+  '''Return `value` as a float, or nan if it is not a number'''
+  try:
+    return float(value)
+  except (TypeError, ValueError):
+    return np.nan
 
 
 def write_metadata(metadata, **kwargs):
-  '''Write list `metadata` of objects to disk'''
+  '''
+  Write list `metadata` of objects to disk. Records are written one file per
+  image, or with kwargs['metadata_format'] == 'packed', as shards of JSON
+  lines whose index is returned
+  '''
   if not metadata: return
   out_dir = join(kwargs['out_dir'], 'metadata')
-  for i in ['filters', 'options', 'file']:
+  packed = kwargs.get('metadata_format') == 'packed'
+  for i in ['filters', 'options', 'records' if packed else 'file']:
     out_path = join(out_dir, i)
     if not exists(out_path): os.makedirs(out_path)
+  records = PackedRecordWriter(join(out_dir, 'records')) if packed else None
   # create the lists of images with each tag
   d = defaultdict(list)
   for i in metadata:
     filename = clean_filename(i['filename'])
     i['tags'] = [j.strip() for j in i.get('tags', '').split('|')]
     for j in i['tags']: d[ '__'.join(j.split()) ].append(filename)
-    write_json(os.path.join(out_dir, 'file', filename + '.json'), i, **kwargs)
-  write_json(os.path.join(out_dir, 'filters', 'filters.json'), [{
+    if packed: records.add(i)
+    else: write_json(os.path.join(out_dir, 'file', filename + '.json'), i, **kwargs)
+  filters = {
     'filter_name': 'select',
     'filter_values': list(d.keys()),
-  }], **kwargs)
+  }
   # create the options for the category dropdown
-  for i in d:
-    write_json(os.path.join(out_dir, 'options', i + '.json'), d[i], **kwargs)
+  if packed:
+    ranges = write_packed_json(os.path.join(out_dir, 'options', 'options.jsonl'), d.values())
+    filters['options'] = dict(zip(d.keys(), ranges))
+  else:
+    for i in d:
+      write_json(os.path.join(out_dir, 'options', i + '.json'), d[i], **kwargs)
+  write_json(os.path.join(out_dir, 'filters', 'filters.json'), [filters], **kwargs)
   # create the map from date to images with that date (if dates present)
   date_d = defaultdict(list)
   for i in metadata:
@@ -386,6 +1324,59 @@ def write_metadata(metadata, **kwargs):
       'domain': domain,
       'dates': date_d,
     }, **kwargs)
+  if packed: return records.close()
+
+
+def write_packed_json(path, objs):
+  '''Write each of `objs` as a line of JSON to `path` and return the [byte offset, byte length] of each'''
+  ranges = []
+  offset = 0
+  with open(path, 'wb') as out:
+    for i in objs:
+      line = json.dumps(i).encode('utf8')
+      out.write(line + b'\n')
+      ranges.append([offset, len(line)])
+      offset += len(line) + 1
+  return ranges
+
+
+class PackedRecordWriter:
+  '''
+  Write the metadata record of each image passed to add() as a line of JSON
+  in shards of records_per_shard records. The byte offset and length of each
+  record in its shard are saved in a uint32 index, so a client can fetch any
+  set of records with one range request per shard
+  '''
+  records_per_shard = 10000
+
+  def __init__(self, out_dir):
+    self.out_dir = out_dir
+    self.shards = [] # filenames of the shards
+    self.ranges = [] # l[record idx] = [byte offset, byte length] in its shard
+    self.out = None
+    self.offset = 0
+
+  def add(self, record):
+    '''Append `record` to the current shard'''
+    if len(self.ranges) % self.records_per_shard == 0:
+      if self.out: self.out.close()
+      self.shards.append('records-{}.jsonl'.format(len(self.shards)))
+      self.out = open(join(self.out_dir, self.shards[-1]), 'wb')
+      self.offset = 0
+    line = json.dumps(record).encode('utf8')
+    self.out.write(line + b'\n')
+    self.ranges.append([self.offset, len(line)])
+    self.offset += len(line) + 1
+
+  def close(self):
+    '''Write the index of the records and return the path to its JSON header'''
+    if self.out: self.out.close()
+    header = write_buffer(join(self.out_dir, 'index.bin'), np.array(self.ranges).reshape(-1, 2), 'uint32')
+    header.update({
+      'records_per_shard': self.records_per_shard,
+      'shards': self.shards,
+    })
+    return write_json(join(self.out_dir, 'index.json'), header, gzip=False)
 
 
 def is_number(s):
@@ -413,11 +1404,18 @@ def get_manifest(**kwargs):
   for idx, i in enumerate(atlas_data):
     sizes[ i['idx'] ].append([ i['w'], i['h'] ])
     pos[ i['idx'] ].append([ i['x'], i['y'] ])
+  # in binary mode, pack the sizes and positions into uint16 buffers with a count of cells per atlas
+  counts = [len(i) for i in sizes]
+  if kwargs.get('layout_format', 'json') != 'json':
+    sizes = write_buffer(get_buffer_path(get_path('imagelists', 'cell-sizes', **kwargs)),
+      [j for i in sizes for j in i], 'uint16')
+    pos = write_buffer(get_buffer_path(get_path('imagelists', 'atlas-positions', **kwargs)),
+      [j for i in pos for j in i], 'uint16')
   # obtain the paths to each layout's JSON positions
   layouts = get_layouts(**kwargs)
   # create a heightmap for the umap layout
   if 'umap' in layouts and layouts['umap']:
-    get_heightmap(layouts['umap']['variants'][0]['layout'], 'umap', **kwargs)
+    run_stage('heightmap', get_heightmap, layouts['umap']['variants'][0]['layout'], 'umap', **kwargs)
   # specify point size scalars
   point_sizes = {}
   point_sizes['min'] = 0
@@ -442,7 +1440,9 @@ def get_manifest(**kwargs):
     'imagelist': get_path('imagelists', 'imagelist', **kwargs),
     'atlas_dir': kwargs['atlas_dir'],
     'metadata': True if kwargs['metadata'] else False,
-    'default_hotspots': get_hotspots(layouts=layouts, **kwargs),
+    'metadata_index': kwargs.get('metadata_index'),
+    'default_hotspots': run_stage('hotspots', get_hotspots, layouts=layouts, **kwargs),
+    'neighbors': run_stage('similar_images', get_similar_images, **kwargs),
     'custom_hotspots': get_path('hotspots', 'user_hotspots', add_hash=False, **kwargs),
     'gzipped': kwargs['gzip'],
     'config': {
@@ -451,6 +1451,7 @@ def get_manifest(**kwargs):
         'cell': kwargs['cell_size'],
         'lod': kwargs['lod_cell_height'],
       },
+      'image_suffix': image_formats.get(kwargs.get('image_format'), [None, ''])[1],
     },
     'creation_date': datetime.datetime.today().strftime('%d-%B-%Y-%H:%M:%S'),
   }
@@ -470,6 +1471,7 @@ def get_manifest(**kwargs):
     'images': [clean_filename(i) for i in kwargs['image_paths']],
     'atlas': {
       'count': len(atlas_ids),
+      'counts': counts,
       'positions': pos,
     },
   }
@@ -481,64 +1483,175 @@ def get_manifest(**kwargs):
 ##
 
 
-def get_atlas_data(**kwargs):
-  '''
-  Generate and save to disk all atlases to be used for this visualization
-  If square, center each cell in an nxn square, else use uniform height
-  '''
-  # if the atlas files already exist, load from cache
+def get_atlas_dir(**kwargs):
+  '''Return the directory in which this plot's atlases are saved'''
   out_dir = os.path.join(kwargs['out_dir'], 'atlases', kwargs['plot_id'])
-  if os.path.exists(out_dir) and kwargs['use_cache'] and not kwargs.get('shuffle', False):
-    print(timestamp(), 'Loading saved atlas data')
-    return out_dir
   if not os.path.exists(out_dir):
     os.makedirs(out_dir)
-  # else create the atlas images and store the positions of cells in atlases
-  print(timestamp(), 'Creating atlas files')
-  n = 0 # number of atlases
-  x = 0 # x pos in atlas
-  y = 0 # y pos in atlas
-  positions = [] # l[cell_idx] = atlas data
-  atlas = np.zeros((kwargs['atlas_size'], kwargs['atlas_size'], 3))
-  for idx, i in enumerate(stream_images(**kwargs)):
-    cell_data = i.resize_to_height(kwargs['cell_size'])
-    _, v, _ = cell_data.shape
+  return out_dir
+
+
+def atlas_cached(path, **kwargs):
+  '''Return a boolean indicating whether the atlases in directory `path` can be loaded from cache'''
+  # when a build cache is in use, it decides whether the atlases are current
+  if kwargs.get('build_cache'): return False
+  return os.path.exists(join(path, 'atlas_positions.json')) and \
+    kwargs['use_cache'] and \
+    not kwargs.get('shuffle', False)
+
+
+class AtlasPacker:
+  '''Assign cells to rows of atlases using only the size of each image'''
+  def __init__(self, **kwargs):
+    self.atlas_size = kwargs['atlas_size']
+    self.cell_size = kwargs['cell_size']
+    self.lod_cell_height = kwargs['lod_cell_height']
+    self.n = 0 # number of atlases
+    self.x = 0 # x pos in atlas
+    self.y = 0 # y pos in atlas
+
+  def place(self, size):
+    '''Return the atlas position of an image with original size `size` (w, h)'''
+    v, _ = get_height_size(size, self.cell_size)
     appendable = False
-    if (x + v) <= kwargs['atlas_size']:
+    if (self.x + v) <= self.atlas_size:
       appendable = True
-    elif (y + (2*kwargs['cell_size'])) <= kwargs['atlas_size']:
-      y += kwargs['cell_size']
-      x = 0
+    elif (self.y + (2*self.cell_size)) <= self.atlas_size:
+      self.y += self.cell_size
+      self.x = 0
       appendable = True
     if not appendable:
-      save_atlas(atlas, out_dir, n)
-      n += 1
-      atlas = np.zeros((kwargs['atlas_size'], kwargs['atlas_size'], 3))
-      x = 0
-      y = 0
-    atlas[y:y+kwargs['cell_size'], x:x+v] = cell_data
+      self.n += 1
+      self.x = 0
+      self.y = 0
     # find the size of the cell in the lod canvas
-    lod_data = i.resize_to_max(kwargs['lod_cell_height'])
-    h,w,_ = lod_data.shape # h,w,colors in lod-cell sized image `i`
-    positions.append({
-      'idx': n, # atlas idx
-      'x': x, # x offset of cell in atlas
-      'y': y, # y offset of cell in atlas
+    w, h = get_max_size(size, self.lod_cell_height)
+    position = {
+      'idx': self.n, # atlas idx
+      'x': self.x, # x offset of cell in atlas
+      'y': self.y, # y offset of cell in atlas
       'w': w, # w of cell at lod size
       'h': h, # h of cell at lod size
-    })
-    x += v
-  save_atlas(atlas, out_dir, n)
-  out_path = os.path.join(out_dir, 'atlas_positions.json')
-  with open(out_path, 'w') as out:
-    json.dump(positions, out)
-  return out_dir
+    }
+    self.x += v
+    return position
+
+
+class AtlasWriter:
+  '''
+  Pack the cells of each image passed to add() into atlases. Cells are
+  kept as uint8 and each full atlas is saved by a worker process
+  '''
+  def __init__(self, **kwargs):
+    self.atlas_size = kwargs['atlas_size']
+    self.cell_size = kwargs['cell_size']
+    self.decode_size = self.cell_size
+    self.out_dir = get_atlas_dir(**kwargs)
+    # a lossless copy of the last atlas, so appending cells to it doesn't compress it again
+    cache_dir = kwargs.get('cache_dir') or join(kwargs['out_dir'], 'cache')
+    self.last_path = join(cache_dir, 'atlas-{}-last.png'.format(kwargs['plot_id']))
+    # if the atlas files already exist, load from cache
+    self.cached = atlas_cached(self.out_dir, **kwargs)
+    if self.cached:
+      print(timestamp(), 'Loading saved atlas data')
+      return
+    # else create the atlas images and store the positions of cells in atlases
+    print(timestamp(), 'Creating atlas files')
+    self.n_workers = get_n_workers(**kwargs)
+    # the pool starts while the decoding threads run and tensorflow may be loaded, so spawn the workers
+    self.pool = ProcessPoolExecutor(max_workers=self.n_workers, mp_context=multiprocessing.get_context('spawn'))
+    self.saving = deque() # futures for atlases being saved
+    self.packer = AtlasPacker(**kwargs)
+    self.positions = [] # l[cell_idx] = atlas data
+    self.n = 0
+    self.atlas = np.zeros((self.atlas_size, self.atlas_size, 3), dtype=np.uint8)
+
+  def resume(self, out_dir, sizes):
+    '''
+    Continue packing the atlases in `out_dir`, which hold the cells of
+    images with original (w, h) `sizes`, from the last cell in those atlases
+    '''
+    self.out_dir = out_dir
+    with open(join(out_dir, 'atlas_positions.json')) as f:
+      self.positions = json.load(f)
+    # replay the packing of the existing cells to find the next open position
+    for i in sizes:
+      self.packer.place(i)
+    if self.positions[-1]['idx'] != self.packer.n:
+      raise Exception('The atlases in {} do not match the sizes of the plot images'.format(out_dir))
+    self.n = self.packer.n
+    self.atlas = self.load_last()
+
+  def load_last(self):
+    '''Return the pixels of the last atlas, from its lossless copy if that copy is current'''
+    path = join(self.out_dir, 'atlas-{}.jpg'.format(self.n))
+    # atlases rebuilt since the copy was saved are newer than it
+    if os.path.exists(self.last_path) and os.path.getmtime(self.last_path) >= os.path.getmtime(path):
+      with PIL.Image.open(self.last_path) as f:
+        if f.text.get('atlas') == str(self.n) and f.size == (self.atlas_size, self.atlas_size):
+          path = self.last_path
+    with PIL.Image.open(path) as f:
+      return np.array(f.convert('RGB'), dtype=np.uint8)
+
+  def save_last(self):
+    '''Save a lossless copy of the last atlas, to which the next append adds its cells'''
+    from PIL.PngImagePlugin import PngInfo
+    info = PngInfo()
+    info.add_text('atlas', str(self.n))
+    if not os.path.exists(dirname(self.last_path)): os.makedirs(dirname(self.last_path))
+    PIL.Image.fromarray(self.atlas).save(self.last_path, pnginfo=info, compress_level=1)
+
+  def prepare(self, i):
+    '''Resize Image `i` to its cell size on the decoding thread'''
+    if self.cached: return
+    i.resize_to_height(self.cell_size)
+
+  def add(self, i):
+    '''Add Image `i` to the current atlas'''
+    if self.cached: return
+    self.add_cell(i.size, i.resize_to_height(self.cell_size))
+
+  def add_cell(self, size, cell_data):
+    '''Add the cell `cell_data` of an image with original (w, h) `size` to the current atlas'''
+    position = self.packer.place(size)
+    if position['idx'] != self.n:
+      self.save()
+      self.n = position['idx']
+      self.atlas = np.zeros((self.atlas_size, self.atlas_size, 3), dtype=np.uint8)
+    _, v, _ = cell_data.shape
+    self.atlas[position['y']:position['y']+self.cell_size, position['x']:position['x']+v] = cell_data
+    self.positions.append(position)
+
+  def save(self):
+    '''Save the current atlas in a worker process, limiting the atlases in flight'''
+    self.saving.append(self.pool.submit(save_atlas, self.atlas, self.out_dir, self.n))
+    while len(self.saving) > self.n_workers:
+      self.saving.popleft().result()
+
+  def close(self):
+    '''Save the last atlas and the cell positions and return the atlas directory'''
+    if self.cached: return self.out_dir
+    self.save()
+    while self.saving:
+      self.saving.popleft().result()
+    self.pool.shutdown()
+    self.save_last()
+    write_atlas_positions(self.positions, self.out_dir)
+    return self.out_dir
 
 
 def save_atlas(atlas, out_dir, n):
   '''Save an atlas to disk'''
   out_path = join(out_dir, 'atlas-{}.jpg'.format(n))
-  save_img(out_path, atlas)
+  PIL.Image.fromarray(np.asarray(atlas, dtype=np.uint8)).save(out_path)
+
+
+def write_atlas_positions(positions, out_dir):
+  '''Save the atlas position of each cell to disk'''
+  out_path = os.path.join(out_dir, 'atlas_positions.json')
+  with open(out_path, 'w') as out:
+    json.dump(positions, out)
+
 
 ##
 # Layouts
@@ -547,63 +1660,259 @@ def save_atlas(atlas, out_dir, n):
 
 def get_layouts(**kwargs):
   '''Get the image positions in each projection'''
-  umap = get_umap_layout(**kwargs)
+  umap = run_stage('layouts/umap', get_umap_layout, **kwargs)
   layouts = {
     'umap': umap,
     'alphabetic': {
-      'layout': get_alphabetic_layout(**kwargs),
+      'layout': run_stage('layouts/alphabetic', get_alphabetic_layout, **kwargs),
     },
     'grid': {
-      'layout': get_rasterfairy_layout(umap=umap, **kwargs),
+      'layout': run_stage('layouts/grid', get_grid_layout, umap=umap, **kwargs),
     },
-    'categorical': get_categorical_layout(**kwargs),
-    'date': get_date_layout(**kwargs),
-    'geographic': get_geographic_layout(**kwargs),
-    'custom': get_custom_layout(**kwargs),
+    'categorical': run_stage('layouts/categorical', get_categorical_layout, **kwargs),
+    'date': run_stage('layouts/date', get_date_layout, **kwargs),
+    'geographic': run_stage('layouts/geographic', get_geographic_layout, **kwargs),
+    'custom': run_stage('layouts/custom', get_custom_layout, **kwargs),
   }
   return layouts
 
 
-def get_inception_vectors(**kwargs):
-  '''Create and return Inception vector representation of Image() instances'''
-  print(timestamp(), 'Creating Inception vectors for {} images'.format(len(kwargs['image_paths'])))
-  vector_dir = os.path.join(kwargs['out_dir'], 'image-vectors', 'inception')
-  if not os.path.exists(vector_dir): os.makedirs(vector_dir)
-  base = InceptionV3(include_top=True, weights='imagenet',)
-  model = Model(inputs=base.input, outputs=base.get_layer('avg_pool').output)
-  print(timestamp(), 'Creating image array')
-  vecs = []
-  with tqdm(total=len(kwargs['image_paths'])) as progress_bar:
-    for idx, i in enumerate(stream_images(**kwargs)):
-      vector_path = os.path.join(vector_dir, clean_filename(i.path) + '.npy')
-      if os.path.exists(vector_path) and kwargs['use_cache']:
-        vec = np.load(vector_path)
-      else:
-        im = preprocess_input( img_to_array( i.original.resize((299,299)) ) )
-        vec = model.predict(np.expand_dims(im, 0)).squeeze()
-        np.save(vector_path, vec)
-      vecs.append(vec)
-      progress_bar.update(1)
-  return np.array(vecs)
+class VectorWriter:
+  '''
+  Create or load from cache the Inception vector of each image passed to add().
+  Uncached images are run through the model in batches of kwargs['batch_size']
+  and their vectors are appended to the VectorStore for this output directory,
+  keyed by the hash of each image's content when kwargs['image_hashes'] is set
+  '''
+  def __init__(self, **kwargs):
+    self.image_paths = kwargs['image_paths']
+    self.use_cache = kwargs['use_cache']
+    self.batch_size = kwargs.get('batch_size', config['batch_size'])
+    self.seed = kwargs.get('seed', config['seed'])
+    self.decode_size = 299
+    self.vector_dir = os.path.join(kwargs['out_dir'], 'image-vectors', 'inception')
+    self.store = VectorStore(self.vector_dir, dtype=kwargs.get('vector_dtype', config['vector_dtype']))
+    self.hashes = kwargs.get('image_hashes') or {}
+    self.model = None
+    self.inputs = {} # d[image path] = preprocessed model input
+    self.legacy = {} # d[image path] = vector loaded from a per-image .npy file
+    self.batch = [] # [(key, model input)]
+    self.vecs = [] # [(key, vector)] ready to be stored
+    self.keys = [] # keys of all added images, in order
+    self.n_created = 0 # number of vectors created by the model
+
+  def get_model(self):
+    '''Load the Inception model the first time an uncached image is seen'''
+    if self.model is None:
+      load_tensorflow(self.seed)
+      from tensorflow.keras.applications import InceptionV3
+      from tensorflow.keras.models import Model
+      base = InceptionV3(include_top=True, weights='imagenet',)
+      self.model = Model(inputs=base.input, outputs=base.get_layer('avg_pool').output)
+    return self.model
+
+  def get_key(self, path):
+    '''Return the key of the image at `path` in the vector store'''
+    return self.hashes.get(path) or clean_filename(path)
+
+  def get_paths(self):
+    '''Return the paths to the files in which vectors are stored'''
+    return [self.store.vectors_path, self.store.index_path]
+
+  def count_uncached(self):
+    '''Return the number of images whose vectors are neither stored nor saved by an earlier version'''
+    if not self.use_cache: return len(self.image_paths)
+    legacy = set(os.listdir(self.vector_dir))
+    return sum(1 for i in self.image_paths if self.get_key(i) not in self.store and \
+      clean_filename(i) + '.npy' not in legacy)
+
+  def prepare(self, i):
+    '''Create the model input for Image `i` on the decoding thread'''
+    if self.use_cache:
+      if self.get_key(i.path) in self.store: return
+      # migrate vectors saved one file per image by earlier versions
+      legacy_path = os.path.join(self.vector_dir, clean_filename(i.path) + '.npy')
+      if os.path.exists(legacy_path):
+        self.legacy[i.path] = np.load(legacy_path)
+        return
+    self.inputs[i.path] = self.get_input(i)
+
+  def get_input(self, i):
+    '''Return the model input for Image `i`'''
+    from tensorflow.keras.applications.inception_v3 import preprocess_input
+    return preprocess_input( i.resize((self.decode_size, self.decode_size)).astype('float32') )
+
+  def add(self, i):
+    '''Add the vector for Image `i`'''
+    key = self.get_key(i.path)
+    self.keys.append(key)
+    if i.path in self.legacy:
+      self.vecs.append((key, self.legacy.pop(i.path)))
+    elif i.path in self.inputs:
+      self.batch.append((key, self.inputs.pop(i.path)))
+    if len(self.batch) + len(self.vecs) >= self.batch_size: self.flush()
+
+  def flush(self):
+    '''Run the pending batch of model inputs through the model and store the results'''
+    if self.batch:
+      # no created vectors are stored before the first batch, so the store still shows which images are uncached
+      if not self.n_created:
+        print(timestamp(), 'Creating Inception vectors for {} images'.format(self.count_uncached()))
+      keys, ims = zip(*self.batch)
+      vecs = self.get_model().predict(np.stack(ims), batch_size=len(ims))
+      self.vecs += list(zip(keys, vecs))
+      self.n_created += len(keys)
+      self.batch = []
+    if self.vecs:
+      self.store.append(*zip(*self.vecs))
+      self.vecs = []
+
+  def close(self):
+    '''Return the array of vectors in the order images were added'''
+    self.flush()
+    return self.store.get(self.keys)
+
+  def load(self, image_paths):
+    '''Return the stored vectors for `image_paths` without reading any images'''
+    return self.store.get([self.get_key(i) for i in image_paths])
+
+
+def load_tensorflow(seed):
+  '''Import tensorflow, let it claim GPU memory as it needs it, and seed it'''
+  import tensorflow as tf
+  for i in tf.config.list_physical_devices('GPU'):
+    try:
+      tf.config.experimental.set_memory_growth(i, True)
+    except RuntimeError: # the GPU was already initialized
+      pass
+  tf.random.set_seed(seed)
+
+
+class VectorStore:
+  '''
+  Store vectors as the rows of a single memory-mapped file, along with
+  the key (e.g. filename) of each row. Rows for new keys are appended and rows
+  for stored keys are rewritten in place, so the files only grow with new keys
+  and an interrupted run keeps every vector stored before it stopped. Files:
+    vectors.json: the dtype and dimensionality of the vectors
+    vectors.bin: the raw vector data, one row per vector
+    vectors.jsonl: the JSON-encoded key of each row in vectors.bin
+  '''
+  def __init__(self, path, dtype='float32'):
+    self.header_path = join(path, 'vectors.json')
+    self.vectors_path = join(path, 'vectors.bin')
+    self.index_path = join(path, 'vectors.jsonl')
+    if not os.path.exists(path): os.makedirs(path)
+    self.dtype = np.dtype(dtype)
+    self.dim = None
+    self.rows = {} # d[filename] = row index of the vector in vectors.bin
+    self.n = 0 # number of rows in vectors.bin
+    # a run interrupted after writing the header may not have written the other files
+    if os.path.exists(self.header_path) and \
+       not (os.path.exists(self.vectors_path) and os.path.exists(self.index_path)):
+      print(timestamp(), 'Discarding the incomplete vector store in', path)
+      for i in [self.header_path, self.vectors_path, self.index_path]:
+        if os.path.exists(i): os.remove(i)
+    if os.path.exists(self.header_path):
+      with open(self.header_path) as f:
+        header = json.load(f)
+      if np.dtype(header['dtype']) != self.dtype:
+        print(timestamp(), 'Using the stored vector dtype', header['dtype'])
+      self.dtype = np.dtype(header['dtype'])
+      self.dim = header['dim']
+      self.load_index()
+
+  def load_index(self):
+    '''Read the filename of each row, discarding any row that was only partly written'''
+    with open(self.index_path) as f:
+      filenames = [json.loads(i) for i in f if i.strip()]
+    row_bytes = self.dim * self.dtype.itemsize
+    self.n = min(len(filenames), os.path.getsize(self.vectors_path) // row_bytes)
+    # later rows for a filename replace earlier ones
+    for idx, i in enumerate(filenames[:self.n]):
+      self.rows[i] = idx
+    # truncate both files to the rows that were completely written
+    if len(filenames) != self.n or os.path.getsize(self.vectors_path) != self.n * row_bytes:
+      with open(self.vectors_path, 'r+b') as f:
+        f.truncate(self.n * row_bytes)
+      with open(self.index_path, 'w') as out:
+        out.write(''.join(json.dumps(i) + '\n' for i in filenames[:self.n]))
+
+  def __contains__(self, filename):
+    return filename in self.rows
+
+  def append(self, filenames, vecs):
+    '''Store the rows `vecs` with the given filenames, replacing the rows of filenames already stored'''
+    vecs = np.asarray(vecs, dtype=self.dtype).reshape(len(filenames), -1)
+    if self.dim is None:
+      self.dim = vecs.shape[1]
+      with open(self.header_path, 'w') as out:
+        json.dump({'dtype': self.dtype.name, 'dim': self.dim}, out)
+    # d[filename] = index in vecs of the last vector given for filename
+    last = {i: idx for idx, i in enumerate(filenames)}
+    stored = [i for i in last if i in self.rows]
+    added = [i for i in last if i not in self.rows]
+    if stored:
+      row_bytes = self.dim * self.dtype.itemsize
+      with open(self.vectors_path, 'r+b') as f:
+        for i in stored:
+          f.seek(self.rows[i] * row_bytes)
+          f.write(vecs[last[i]].tobytes())
+    if added:
+      with open(self.vectors_path, 'ab') as out:
+        out.write(vecs[[last[i] for i in added]].tobytes())
+      with open(self.index_path, 'a') as out:
+        out.write(''.join(json.dumps(i) + '\n' for i in added))
+    for i in added:
+      self.rows[i] = self.n
+      self.n += 1
+
+  def load(self):
+    '''Return a read-only memory map of all rows in the store'''
+    if not self.n: return np.zeros((0, self.dim or 0), dtype=self.dtype)
+    return np.memmap(self.vectors_path, dtype=self.dtype, mode='r', shape=(self.n, self.dim))
+
+  def get(self, filenames):
+    '''Return the vectors for `filenames`, without copying if they are stored in order'''
+    rows = [self.rows[i] for i in filenames]
+    vecs = self.load()
+    if rows == list(range(len(rows))):
+      return vecs[:len(rows)]
+    return vecs[rows]
 
 
 def get_umap_layout(**kwargs):
   '''Get the x,y positions of images passed through a umap projection'''
+  record = get_build_record('umap', **kwargs)
+  if record: return record
+  # the inputs changed, so don't reuse layouts saved under this plot_id
+  if kwargs.get('build_cache'): kwargs['use_cache'] = False
   vecs = kwargs['vecs']
-  w = PCA(n_components=min(100, len(vecs))).fit_transform(vecs)
-  # single model umap
-  if len(kwargs['n_neighbors']) == 1 and len(kwargs['min_dist']) == 1:
-    return process_single_layout_umap(w, **kwargs)
-  else:
-    return process_multi_layout_umap(w, **kwargs)
+  single = len(kwargs['n_neighbors']) == 1 and len(kwargs['min_dist']) == 1
+  # when appending to a plot, project only the new images with the saved model
+  umap = append_umap_layout(vecs, **kwargs) if single and kwargs.get('plot_manifest') else None
+  if not umap:
+    pca, w = kwargs['neighbor_graph'].get_pca()
+    if single:
+      umap = process_single_layout_umap(w, pca=pca, **kwargs)
+    elif kwargs.get('umap_variants') == 'parallel' and not get_umap()[1]:
+      umap = process_parallel_layout_umap(w, **kwargs)
+    else:
+      umap = process_multi_layout_umap(w, **kwargs)
+  paths = [i[j] for i in umap['variants'] for j in ['layout', 'jittered']]
+  return set_build_record('umap', umap, paths, **kwargs)
 
 
-def process_single_layout_umap(v, **kwargs):
-  '''Create a single layout UMAP projection'''
+def process_single_layout_umap(v, pca=None, **kwargs):
+  '''
+  Create a single layout UMAP projection. If the PCA model `pca` that
+  produced `v` is given, save it and the UMAP model so more images can
+  later be projected into this layout
+  '''
   print(timestamp(), 'Creating single umap layout')
-  model = get_umap_model(**kwargs)
   out_path = get_path('layouts', 'umap', **kwargs)
-  if cuml_ready:
+  if get_umap()[1]:
+    model = get_umap_model(**kwargs)
     z = model.fit(v).embedding_
   else:
     if os.path.exists(out_path) and kwargs['use_cache']: 
@@ -619,7 +1928,7 @@ def process_single_layout_umap(v, **kwargs):
       }
     y = []
     if kwargs.get('metadata', False):
-      labels = [i.get('label', None) for i in kwargs['metadata']]
+      labels = get_metadata_column('label', **kwargs)
       # if the user provided labels, integerize them
       if any([i for i in labels]):
         d = defaultdict(lambda: len(d))
@@ -628,7 +1937,10 @@ def process_single_layout_umap(v, **kwargs):
           else: y.append(d[i])
         y = np.array(y)
     # project the PCA space down to 2d for visualization
+    model = get_umap_model(**kwargs)
     z = model.fit(v, y=y if np.any(y) else None).embedding_
+  if pca is not None:
+    save_umap_model({'pca': pca, 'umap': model, 'embedding': z}, **kwargs)
   return {
     'variants': [
       {
@@ -640,55 +1952,93 @@ def process_single_layout_umap(v, **kwargs):
     ]
   }
 
+def append_umap_layout(v, **kwargs):
+  '''
+  Project the vectors in `v` beyond those the saved single layout UMAP
+  model was fit on into that model's layout. Return None if there is no
+  saved model
+  '''
+  model_path = get_umap_model_path(**kwargs)
+  if not os.path.exists(model_path): return None
+  with open(model_path, 'rb') as f:
+    saved = pickle.load(f)
+  n = len(saved['embedding'])
+  print(timestamp(), 'Projecting {} new images into the saved umap layout'.format(len(v) - n))
+  z = saved['umap'].transform(saved['pca'].transform(v[n:]))
+  saved['embedding'] = np.vstack([saved['embedding'], z])
+  save_umap_model(saved, **kwargs)
+  out_path = get_path('layouts', 'umap', **kwargs)
+  return {
+    'variants': [
+      {
+        'n_neighbors': kwargs['n_neighbors'][0],
+        'min_dist': kwargs['min_dist'][0],
+        'layout': write_layout(out_path, saved['embedding'], **kwargs),
+        'jittered': get_pointgrid_layout(out_path, 'umap', **kwargs),
+      }
+    ]
+  }
+
+
+def get_umap_model_path(**kwargs):
+  '''Return the path to the saved single layout UMAP model for this plot'''
+  return join(kwargs['out_dir'], 'models', 'umap-{}.pkl'.format(kwargs['plot_id']))
+
+
+def save_umap_model(saved, **kwargs):
+  '''Save the dict `saved` with the PCA and UMAP models and the layout embedding'''
+  path = get_umap_model_path(**kwargs)
+  if not os.path.exists(dirname(path)): os.makedirs(dirname(path))
+  try:
+    with open(path, 'wb') as out:
+      pickle.dump(saved, out)
+  except Exception as exc:
+    print(timestamp(), 'Could not save umap model', exc)
+
+
 def process_multi_layout_umap(v, **kwargs):
-  '''Create a multi-layout UMAP projection'''
+  '''
+  Create a multi-layout UMAP projection. The AlignedUMAP model is saved
+  under a digest of `v` and the UMAP params shared by all variants, so
+  later runs on the same vectors only fit the variants the model lacks
+  '''
   print(timestamp(), 'Creating multi-umap layout')
-  params = []
-  for n_neighbors, min_dist in itertools.product(kwargs['n_neighbors'], kwargs['min_dist']):
-    filename = 'umap-n_neighbors_{}-min_dist_{}'.format(n_neighbors, min_dist)
-    out_path = get_path('layouts', filename, **kwargs)
-    params.append({
-      'n_neighbors': n_neighbors,
-      'min_dist': min_dist,
-      'filename': filename,
-      'out_path': out_path,
-    })
-  # map each image's index to itself and create one copy of that map for each layout
+  params = get_umap_variant_params(**kwargs)
+  # map each image's index to itself; each layout is related to the one before it
   relations_dict = {idx: idx for idx, _ in enumerate(v)}
-  # determine the subset of params that have already been computed
-  uncomputed_params = [i for i in params if not os.path.exists(i['out_path'])]
-  # determine the filepath where this model will be saved
-  model_filename = 'umap-' + str(abs(hash(kwargs['images'])))
-  model_path = get_path('models', model_filename, **kwargs).replace('.json', '.gz')
-  out_dir = os.path.join(kwargs['out_dir'], 'models')
-  if not os.path.exists(out_dir):
-    os.makedirs(out_dir)
-  # load or create the model
-  if os.path.exists(model_path):
-    model = load_model(model_path)
-    for i in uncomputed_params:
-      model.update(v, relations_dict.copy())
-    # after updating, we can read the results from the end of the updated model
-    for idx, i in enumerate(uncomputed_params):
-      embedding = z.embeddings_[len(uncomputed_params)-idx]
-      write_layout(i['out_path'], embedding, **kwargs)
-  else:
+  # load the saved model and the [n_neighbors, min_dist] of each of its embeddings
+  model_path = get_aligned_umap_path(v, **kwargs)
+  model, fitted = load_aligned_umap(model_path)
+  uncomputed_params = [i for i in params if [i['n_neighbors'], i['min_dist']] not in fitted]
+  if uncomputed_params and model is None:
+    from umap import AlignedUMAP
     model = AlignedUMAP(
       n_neighbors=[i['n_neighbors'] for i in uncomputed_params],
       min_dist=[i['min_dist'] for i in uncomputed_params],
+      n_components=kwargs['n_components'],
+      metric=kwargs['metric'],
+      random_state=kwargs['seed'],
     )
-    # fit the model on the data
-    z = model.fit(
-      [v for _ in params],
-      relations=[relations_dict for _ in params[1:]]
+    model.fit(
+      [v for _ in uncomputed_params],
+      relations=[relations_dict for _ in uncomputed_params[1:]]
     )
-    for idx, i in enumerate(params):
-      write_layout(i['out_path'], z.embeddings_[idx], **kwargs)
-    # save the model
-    save_model(model, model_path)
-  # load the list of layout variants
+  elif uncomputed_params:
+    print(timestamp(), 'Adding {} variants to the saved multi-umap model'.format(len(uncomputed_params)))
+    for i in uncomputed_params:
+      model.update(v,
+        relations=relations_dict.copy(),
+        n_neighbors=i['n_neighbors'],
+        min_dist=i['min_dist'])
+  fitted += [[i['n_neighbors'], i['min_dist']] for i in uncomputed_params]
+  if uncomputed_params:
+    save_aligned_umap(model, fitted, model_path)
+  # fitting realigns every embedding in the model, so rewrite all layouts after a fit
   l = []
   for i in params:
+    if uncomputed_params or not (os.path.exists(i['out_path']) and kwargs['use_cache']):
+      embedding = model.embeddings_[fitted.index([i['n_neighbors'], i['min_dist']])]
+      write_layout(i['out_path'], embedding, **kwargs)
     l.append({
       'n_neighbors': i['n_neighbors'],
       'min_dist': i['min_dist'],
@@ -700,33 +2050,134 @@ def process_multi_layout_umap(v, **kwargs):
   }
 
 
-def save_model(model, path):
+def process_parallel_layout_umap(v, **kwargs):
+  '''
+  Create a multi-layout UMAP projection by fitting each variant in its own
+  process. All variants share the neighbor graph of this build, sliced to
+  each variant's n_neighbors, and start from the same PCA initialization
+  so their layouts have the same orientation
+  '''
+  print(timestamp(), 'Creating parallel multi-umap layout')
+  params = get_umap_variant_params(**kwargs)
+  uncomputed = [i for i in params if not (os.path.exists(i['out_path']) and kwargs['use_cache'])]
+  if uncomputed:
+    from sklearn.preprocessing import minmax_scale
+    init = minmax_scale(v[:, :kwargs['n_components']]) * 10
+    n_workers = min(get_n_workers(**kwargs), len(uncomputed))
+    # numba's thread pool, started by the neighbor search, doesn't survive a fork, so spawn the workers
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=context) as pool:
+      futures = []
+      for i in uncomputed:
+        indices, distances, _ = kwargs['neighbor_graph'].get(i['n_neighbors'])
+        futures.append(pool.submit(fit_umap_variant, v, (indices, distances, None), init,
+          n_neighbors=i['n_neighbors'],
+          min_dist=i['min_dist'],
+          n_components=kwargs['n_components'],
+          metric=kwargs['metric'],
+          random_state=kwargs['seed']))
+      for i, future in zip(uncomputed, futures):
+        write_layout(i['out_path'], future.result(), **kwargs)
+  return {
+    'variants': [{
+      'n_neighbors': i['n_neighbors'],
+      'min_dist': i['min_dist'],
+      'layout': i['out_path'],
+      'jittered': get_pointgrid_layout(i['out_path'], i['filename'], **kwargs)
+    } for i in params],
+  }
+
+
+def fit_umap_variant(v, knn, init, **params):
+  '''Fit a UMAP model with `params` on `v` using the precomputed neighbors `knn` and return its embedding'''
+  from umap import UMAP
+  model = UMAP(precomputed_knn=knn, init=init, **params)
+  return model.fit(v).embedding_
+
+
+def get_umap_variant_params(**kwargs):
+  '''Return the n_neighbors, min_dist, and output path of each UMAP variant'''
+  params = []
+  for n_neighbors, min_dist in itertools.product(kwargs['n_neighbors'], kwargs['min_dist']):
+    filename = 'umap-n_neighbors_{}-min_dist_{}'.format(n_neighbors, min_dist)
+    params.append({
+      'n_neighbors': n_neighbors,
+      'min_dist': min_dist,
+      'filename': filename,
+      'out_path': get_path('layouts', filename, **kwargs),
+    })
+  return params
+
+
+# version of the saved AlignedUMAP model format; bump when that format changes
+aligned_umap_version = 1
+
+
+def get_aligned_umap_path(v, **kwargs):
+  '''Return the path to the AlignedUMAP model fit on `v` with the UMAP params in `kwargs`'''
+  digest = get_digest({
+    'vectors': hashlib.sha1(np.ascontiguousarray(v).tobytes()).hexdigest(),
+    'n_components': kwargs['n_components'],
+    'metric': kwargs['metric'],
+    'seed': kwargs['seed'],
+  })
+  return join(kwargs['out_dir'], 'models', 'aligned-umap-{}.pkl'.format(digest))
+
+
+def save_aligned_umap(model, fitted, path):
+  '''Save AlignedUMAP `model` with the [n_neighbors, min_dist] of each of its embeddings in `fitted`'''
+  if not os.path.exists(dirname(path)): os.makedirs(dirname(path))
+  # numba typed lists can't be pickled, so save the embeddings as a list of arrays
+  embeddings = model.embeddings_
+  model.embeddings_ = [np.asarray(i) for i in embeddings]
   try:
-    params = model.get_params()
-    attributes_names = [attr for attr in model.__dir__() if attr not in params and attr[0] != '_']
-    attributes = {key: model.__getattribute__(key) for key in attributes_names}
-    attributes['embeddings_'] = list(model.embeddings_)
-    for x in ['fit', 'fit_transform', 'update', 'get_params','set_params']:
-      del attributes[x]
-    all_params = {
-      'umap_params': params,
-      'umap_attributes': {key:value for key, value in attributes.items()}
-    }
-    pickle.dump(all_params, open(path, 'wb'))
-  except:
-    print(timestamp(), 'Could not save model')
+    with open(path, 'wb') as out:
+      pickle.dump({
+        'version': aligned_umap_version,
+        'pixplot_version': get_version(),
+        'fitted': fitted,
+        'model': model,
+      }, out)
+  except Exception as exc:
+    print(timestamp(), 'Could not save multi-umap model', exc)
+  model.embeddings_ = embeddings
+
 
+def load_aligned_umap(path):
+  '''Return the AlignedUMAP model saved at `path` and the params of its embeddings, or [None, []]'''
+  if not os.path.exists(path): return [None, []]
+  try:
+    with open(path, 'rb') as f:
+      saved = pickle.load(f)
+  except Exception as exc:
+    print(timestamp(), 'Could not load multi-umap model', exc)
+    return [None, []]
+  if saved.get('version') != aligned_umap_version or saved.get('pixplot_version') != get_version():
+    return [None, []]
+  from numba.typed import List
+  model = saved['model']
+  model.embeddings_ = List([np.ascontiguousarray(i, dtype=np.float32) for i in model.embeddings_])
+  return [model, saved['fitted']]
+
+
+def get_umap():
+  '''Return the UMAP class to use and whether it is the cuml GPU implementation'''
+  if get_umap.cache is None:
+    try:
+      from cuml.manifold.umap import UMAP
+      print(timestamp(), 'Using cuml UMAP')
+      get_umap.cache = (UMAP, True)
+    except:
+      from umap import UMAP
+      print(timestamp(), 'CUML not available; using umap-learn UMAP')
+      get_umap.cache = (UMAP, False)
+  return get_umap.cache
 
-def load_model(path):
-  params = pickle.load(open(path, 'rb'))
-  model = AlignedUMAP()
-  model.set_params(**params.get('umap_params'))
-  for attr, value in params.get('umap_attributes').items():
-    model.__setattr__(attr, value)
-  model.__setattr__('embeddings_', List(params.get('umap_attributes').get('embeddings_')))
+get_umap.cache = None
 
 
 def get_umap_model(**kwargs):
+  UMAP, cuml_ready = get_umap()
   if cuml_ready:
     return UMAP(
       n_neighbors=kwargs['n_neighbors'][0],
@@ -735,13 +2186,18 @@ def get_umap_model(**kwargs):
       random_state=kwargs['seed'],
       verbose=5)
   else:
+    # reuse the neighbor graph of this build rather than searching for neighbors again
+    knn = (None, None, None)
+    if kwargs.get('neighbor_graph'):
+      knn = kwargs['neighbor_graph'].get(kwargs['n_neighbors'][0])
     return UMAP(
       n_neighbors=kwargs['n_neighbors'][0],
       min_dist=kwargs['min_dist'][0],
       n_components=kwargs['n_components'],
       metric=kwargs['metric'],
       random_state=kwargs['seed'],
-      transform_seed=kwargs['seed'])
+      transform_seed=kwargs['seed'],
+      precomputed_knn=knn)
 
 
 def get_tsne_layout(**kwargs):
@@ -749,6 +2205,10 @@ def get_tsne_layout(**kwargs):
   print(timestamp(), 'Creating TSNE layout with ' + str(multiprocessing.cpu_count()) + ' cores...')
   out_path = get_path('layouts', 'tsne', **kwargs)
   if os.path.exists(out_path) and kwargs['use_cache']: return out_path
+  try:
+    from MulticoreTSNE import MulticoreTSNE as TSNE
+  except:
+    from sklearn.manifold import TSNE
   model = TSNE(
     perplexity=kwargs.get('perplexity', 2),
     n_jobs=multiprocessing.cpu_count())
@@ -761,10 +2221,18 @@ def get_rasterfairy_layout(**kwargs):
   print(timestamp(), 'Creating rasterfairy layout')
   out_path = get_path('layouts', 'rasterfairy', **kwargs)
   if os.path.exists(out_path) and kwargs['use_cache']: return out_path
-  umap = np.array(read_json(kwargs['umap']['variants'][0]['layout'], **kwargs))
+  umap = read_layout(kwargs['umap']['variants'][0]['layout'], **kwargs)
   if umap.shape[-1] != 2:
     print(timestamp(), 'Could not create rasterfairy layout because data is not 2D')
     return None
+  pos = rasterfairy_grid(umap)
+  return write_layout(out_path, pos, **kwargs)
+
+
+def rasterfairy_grid(umap):
+  '''Return the x, y grid position of each point in the -1:1 scaled 2D layout `umap`'''
+  from rasterfairy import coonswarp
+  import rasterfairy
   umap = (umap + 1)/2 # scale 0:1
   try:
     umap = coonswarp.rectifyCloud(umap, # stretch the distribution
@@ -773,8 +2241,7 @@ def get_rasterfairy_layout(**kwargs):
       paddingScale=1.05)
   except Exception as exc:
     print(timestamp(), 'Coonswarp rectification could not be performed', exc)
-  pos = rasterfairy.transformPointCloud2D(umap)[0]
-  return write_layout(out_path, pos, **kwargs)
+  return rasterfairy.transformPointCloud2D(umap)[0]
 
 
 def get_lap_layout(**kwargs):
@@ -783,10 +2250,11 @@ def get_lap_layout(**kwargs):
     import lap
   except:
     raise Exception('LAP must be installed to use get_lap_layout')
+  from scipy.spatial.distance import cdist
   out_path = get_path('layouts', 'linear-assignment', **kwargs)
   if os.path.exists(out_path) and kwargs['use_cache']: return out_path
   # load the umap layout
-  umap = np.array(read_json(kwargs['umap']['variants'][0]['layout'], **kwargs))
+  umap = read_layout(kwargs['umap']['variants'][0]['layout'], **kwargs)
   umap = (umap + 1)/2 # scale 0:1
   # determine length of each side in square grid
   side = math.ceil(umap.shape[0]**(1/2))
@@ -804,11 +2272,83 @@ def get_lap_layout(**kwargs):
   return write_layout(out_path, pos, **kwargs)
 
 
+def get_grid_layout(**kwargs):
+  '''Get the x, y positions of images in a grid layout that preserves the umap layout'''
+  record = get_build_record('grid', **kwargs)
+  if record is not None: return record
+  # the umap layout changed, so don't reuse a grid saved under this plot_id
+  if kwargs.get('build_cache'): kwargs['use_cache'] = False
+  if kwargs.get('grid_engine', config['grid_engine']) == 'rasterfairy':
+    out_path = get_rasterfairy_layout(**kwargs)
+  else:
+    out_path = get_bisection_layout(**kwargs)
+  return set_build_record('grid', out_path, [out_path], **kwargs)
+
+
+def get_bisection_layout(**kwargs):
+  '''Get the x, y position of images assigned to a grid by recursive bisection of the umap layout'''
+  print(timestamp(), 'Creating bisection grid layout')
+  out_path = get_path('layouts', 'bisection-grid', **kwargs)
+  if os.path.exists(out_path) and kwargs['use_cache']: return out_path
+  umap = read_layout(kwargs['umap']['variants'][0]['layout'], **kwargs)
+  if umap.shape[-1] != 2:
+    print(timestamp(), 'Could not create bisection grid layout because data is not 2D')
+    return None
+  pos = bisect_grid(umap, leaf_size=kwargs.get('grid_quality', config['grid_quality']))
+  return write_layout(out_path, pos, **kwargs)
+
+
+def bisect_grid(points, leaf_size=256):
+  '''
+  Assign each of the 2D `points` to a cell in a square grid and return the
+  x, y grid position of each point. The grid is split in half along its
+  longer axis, the points are split at the same quantile of that axis, and
+  each half is split again until it has at most `leaf_size` points. The
+  points in each leaf are then matched to the leaf's cells with a linear
+  assignment. Memory is linear in the number of points
+  '''
+  if leaf_size < 1:
+    raise Exception('leaf_size must be at least 1, not {}'.format(leaf_size))
+  from scipy.optimize import linear_sum_assignment
+  from scipy.spatial.distance import cdist
+  n = len(points)
+  cols = math.ceil(n**(1/2))
+  rows = math.ceil(n / cols)
+  cells = np.dstack(np.meshgrid(np.arange(cols), np.arange(rows))).reshape(-1, 2)
+  assignment = np.zeros(n, dtype=int)
+  stack = [(np.arange(n), np.arange(len(cells)))]
+  while stack:
+    p_idx, c_idx = stack.pop()
+    if not len(p_idx): continue
+    c = cells[c_idx]
+    if len(p_idx) <= leaf_size:
+      # rescale the points to the cells they'll fill, then match them to those cells
+      p = points[p_idx]
+      p = (p - p.min(axis=0)) / np.maximum(np.ptp(p, axis=0), 1e-12)
+      p = p * np.ptp(c, axis=0) + c.min(axis=0)
+      row_idx, col_idx = linear_sum_assignment(cdist(p, c, 'sqeuclidean'))
+      assignment[p_idx[row_idx]] = c_idx[col_idx]
+      continue
+    # split the cells between whole rows or columns of the longer axis
+    axis = int(np.ptp(c[:,1]) > np.ptp(c[:,0]))
+    lines = np.unique(c[:,axis])
+    left = c[:,axis] < lines[len(lines)//2]
+    # give each half of the cells the same share of the points
+    n_left = round(len(p_idx) * left.sum() / len(c_idx))
+    n_left = min(left.sum(), max(len(p_idx) - (~left).sum(), n_left))
+    order = np.argpartition(points[p_idx, axis], n_left) if 0 < n_left < len(p_idx) else np.arange(len(p_idx))
+    stack.append((p_idx[order[:n_left]], c_idx[left]))
+    stack.append((p_idx[order[n_left:]], c_idx[~left]))
+  return cells[assignment]
+
+
 def get_alphabetic_layout(**kwargs):
   '''Get the x,y positions of images in a grid projection'''
+  record = get_build_record('alphabetic', **kwargs)
+  if record is not None: return record
   print(timestamp(), 'Creating grid layout')
   out_path = get_path('layouts', 'grid', **kwargs)
-  if os.path.exists(out_path) and kwargs['use_cache']: return out_path
+  if os.path.exists(out_path) and kwargs['use_cache'] and not kwargs.get('build_cache'): return out_path
   paths = kwargs['image_paths']
   n = math.ceil(len(paths)**(1/2))
   l = [] # positions
@@ -817,7 +2357,7 @@ def get_alphabetic_layout(**kwargs):
     y = math.floor(i/n)
     l.append([x, y])
   z = np.array(l)
-  return write_layout(out_path, z, **kwargs)
+  return set_build_record('alphabetic', write_layout(out_path, z, **kwargs), [out_path], **kwargs)
 
 
 def get_pointgrid_layout(path, label, **kwargs):
@@ -825,36 +2365,100 @@ def get_pointgrid_layout(path, label, **kwargs):
   print(timestamp(), 'Creating {} pointgrid'.format(label))
   out_path = get_path('layouts', label + '-jittered', **kwargs)
   if os.path.exists(out_path) and kwargs['use_cache']: return out_path
-  arr = np.array(read_json(path, **kwargs))
+  arr = read_layout(path, **kwargs)
   if arr.shape[-1] != 2:
     print(timestamp(), 'Could not create pointgrid layout because data is not 2D')
     return None
+  from pointgrid import align_points_to_grid
   z = align_points_to_grid(arr, fill=0.01)
   return write_layout(out_path, z, **kwargs)
 
 
 def get_custom_layout(**kwargs):
-  out_path = get_path('layouts', 'custom', **kwargs)
-  if os.path.exists(out_path) and kwargs['use_cache']: return out_path
   if not kwargs.get('metadata'): return
-  found_coords = False
-  coords = []
-  for i in stream_images(**kwargs):
-    x = i.metadata.get('x')
-    y = i.metadata.get('y')
-    if x and y:
-      found_coords = True
-      coords.append([x, y])
-    else:
-      if found_coords:
-        print(timestamp(), 'Some images are missing coordinates; skipping custom layout')
-  if not found_coords: return
-  coords = np.array(coords).astype(np.float)
+  record = get_build_record('custom', **kwargs)
+  if record is not None: return record
+  out_path = get_path('layouts', 'custom', **kwargs)
+  if os.path.exists(out_path) and kwargs['use_cache'] and not kwargs.get('build_cache'):
+    return {'layout': out_path}
+  coords = np.stack([get_metadata_floats('x', **kwargs), get_metadata_floats('y', **kwargs)], axis=1)
+  found = ~np.isnan(coords).any(axis=1)
+  if not found.any(): return
+  if not found.all():
+    print(timestamp(), 'Some images are missing coordinates; skipping custom layout')
+    return
+  from sklearn.preprocessing import minmax_scale
   coords = (minmax_scale(coords)-0.5)*2
   print(timestamp(), 'Creating custom layout')
-  return {
+  return set_build_record('custom', {
     'layout': write_layout(out_path, coords.tolist(), scale=False, round=False, **kwargs),
-  }
+  }, [out_path], **kwargs)
+
+
+##
+# Neighbors
+##
+
+
+class NeighborGraph:
+  '''
+  Approximate k nearest neighbor graph over the PCA-reduced image vectors.
+  The graph is searched once per build, at the largest k requested by the
+  UMAP layouts and the similar images export, and sliced for each of them
+  '''
+  def __init__(self, **kwargs):
+    self.vecs = kwargs['vecs']
+    self.metric = kwargs['metric']
+    self.seed = kwargs['seed']
+    # numba can't run more threads than there are cores
+    self.n_workers = min(get_n_workers(**kwargs), multiprocessing.cpu_count())
+    self.n_neighbors = max(kwargs['n_neighbors'] + [kwargs.get('n_similar', 0) + 1])
+    self.pca = None
+    self.reduced = None
+    self.graph = None # [indices, distances, search index] of the neighbors of each vector
+
+  def get_pca(self):
+    '''Return the PCA model fit on the vectors and the PCA-reduced vectors'''
+    if self.pca is None:
+      from sklearn.decomposition import PCA
+      self.pca = PCA(n_components=min(100, len(self.vecs)), random_state=self.seed)
+      self.reduced = self.pca.fit_transform(self.vecs)
+    return self.pca, self.reduced
+
+  def get(self, n_neighbors):
+    '''Return the indices and distances of the `n_neighbors` neighbors of each vector and the search index'''
+    if self.graph is None:
+      _, w = self.get_pca()
+      k = min(self.n_neighbors, len(w)-1)
+      print(timestamp(), 'Finding the {} nearest neighbors of each image'.format(k))
+      from pynndescent import NNDescent
+      index = NNDescent(w,
+        n_neighbors=k,
+        metric=self.metric,
+        random_state=self.seed,
+        n_jobs=self.n_workers)
+      indices, distances = index.neighbor_graph
+      self.graph = [indices, distances, index]
+    indices, distances, index = self.graph
+    return indices[:, :n_neighbors], distances[:, :n_neighbors], index
+
+
+def get_similar_images(**kwargs):
+  '''Save the indices of the images most similar to each image and return the path to that table'''
+  n = kwargs.get('n_similar', 0)
+  if not n or len(kwargs['vecs']) < 2: return None
+  record = get_build_record('neighbors', **kwargs)
+  if record: return record
+  print(timestamp(), 'Saving the {} most similar images to each image'.format(n))
+  indices, _, _ = kwargs['neighbor_graph'].get(n+1)
+  # move each image to the end of its own list of neighbors, then drop the last column
+  own = indices == np.arange(len(indices))[:, None]
+  order = np.argsort(own, axis=1, kind='stable')
+  similar = np.take_along_axis(indices, order, axis=1)[:, :min(n, indices.shape[1]-1)]
+  out_path = get_path('neighbors', 'neighbors', **kwargs)
+  buffer_path = get_buffer_path(out_path)
+  write_json(out_path, write_buffer(buffer_path, similar, 'uint32'), **kwargs)
+  return set_build_record('neighbors', out_path, [out_path, buffer_path], **kwargs)
 
 
 ##
@@ -868,21 +2472,25 @@ def get_date_layout(cols=3, bin_units='years', **kwargs):
   @param int cols: the number of columns to plot for each bar
   @param str bin_units: the temporal units to use when creating bins
   '''
-  date_vals = [kwargs['metadata'][i].get('year', False) for i in range(len(kwargs['metadata']))]
-  if not kwargs['metadata'] or not any(date_vals): return False
-  # if the data layouts have been cached, return them
+  if not kwargs['metadata']: return False
+  date_vals = get_metadata_column('year', **kwargs)
+  if not any(date_vals): return False
+  record = get_build_record('date', **kwargs)
+  if record is not None: return record
+  # if the data layouts have been cached by a build without a build cache, return them
   positions_out_path = get_path('layouts', 'timeline', **kwargs)
   labels_out_path = get_path('layouts', 'timeline-labels', **kwargs)
   if os.path.exists(positions_out_path) and \
      os.path.exists(labels_out_path) and \
-     kwargs['use_cache']:
+     kwargs['use_cache'] and \
+     not kwargs.get('build_cache'):
     return {
       'layout': positions_out_path,
       'labels': labels_out_path,
     }
   # date layout is not cached, so fetch dates and process
   print(timestamp(), 'Creating date layout with {} columns'.format(cols))
-  datestrings = [i.metadata.get('year', 'no_date') for i in stream_images(**kwargs)]
+  datestrings = ['no_date' if i is None else i for i in date_vals]
   dates = [datestring_to_date(i) for i in datestrings]
   rounded_dates = [round_date(i, bin_units) for i in dates]
   # create d[formatted_date] = [indices into datestrings of dates that round to formatted_date]
@@ -916,23 +2524,23 @@ def get_date_layout(cols=3, bin_units='years', **kwargs):
   dx = (grid_x[1]-grid_x[0]) # size of a single cell
   label_positions[:,1] = label_positions[:,1] - dx
   # quantize the label positions and label positions
-  image_positions = round_floats(coords)
-  label_positions = round_floats(label_positions.tolist())
+  label_positions = round_floats(label_positions)
   # write and return the paths to the date based layout
-  return {
-    'layout': write_json(positions_out_path, image_positions, **kwargs),
+  return set_build_record('date', {
+    'layout': write_layout(positions_out_path, coords, scale=False, **kwargs),
     'labels': write_json(labels_out_path, {
       'positions': label_positions,
       'labels': d_keys.tolist(),
       'cols': cols,
     }, **kwargs),
-  }
+  }, [positions_out_path, labels_out_path], **kwargs)
 
 
 def datestring_to_date(datestring):
   '''
   Given a string representing a date return a datetime object
   '''
+  from dateutil.parser import parse as parse_date
   try:
     return parse_date(str(datestring), fuzzy=True, default=datetime.datetime(9999, 1, 1))
   except Exception as exc:
@@ -987,8 +2595,9 @@ def get_categorical_layout(null_category='Other', margin=2, **kwargs):
   out_path = get_path('layouts', 'categorical', **kwargs)
   labels_out_path = get_path('layouts', 'categorical-labels', **kwargs)
   # accumulate d[category] = [indices of points with category]
-  categories = [i.get('category', None) for i in kwargs['metadata']]
+  categories = get_metadata_column('category', **kwargs)
   if not any(categories) or len(set(categories) - set([None])) == 1: return False
+  categories = [null_category if i is None else i for i in categories]
   d = defaultdict(list)
   for idx, i in enumerate(categories): d[i].append(idx)
   # store the number of observations in each group
@@ -1003,8 +2612,7 @@ def get_categorical_layout(null_category='Other', margin=2, **kwargs):
   for idx, i in enumerate(keys_and_counts):
     offsets[i['key']] += sum([j['count'] for j in keys_and_counts[:idx]])
   sorted_points = []
-  for idx, i in enumerate(stream_images(**kwargs)):
-    category = i.metadata.get('category', null_category)
+  for category in categories:
     sorted_points.append(points[ offsets[category] + counts[category] ])
     counts[category] += 1
   sorted_points = np.array(sorted_points)
@@ -1023,11 +2631,10 @@ def get_categorical_layout(null_category='Other', margin=2, **kwargs):
   # separate out the sorted points and text positions
   text_anchors = sorted_points[-len(text_anchors):]
   sorted_points = sorted_points[:-len(text_anchors)]
-  z = round_floats(sorted_points.tolist())
   return {
-    'layout': write_json(out_path, z, **kwargs),
+    'layout': write_layout(out_path, sorted_points, scale=False, **kwargs),
     'labels': write_json(labels_out_path, {
-      'positions': round_floats(text_anchors.tolist()),
+      'positions': round_floats(text_anchors),
       'labels': [i['key'] for i in keys_and_counts],
     }, **kwargs)
   }
@@ -1109,14 +2716,10 @@ class Box:
 def get_geographic_layout(**kwargs):
   '''Return a 2D array of image positions corresponding to lat, lng coordinates'''
   out_path = get_path('layouts', 'geographic', **kwargs)
-  l = []
-  coords = False
-  for idx, i in enumerate(stream_images(**kwargs)):
-    lat = float(i.metadata.get('lat', 0)) / 180
-    lng = float(i.metadata.get('lng', 0)) / 180 # the plot draws longitude twice as tall as latitude
-    if lat or lng: coords = True
-    l.append([lng, lat])
-  if coords:
+  lat = np.nan_to_num(get_metadata_floats('lat', **kwargs)) / 180
+  lng = np.nan_to_num(get_metadata_floats('lng', **kwargs)) / 180 # the plot draws longitude twice as tall as latitude
+  l = np.stack([lng, lat], axis=1)
+  if np.any(l):
     print(timestamp(), 'Creating geographic layout')
     if kwargs['geojson']:
       process_geojson(kwargs['geojson'])
@@ -1142,6 +2745,314 @@ def process_geojson(geojson_path):
     json.dump(l, out)
 
 
+##
+# Build cache
+##
+
+
+# d[stage] = [config keys, upstream inputs] that determine the outputs of a stage.
+# umap and neighbors both slice the NeighborGraph, which is searched at the
+# largest k either needs, so each depends on n_neighbors and n_similar
+build_stages = {
+  'atlas': [['atlas_size', 'cell_size', 'lod_cell_height'], ['images']],
+  'vectors': [['vector_dtype'], ['images']],
+  'images': [['lod_cell_height', 'image_format', 'image_quality'], ['images']],
+  'umap': [['n_neighbors', 'n_similar', 'min_dist', 'n_components', 'metric', 'seed', 'layout_format', 'umap_variants'], ['vectors', 'labels']],
+  'hotspots': [['min_cluster_size', 'max_clusters', 'n_clusters', 'seed', 'cluster_vectors', 'cluster_threshold'], ['vectors', 'filenames']],
+  'neighbors': [['n_similar', 'n_neighbors', 'metric', 'seed'], ['vectors']],
+  'heightmap': [['heightmap_size', 'heightmap_bandwidth'], []],
+  'grid': [['grid_engine', 'grid_quality', 'layout_format'], ['umap']],
+  'alphabetic': [['layout_format'], ['filenames']],
+  'date': [['layout_format'], ['filenames', 'years']],
+  'custom': [['layout_format'], ['filenames', 'coordinates']],
+}
+
+
+class BuildCache:
+  '''
+  Record a digest of the inputs to each stage along with the outputs that
+  stage produced, so a stage only reruns when its inputs change
+  '''
+  def __init__(self, **kwargs):
+    self.path = join(kwargs['out_dir'], 'cache', 'build.json')
+    self.use_cache = kwargs['use_cache']
+    self.records = {} # d[stage] = {digest, outputs, paths} from the last build of stage
+    self.digests = {} # d[stage] = digest of the inputs to stage in this build
+    if os.path.exists(self.path):
+      with open(self.path) as f:
+        self.records = json.load(f)
+
+  def get(self, stage, digest):
+    '''Return the outputs of `stage` if they were built from inputs with `digest`, else None'''
+    record = self.records.get(stage)
+    if not self.use_cache or not record or record['digest'] != digest:
+      return None
+    if not all(os.path.exists(i) for i in record['paths']):
+      return None
+    return record['outputs']
+
+  def set(self, stage, digest, outputs, paths):
+    '''Record that `outputs`, saved to `paths`, were built from inputs with `digest`'''
+    self.records[stage] = {'digest': digest, 'outputs': outputs, 'paths': paths}
+    write_json(self.path, self.records, gzip=False)
+
+
+def get_build_record(stage, *inputs, **kwargs):
+  '''
+  Return the outputs of `stage` saved by an earlier build if the inputs to
+  `stage` are unchanged, else None. `inputs` are any inputs to the stage
+  beyond those listed in build_stages
+  '''
+  cache = kwargs.get('build_cache')
+  if not cache: return None
+  cache.digests[stage] = get_stage_digest(stage, *inputs, **kwargs)
+  outputs = cache.get(stage, cache.digests[stage])
+  if outputs is not None:
+    print(timestamp(), 'Inputs to {} are unchanged; reusing saved outputs'.format(stage))
+  return outputs
+
+
+def set_build_record(stage, outputs, paths, **kwargs):
+  '''Record `outputs`, saved to `paths`, as the outputs of `stage` and return them'''
+  cache = kwargs.get('build_cache')
+  if cache:
+    cache.set(stage, cache.digests[stage], outputs, [i for i in paths if i])
+  return outputs
+
+
+def get_stage_digest(stage, *inputs, **kwargs):
+  '''Return a digest of the config values and upstream inputs of `stage`'''
+  keys, upstream = build_stages[stage]
+  d = {
+    'stage': stage,
+    'version': get_version(),
+    'config': {i: kwargs.get(i) for i in keys},
+    'inputs': inputs,
+  }
+  for i in upstream:
+    if i == 'images':
+      hashes = kwargs.get('image_hashes') or {}
+      d[i] = [hashes.get(j) or j for j in kwargs['image_paths']]
+    elif i == 'filenames':
+      d[i] = [clean_filename(j) for j in kwargs['image_paths']]
+    elif i == 'labels':
+      d[i] = get_metadata_column('label', **kwargs).tolist()
+    elif i == 'years':
+      d[i] = get_metadata_column('year', **kwargs).tolist()
+    elif i == 'coordinates':
+      d[i] = [get_metadata_floats(j, **kwargs).tolist() for j in ['x', 'y']]
+    else:
+      d[i] = kwargs['build_cache'].digests.get(i)
+  return get_digest(d)
+
+
+def get_digest(obj):
+  '''Return the sha1 digest of JSON-serializable object `obj`'''
+  return hashlib.sha1(json.dumps(obj, sort_keys=True, default=str).encode('utf8')).hexdigest()
+
+
+##
+# Profiling
+##
+
+
+# subdirectories of the output dir with a file per image, which the profiler
+# only searches for new files after the stages that write to them
+per_image_dirs = ['originals', 'thumbs', 'metadata', 'shards']
+
+# d[stage] = the per_image_dirs to which stage writes
+profile_dirs = {
+  'image_pass': ['originals', 'thumbs'],
+  'append_images': ['originals', 'thumbs'],
+  'process_shard': ['originals', 'thumbs', 'shards'],
+  'reduce_shards': ['shards'],
+  'write_metadata': ['metadata'],
+}
+
+
+class Profiler:
+  '''
+  Measure the wall time, CPU time, peak memory, throughput and bytes written
+  of each stage of a build and write them to a JSON report in the output dir.
+  CPU time and peak memory include worker processes once they have exited
+  '''
+  def __init__(self, **kwargs):
+    self.out_dir = kwargs['out_dir']
+    name = 'profile' if kwargs.get('shard') is None else 'profile-shard-{}'.format(kwargs['shard'])
+    self.path = get_path('profile', name, **dict(kwargs, gzip=False))
+    self.stacks = kwargs.get('profile_stacks', False)
+    self.start = time.time()
+    self.stages = []
+    self.timers = defaultdict(float) # d[timer name] = seconds spent in it during the current stage
+    self.lock = threading.Lock()
+
+  def run(self, stage, fn, *args, **kwargs):
+    '''Run fn(*args, **kwargs) as `stage` and record its costs'''
+    n_images = len(kwargs.get('image_paths') or [])
+    sampler = StackSampler() if self.stacks else None
+    reset_peak_rss()
+    self.timers.clear()
+    start, cpu = time.time(), get_cpu_time()
+    result = None
+    try:
+      result = fn(*args, **kwargs)
+      return result
+    finally:
+      # stages that find the images, like filter_images, return them first
+      if not n_images and isinstance(result, (list, tuple)) and result and isinstance(result[0], list):
+        n_images = len(result[0])
+      wall = time.time() - start
+      cpu = [i - j for i, j in zip(get_cpu_time(), cpu)]
+      skip = [i for i in per_image_dirs if i not in profile_dirs.get(stage, [])]
+      files, size = get_bytes_written(self.out_dir, start, skip=skip)
+      peak = get_peak_rss()
+      self.stages.append({
+        'stage': stage,
+        'wall_seconds': round(wall, 3),
+        'cpu_seconds': round(cpu[0], 3),
+        'child_cpu_seconds': round(cpu[1], 3),
+        'peak_rss_bytes': peak[0],
+        'child_peak_rss_bytes': peak[1],
+        'images': n_images,
+        'images_per_second': round(n_images / max(wall, 1e-6), 2),
+        'files_written': files,
+        'bytes_written': size,
+        'timers': {i: round(j, 3) for i, j in self.timers.items()},
+      })
+      if sampler:
+        self.stages[-1]['stacks'] = sampler.close(join(self.out_dir, 'profile', stage.replace('/', '-') + '-stacks.txt'))
+
+  def add_time(self, timer, seconds):
+    '''Add `seconds` to `timer` within the current stage; safe to call from any thread'''
+    with self.lock:
+      self.timers[timer] += seconds
+
+  def close(self):
+    '''Write the report, print a summary, and return the path to the report'''
+    hottest = max(self.stages, key=lambda i: i['wall_seconds'])['stage'] if self.stages else None
+    report = {
+      'version': get_version(),
+      'argv': sys.argv[1:],
+      'cpu_count': multiprocessing.cpu_count(),
+      'wall_seconds': round(time.time() - self.start, 3),
+      'hottest_stage': hottest,
+      'stages': self.stages,
+    }
+    write_json(self.path, report, gzip=False)
+    print(timestamp(), 'Profile of each stage (written to {})'.format(self.path))
+    print('{:>24} {:>10} {:>10} {:>10} {:>10} {:>12}'.format('stage', 'wall s', 'cpu s', 'peak MB', 'images/s', 'MB written'))
+    for i in self.stages:
+      print('{:>24} {:>10.1f} {:>10.1f} {:>10.0f} {:>10.1f} {:>12.1f}'.format(i['stage'], i['wall_seconds'],
+        i['cpu_seconds'] + i['child_cpu_seconds'],
+        max(i['peak_rss_bytes'] or 0, i['child_peak_rss_bytes'] or 0) / 2**20,
+        i['images_per_second'], i['bytes_written'] / 2**20))
+    return self.path
+
+
+def run_stage(stage, fn, *args, **kwargs):
+  '''Return fn(*args, **kwargs), profiling it as `stage` if a profiler is set'''
+  profiler = kwargs.get('profiler')
+  if not profiler: return fn(*args, **kwargs)
+  return profiler.run(stage, fn, *args, **kwargs)
+
+
+def add_stage_time(timer, seconds, **kwargs):
+  '''Add `seconds` to `timer` in the stage being profiled, if any'''
+  if kwargs.get('profiler'): kwargs['profiler'].add_time(timer, seconds)
+
+
+def get_cpu_time():
+  '''Return the user + system CPU seconds of this process and of its exited child processes'''
+  t = os.times()
+  return [t.user + t.system, t.children_user + t.children_system]
+
+
+def get_peak_rss():
+  '''Return the peak resident memory in bytes of this process and of its largest exited child, or None'''
+  try:
+    import resource
+  except ImportError: # windows
+    return [None, None]
+  # ru_maxrss is in kilobytes on linux and bytes on macos
+  scale = 1 if sys.platform == 'darwin' else 1024
+  peak = [resource.getrusage(i).ru_maxrss * scale for i in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]]
+  # on linux the peak of this process can be reset between stages, so read it from /proc
+  try:
+    with open('/proc/self/status') as f:
+      peak[0] = [int(i.split()[1]) * 1024 for i in f if i.startswith('VmHWM:')][0]
+  except (IOError, OSError, IndexError):
+    pass
+  return peak
+
+
+def reset_peak_rss():
+  '''Reset the peak resident memory of this process where the os allows it (linux 4.0+)'''
+  try:
+    with open('/proc/self/clear_refs', 'w') as f:
+      f.write('5')
+  except (IOError, OSError):
+    pass
+
+
+def get_bytes_written(out_dir, since, skip=[]):
+  '''
+  Return the number and total size of files in `out_dir` modified after time
+  `since`, without searching the subdirectories of `out_dir` named in `skip`
+  '''
+  files, size = 0, 0
+  dirs = [out_dir]
+  while dirs:
+    d = dirs.pop()
+    try:
+      entries = list(os.scandir(d))
+    except OSError:
+      continue
+    for i in entries:
+      if i.is_dir(follow_symlinks=False):
+        if d != out_dir or i.name not in skip: dirs.append(i.path)
+      else:
+        stat = i.stat(follow_symlinks=False)
+        if stat.st_mtime >= since:
+          files += 1
+          size += stat.st_size
+  return files, size
+
+
+class StackSampler:
+  '''
+  Sample the call stack of every thread in this process at `interval` seconds
+  and save the counts of each stack in the collapsed format read by flame
+  graph tools. Stacks in worker processes are not sampled
+  '''
+  def __init__(self, interval=0.01):
+    self.interval = interval
+    self.counts = defaultdict(int) # d[collapsed stack] = number of samples
+    self.done = threading.Event()
+    self.thread = threading.Thread(target=self.sample, daemon=True)
+    self.thread.start()
+
+  def sample(self):
+    '''Count the stacks of all other threads until close() is called'''
+    while not self.done.wait(self.interval):
+      for thread_id, frame in sys._current_frames().items():
+        if thread_id == self.thread.ident: continue
+        stack = []
+        while frame is not None:
+          stack.append('{}:{}'.format(os.path.basename(frame.f_code.co_filename), frame.f_code.co_name))
+          frame = frame.f_back
+        self.counts[';'.join(reversed(stack))] += 1
+
+  def close(self, path):
+    '''Stop sampling, write the collapsed stacks to `path`, and return `path`'''
+    self.done.set()
+    self.thread.join()
+    if not os.path.exists(os.path.dirname(path)): os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as out:
+      for stack, count in sorted(self.counts.items(), key=lambda i: -i[1]):
+        out.write('{} {}\n'.format(stack, count))
+    return path
+
+
 ##
 # Helpers
 ##
@@ -1157,10 +3068,21 @@ def get_path(*args, **kwargs):
   return path + '.gz' if kwargs.get('gzip', False) else path
 
 
+def get_n_workers(**kwargs):
+  '''Return the number of workers to use for parallel stages'''
+  return kwargs.get('n_workers', None) or multiprocessing.cpu_count()
+
+
 def write_layout(path, obj, **kwargs):
   '''Write layout json `obj` to disk and return the path to the saved file'''
   if kwargs.get('scale', True) != False:
+    from sklearn.preprocessing import minmax_scale
     obj = (minmax_scale(obj)-0.5)*2 # scale -1:1
+  # binary layouts save a JSON header at `path` that describes a buffer beside it
+  layout_format = kwargs.get('layout_format', 'json')
+  if layout_format != 'json':
+    header = write_buffer(get_buffer_path(path), obj, layout_format)
+    return write_json(path, header, **kwargs)
   if kwargs.get('round', True) != False:
     obj = round_floats(obj)
   if isinstance(obj, np.ndarray):
@@ -1168,22 +3090,76 @@ def write_layout(path, obj, **kwargs):
   return write_json(path, obj, **kwargs)
 
 
+def read_layout(path, **kwargs):
+  '''Read the layout at `path` written by write_layout and return it as a numpy array'''
+  obj = read_json(path, **kwargs)
+  if isinstance(obj, dict) and 'buffer' in obj:
+    return read_buffer(os.path.dirname(path), obj)
+  return np.array(obj)
+
+
 def round_floats(obj, digits=5):
   '''Return 2D array obj with rounded float precision'''
-  return [[round(float(j), digits) for j in i] for i in obj]
+  return np.round(np.asarray(obj, dtype=float), digits).tolist()
+
+
+# d[format] = little-endian dtype of binary buffers saved in that format
+buffer_dtypes = {
+  'float32': '<f4',
+  'int16': '<i2',
+  'uint16': '<u2',
+  'uint32': '<u4',
+}
+
+
+def get_buffer_path(path):
+  '''Return the path to the binary buffer described by the JSON file at `path`'''
+  path = path[:-3] if path.endswith('.gz') else path
+  return os.path.splitext(path)[0] + '.bin'
+
+
+def write_buffer(path, obj, fmt):
+  '''Write array `obj` to `path` as a raw buffer in `fmt` and return a header describing it'''
+  arr = np.asarray(obj)
+  header = {
+    'format': fmt,
+    'shape': list(arr.shape),
+    'buffer': os.path.basename(path),
+  }
+  # quantize int16 buffers to the full int16 range and store the scale that restores them
+  if fmt == 'int16':
+    header['scale'] = float(np.abs(arr).max()) / 32767 or 1.0
+    arr = np.round(arr / header['scale'])
+  data = arr.astype(buffer_dtypes[fmt]).tobytes()
+  # the hash lets consumers that digest the header notice changes to the buffer
+  header['hash'] = hashlib.sha1(data).hexdigest()
+  out_dir = os.path.dirname(path)
+  if not os.path.exists(out_dir): os.makedirs(out_dir)
+  with open(path, 'wb') as out:
+    out.write(data)
+  return header
+
+
+def read_buffer(directory, header):
+  '''Return the array described by `header`, whose buffer is saved in `directory`'''
+  arr = np.fromfile(join(directory, header['buffer']), dtype=buffer_dtypes[header['format']])
+  arr = arr.reshape(header['shape']).astype(float)
+  if 'scale' in header: arr *= header['scale']
+  return arr
 
 
 def write_json(path, obj, **kwargs):
   '''Write json object `obj` to disk and return the path to that file'''
   out_dir, filename = os.path.split(path)
   if not os.path.exists(out_dir): os.makedirs(out_dir)
+  indent = kwargs.get('indent', 4)
   if kwargs.get('gzip', False):
     with gzip.GzipFile(path, 'w') as out:
-      out.write(json.dumps(obj, indent=4).encode(kwargs['encoding']))
+      out.write(json.dumps(obj, indent=indent).encode(kwargs['encoding']))
     return path
   else:
     with open(path, 'w') as out:
-      json.dump(obj, out, indent=4)
+      json.dump(obj, out, indent=indent)
     return path
 
 
@@ -1198,13 +3174,25 @@ def read_json(path, **kwargs):
 
 def get_hotspots(layouts={}, use_high_dimensional_vectors=True, **kwargs):
   '''Return the stable clusters from the condensed tree of connected components from the density graph'''
-  print(timestamp(), 'Clustering data with {}'.format(cluster_method))
-  if use_high_dimensional_vectors:
-    vecs = kwargs['vecs']
+  # when appending to a plot, keep the hotspots of the images already in it
+  if kwargs.get('plot_manifest') and kwargs['plot_manifest'].get('default_hotspots'):
+    return kwargs['plot_manifest']['default_hotspots']
+  inputs = [use_high_dimensional_vectors]
+  if not use_high_dimensional_vectors:
+    inputs.append(hash_file(layouts['umap']['variants'][0]['layout']))
+  record = get_build_record('hotspots', *inputs, **kwargs)
+  if record: return record
+  if not use_high_dimensional_vectors:
+    vecs, kind = read_layout(layouts['umap']['variants'][0]['layout'], **kwargs), 'umap'
+  elif kwargs.get('cluster_vectors', config['cluster_vectors']) == 'reduced':
+    vecs, kind = kwargs['neighbor_graph'].get_pca()[1], 'PCA-reduced'
   else:
-    vecs = read_json(layouts['umap']['variants'][0]['layout'], **kwargs)
-  model = get_cluster_model(**kwargs)
+    vecs, kind = kwargs['vecs'], 'full'
+  model, strategy = get_cluster_model(n_samples=len(vecs), **kwargs)
+  print(timestamp(), 'Clustering {} {} vectors with {}'.format(len(vecs), kind, strategy))
+  start = time.time()
   z = model.fit(vecs)
+  print(timestamp(), 'Clustering took {:.1f}s'.format(time.time() - start))
   # create a map from cluster label to image indices in cluster
   d = defaultdict(lambda: defaultdict(list))
   for idx, i in enumerate(z.labels_):
@@ -1230,100 +3218,216 @@ def get_hotspots(layouts={}, use_high_dimensional_vectors=True, **kwargs):
   clusters = clusters[:kwargs['max_clusters']]
   # save the hotspots to disk and return the path to the saved json
   print(timestamp(), 'Found', len(clusters), 'hotspots')
-  return write_json(get_path('hotspots', 'hotspot', **kwargs), clusters, **kwargs)
+  out_path = write_json(get_path('hotspots', 'hotspot', **kwargs), clusters, **kwargs)
+  return set_build_record('hotspots', out_path, [out_path], **kwargs)
 
 
-def get_cluster_model(**kwargs):
-  '''Return a model with .fit() method that can be used to cluster input vectors'''
-  if cluster_method == 'hdbscan':
-    config = {
-      'core_dist_n_jobs': multiprocessing.cpu_count(),
+def get_cluster_model(n_samples=0, **kwargs):
+  '''
+  Return a model with .fit() method that can be used to cluster `n_samples`
+  input vectors and a description of the clustering strategy. Above
+  cluster_threshold samples, use the approximate variant of the model
+  '''
+  approximate = n_samples > kwargs.get('cluster_threshold', config['cluster_threshold'])
+  try:
+    from hdbscan import HDBSCAN
+  except:
+    HDBSCAN = None
+    print(timestamp(), 'HDBSCAN not available; using sklearn KMeans')
+  if HDBSCAN is not None:
+    params = {
+      'core_dist_n_jobs': get_n_workers(**kwargs),
       'min_cluster_size': kwargs['min_cluster_size'],
       'cluster_selection_epsilon': 0.01,
       'min_samples': 1,
-      'approx_min_span_tree': False,
+      'approx_min_span_tree': approximate,
     }
-    return HDBSCAN(**config)
+    if approximate:
+      params['algorithm'] = 'boruvka_balltree'
+      return HDBSCAN(**params), 'HDBSCAN (boruvka, approximate minimum spanning tree)'
+    return HDBSCAN(**params), 'HDBSCAN (exact minimum spanning tree)'
+  elif approximate:
+    from sklearn.cluster import MiniBatchKMeans
+    model = MiniBatchKMeans(n_clusters=kwargs['n_clusters'], random_state=kwargs['seed'], batch_size=4096)
+    return model, 'MiniBatchKMeans'
   else:
-    return KMeans(n_clusters=kwargs['n_clusters'], random_state=kwargs['seed'])
+    from sklearn.cluster import KMeans
+    return KMeans(n_clusters=kwargs['n_clusters'], random_state=kwargs['seed']), 'KMeans'
 
 
 def get_heightmap(path, label, **kwargs):
   '''Create a heightmap using the distribution of points stored at `path`'''
-  import matplotlib.pyplot as plt
-  X = read_json(path, **kwargs)
-  if 'positions' in X: X = X['positions']
-  X = np.array(X)
+  record = get_build_record('heightmap', hash_file(path), label, **kwargs)
+  if record: return record
+  X = read_layout(path, **kwargs)
   if X.shape[-1] != 2:
     print(timestamp(), 'Could not create heightmap because data is not 2D')
     return
-  # create kernel density estimate of distribution X
-  nbins = 200
-  x, y = X.T
-  xi, yi = np.mgrid[x.min():x.max():nbins*1j, y.min():y.max():nbins*1j]
-  zi = kde.gaussian_kde(X.T)(np.vstack([xi.flatten(), yi.flatten()]))
-  # create the plot
-  fig, ax = plt.subplots(nrows=1, ncols=1, figsize=(5,5))
-  fig.subplots_adjust(0,0,1,1)
-  plt.pcolormesh(xi, yi, zi.reshape(xi.shape), shading='gouraud', cmap=plt.cm.gray)
-  plt.axis('off')
-  # save the plot
+  z = get_density(X,
+    size=kwargs.get('heightmap_size', config['heightmap_size']),
+    bandwidth=kwargs.get('heightmap_bandwidth', config['heightmap_bandwidth']))
+  # save the density as a grayscale image with y increasing upwards
+  z = (z - z.min()) / max(np.ptp(z), 1e-12) * 255
   out_dir = os.path.join(kwargs['out_dir'], 'heightmaps')
   if not os.path.exists(out_dir): os.makedirs(out_dir)
   out_path = os.path.join(out_dir, label + '-heightmap.png')
-  plt.savefig(out_path, pad_inches=0)
-
-
-def write_images(**kwargs):
-  '''Write all originals and thumbs to the output dir'''
-  for i in stream_images(**kwargs):
-    filename = clean_filename(i.path)
-    # copy original for lightbox
-    out_dir = join(kwargs['out_dir'], 'originals')
-    if not exists(out_dir): os.makedirs(out_dir)
-    out_path = join(out_dir, filename)
-    if not os.path.exists(out_path):
-      resized = i.resize_to_height(600)
-      resized = array_to_img(resized)
-      save_img(out_path, resized)
-    # copy thumb for lod texture
-    out_dir = join(kwargs['out_dir'], 'thumbs')
-    if not exists(out_dir): os.makedirs(out_dir)
-    out_path = join(out_dir, filename)
-    img = array_to_img(i.resize_to_max(kwargs['lod_cell_height']))
-    save_img(out_path, img)
+  PIL.Image.fromarray(np.round(z.T[::-1]).astype(np.uint8), 'L').save(out_path)
+  return set_build_record('heightmap', out_path, [out_path], **kwargs)
+
+
+def get_density(X, size=500, bandwidth=1.0):
+  '''
+  Return a `size` x `size` gaussian kernel density estimate of the 2D points
+  `X`, indexed [x, y]. The points are binned into a histogram, which is then
+  convolved with the kernel using FFTs, so the cost is linear in len(X).
+  `bandwidth` scales the width of the kernel given by Scott's rule
+  '''
+  from scipy.signal import fftconvolve
+  x, y = X.T
+  hist, x_edges, y_edges = np.histogram2d(x, y, bins=size,
+    range=[[x.min(), x.max()], [y.min(), y.max()]])
+  # determine the kernel's standard deviation along each axis in bins
+  scott = len(X) ** (-1/6) * bandwidth
+  sigma = [
+    max(scott * np.std(x) / max(x_edges[1] - x_edges[0], 1e-12), 1e-3),
+    max(scott * np.std(y) / max(y_edges[1] - y_edges[0], 1e-12), 1e-3),
+  ]
+  # build a kernel that covers 4 standard deviations on each side, up to the size of the histogram
+  axes = [np.arange(-min(math.ceil(4*i), size), min(math.ceil(4*i), size)+1) for i in sigma]
+  kernel = np.outer(
+    np.exp(-0.5 * (axes[0] / sigma[0])**2),
+    np.exp(-0.5 * (axes[1] / sigma[1])**2))
+  return np.maximum(fftconvolve(hist, kernel / kernel.sum(), mode='same'), 0)
+
+
+# d[image_format] = [PIL format, suffix added to each output filename]
+image_formats = {
+  'jpeg': ['JPEG', '.jpg'],
+  'webp': ['WEBP', '.webp'],
+}
+
+
+class ImageWriter:
+  '''
+  Write the original and thumb of each image passed to add(). Images are
+  encoded from PIL on the decoding threads, and outputs newer than their
+  input image are left in place unless the output settings have changed
+  '''
+  def __init__(self, **kwargs):
+    self.lod_cell_height = kwargs['lod_cell_height']
+    self.decode_size = max(600, self.lod_cell_height)
+    self.originals_dir = join(kwargs['out_dir'], 'originals')
+    self.thumbs_dir = join(kwargs['out_dir'], 'thumbs')
+    for i in [self.originals_dir, self.thumbs_dir]:
+      os.makedirs(i, exist_ok=True)
+    self.format, self.suffix = image_formats.get(kwargs.get('image_format'), [None, ''])
+    self.quality = kwargs.get('image_quality', config['image_quality'])
+    # outputs written with other settings are rewritten even if they are newer than their inputs
+    self.settings = {'lod_cell_height': self.lod_cell_height, 'format': self.format, 'quality': self.quality}
+    self.settings_path = join(kwargs.get('cache_dir') or join(kwargs['out_dir'], 'cache'), 'image-settings.json')
+    self.use_cache = kwargs.get('use_cache', True) and os.path.exists(self.settings_path) and \
+      read_json(self.settings_path) == self.settings
+    self.lock = threading.Lock()
+    self.start = None
+    self.written = 0 # number of images whose original or thumb was written
+    self.skipped = 0 # number of images whose original and thumb were current
+
+  def get_paths(self):
+    '''Return the directories to which images are written'''
+    return [self.originals_dir, self.thumbs_dir]
+
+  def get_out_paths(self, path):
+    '''Return the paths of the original and thumb written for the image at `path`'''
+    filename = clean_filename(path) + self.suffix
+    return [join(self.originals_dir, filename), join(self.thumbs_dir, filename)]
+
+  def is_current(self, path, out_path=None):
+    '''Return True if `out_path` (or both outputs for the image at `path`) are newer than that image'''
+    if not self.use_cache: return False
+    out_paths = [out_path] if out_path else self.get_out_paths(path)
+    try:
+      mtime = os.path.getmtime(path)
+      return all(os.path.getmtime(i) >= mtime for i in out_paths)
+    except OSError:
+      return False
+
+  def prepare(self, i):
+    '''Write the original and thumb for Image `i` on the decoding thread'''
+    with self.lock:
+      if self.start is None: self.start = time.time()
+    written = False
+    original_path, thumb_path = self.get_out_paths(i.path)
+    # the original for the lightbox is resized to 600px high
+    if not self.is_current(i.path, original_path):
+      self.save(i.original.resize(get_height_size(i.size, 600)), original_path)
+      written = True
+    # the thumb for the lod texture reuses the resize made by the filter checks
+    if not self.is_current(i.path, thumb_path):
+      self.save(PIL.Image.fromarray(i.resize_to_max(self.lod_cell_height)), thumb_path)
+      written = True
+    with self.lock:
+      if written: self.written += 1
+      else: self.skipped += 1
+
+  def save(self, img, path):
+    '''Encode PIL image `img` to `path` in the configured format and quality'''
+    img.save(path, format=self.format, quality=self.quality)
+
+  def add(self, i):
+    pass
+
+  def close(self):
+    '''Record the output settings and report the number of images written per second'''
+    write_json(self.settings_path, self.settings, gzip=False)
+    if not self.written: return
+    elapsed = max(time.time() - self.start, 1e-6)
+    print(timestamp(), 'Wrote the originals and thumbs of {} images ({:.1f} images/s); {} were up to date'.format(
+      self.written, self.written / elapsed, self.skipped))
 
 
 def get_version():
   '''Return the version of pixplot installed'''
-  return pkg_resources.get_distribution('pixplot').version
+  try:
+    from importlib.metadata import version # python 3.8+
+  except ImportError:
+    import pkg_resources
+    return pkg_resources.get_distribution('pixplot').version
+  return version('pixplot')
 
 
 class Image:
+  '''
+  An input image. If kwargs['decode_size'] is given, self.original may be
+  decoded at a reduced resolution whose sides are each at least that many
+  pixels, so only resize to sizes computed from self.size, the (w, h) of
+  the full image
+  '''
   def __init__(self, *args, **kwargs):
     self.path = args[0]
-    self.original = load_img(self.path)
+    self.original, self.size = load_image(self.path, kwargs.get('decode_size'))
     self.metadata = kwargs['metadata'] if kwargs['metadata'] else {}
+    self.resized = {} # d[(w, h)] = uint8 array of self.original resized to w, h
+
+  def resize(self, size):
+    '''
+    Resize self.original to `size` (w, h), reusing any prior resize to the same
+    size so each stage that needs a given size shares a single resize
+    '''
+    if size not in self.resized:
+      self.resized[size] = np.asarray(self.original.resize(size), dtype='uint8')
+    return self.resized[size]
 
   def resize_to_max(self, n):
     '''
     Resize self.original so its longest side has n pixels (maintain proportion)
     '''
-    w,h = self.original.size
-    size = (n, int(n * h/w)) if w > h else (int(n * w/h), n)
-    return img_to_array(self.original.resize(size))
+    return self.resize(get_max_size(self.size, n))
 
   def resize_to_height(self, height):
     '''
     Resize self.original into an image with height h and proportional width
     '''
-    w,h = self.original.size
-    if (w/h*height) < 1:
-      resizedwidth = 1
-    else:
-      resizedwidth =  int(w/h*height)
-    size = (resizedwidth, height)
-    return img_to_array(self.original.resize(size))
+    return self.resize(get_height_size(self.size, height))
 
   def resize_to_square(self, n, center=False):
     '''
@@ -1340,6 +3444,43 @@ class Image:
     return b
 
 
+def load_image(path, decode_size=None):
+  '''
+  Return the image at `path` as an RGB PIL image and the (w, h) of the full
+  image. If `decode_size` is given, the image is decoded at the lowest
+  resolution whose sides are each at least `decode_size` pixels: JPEGs are
+  scaled by 1/2, 1/4 or 1/8 as they are decoded, and other images are
+  reduced by a whole factor after they are decoded
+  '''
+  img = PIL.Image.open(path)
+  size = img.size
+  scale = min(size) / decode_size if decode_size else 1
+  if scale >= 2 and img.format == 'JPEG':
+    img.draft('RGB', (math.ceil(size[0] / scale), math.ceil(size[1] / scale)))
+  img.load()
+  if img.mode != 'RGB': img = img.convert('RGB')
+  factor = int(min(img.size) // decode_size) if decode_size else 1
+  if factor >= 2 and hasattr(img, 'reduce'): # pillow 7+
+    img = img.reduce(factor)
+  return [img, size]
+
+
+def get_max_size(size, n):
+  '''Return the (w, h) of an image of size `size` resized so its longest side has n pixels'''
+  w,h = size
+  return (n, int(n * h/w)) if w > h else (int(n * w/h), n)
+
+
+def get_height_size(size, height):
+  '''Return the (w, h) of an image of size `size` resized to height `height`'''
+  w,h = size
+  if (w/h*height) < 1:
+    resizedwidth = 1
+  else:
+    resizedwidth =  int(w/h*height)
+  return (resizedwidth, height)
+
+
 ##
 # Entry Point
 ##
@@ -1355,11 +3496,18 @@ def parse():
   parser.add_argument('--use_cache', type=bool, default=config['use_cache'], help='given inputs identical to prior inputs, load outputs from cache', required=False)
   parser.add_argument('--encoding', type=str, default=config['encoding'], help='the encoding of input metadata', required=False)
   parser.add_argument('--min_cluster_size', type=int, default=config['min_cluster_size'], help='the minimum number of images in a cluster', required=False)
+  parser.add_argument('--cluster_vectors', type=str, default=config['cluster_vectors'], choices=['reduced', 'full'], help='cluster the PCA-reduced image vectors or the full image vectors when finding hotspots')
+  parser.add_argument('--cluster_threshold', type=int, default=config['cluster_threshold'], help='the number of images above which hotspots are found with approximate clustering')
   parser.add_argument('--max_clusters', type=int, default=config['max_clusters'], help='the maximum number of clusters to return', required=False)
   parser.add_argument('--out_dir', type=str, default=config['out_dir'], help='the directory to which outputs will be saved', required=False)
   parser.add_argument('--cell_size', type=int, default=config['cell_size'], help='the size of atlas cells in px', required=False)
   parser.add_argument('--n_neighbors', nargs='+', type=int, default=config['n_neighbors'], help='the n_neighbors arguments for UMAP')
   parser.add_argument('--min_dist', nargs='+', type=float, default=config['min_dist'], help='the min_dist arguments for UMAP')
+  parser.add_argument('--umap_variants', type=str, default=config['umap_variants'], choices=['aligned', 'parallel'], help='fit multiple UMAP variants with AlignedUMAP or in parallel processes that share one neighbor graph')
+  parser.add_argument('--grid_engine', type=str, default=config['grid_engine'], choices=['bisection', 'rasterfairy'], help='the engine that creates the grid layout; rasterfairy does not scale to large plots')
+  parser.add_argument('--grid_quality', type=int, default=config['grid_quality'], help='the number of points the bisection grid engine assigns to cells at once; higher values are slower but preserve more structure')
+  parser.add_argument('--heightmap_size', type=int, default=config['heightmap_size'], help='the width and height of the umap heightmap in pixels')
+  parser.add_argument('--heightmap_bandwidth', type=float, default=config['heightmap_bandwidth'], help='the width of the heightmap smoothing kernel relative to the width given by Scott\'s rule')
   parser.add_argument('--n_components', type=int, default=config['n_components'], help='the n_components argument for UMAP')
   parser.add_argument('--metric', type=str, default=config['metric'], help='the metric argument for umap')
   parser.add_argument('--pointgrid_fill', type=float, default=config['pointgrid_fill'], help='float 0:1 that determines sparsity of jittered distributions (lower means more sparse)')
@@ -1370,6 +3518,23 @@ def parse():
   parser.add_argument('--plot_id', type=str, default=config['plot_id'], help='unique id for a plot; useful for resuming processing on a started plot')
   parser.add_argument('--seed', type=int, default=config['seed'], help='seed for random processes')
   parser.add_argument('--n_clusters', type=int, default=config['n_clusters'], help='number of clusters to use when clustering with kmeans')
+  parser.add_argument('--batch_size', type=int, default=config['batch_size'], help='number of images to pass through the Inception model at once')
+  parser.add_argument('--metadata_format', type=str, default=config['metadata_format'], choices=['files', 'packed'], help='write the metadata of each image to its own file or pack all metadata into a few files')
+  parser.add_argument('--image_format', type=str, default=config['image_format'], choices=['source', 'jpeg', 'webp'], help='the format of the thumbs and originals; source keeps the format of each input image')
+  parser.add_argument('--image_quality', type=int, default=config['image_quality'], help='the JPEG or WebP quality (1-100) of the thumbs and originals')
+  parser.add_argument('--fetch_workers', type=int, default=config['fetch_workers'], help='the number of IIIF manifests and image urls to download at once')
+  parser.add_argument('--fetch_per_host', type=int, default=config['fetch_per_host'], help='the most connections to open to any one host when downloading urls')
+  parser.add_argument('--profile', action='store_true', help='write a report of the time, memory, throughput and bytes written of each stage to the output dir')
+  parser.add_argument('--profile_stacks', action='store_true', help='with --profile, also sample the call stacks of each stage and save them for flame graph tools')
+  parser.add_argument('--n_workers', type=int, default=config['n_workers'], help='number of workers to use for parallel stages (defaults to the number of cores)')
+  parser.add_argument('--vector_dtype', type=str, default=config['vector_dtype'], choices=['float32', 'float16'], help='the dtype in which to store image vectors')
+  parser.add_argument('--layout_format', type=str, default=config['layout_format'], choices=['json', 'float32', 'int16'], help='the format in which to save layouts and the imagelist; float32 and int16 save binary buffers')
+  parser.add_argument('--n_similar', type=int, default=config['n_similar'], help='number of similar images to save for each image; 0 to skip')
+  parser.add_argument('--n_shards', type=int, default=config['n_shards'], help='number of shards into which the images are split for a multi-node build')
+  parser.add_argument('--shard', type=int, default=config['shard'], help='process only the images in this shard (0 to n_shards - 1) and exit')
+  parser.add_argument('--reduce', action='store_true', help='wait for all --n_shards shards to finish, then merge them and build the plot')
+  parser.add_argument('--shard_timeout', type=float, default=config['shard_timeout'], help='seconds the reduce step waits for the shards to finish; 0 to wait forever')
+  parser.add_argument('--append', action='store_true', help='add input images that are not yet in the plot with --plot_id to that plot')
   parser.add_argument('--geojson', type=str, default=config['geojson'], help='path to a GeoJSON file with shapes to be rendered on a map')
   config.update(vars(parser.parse_args()))
   process_images(**config)
@@ -46,6 +46,7 @@ function Config() {
     dir: 'data', // data folder within the output_directory
     file: 'manifest.json',
     gzipped: false,
+    imageSuffix: '', // extension added to the filename of each thumb and original
   }
   this.mobileBreakpoint = 600;
   this.isTouchDevice = 'ontouchstart' in document.documentElement;
@@ -127,7 +128,9 @@ Data.prototype.load = function() {
     function(json) {
       config.data.output_directory = json.output_directory;
       get(getPath(json.imagelist), function(data) {
-        this.parseManifest(Object.assign({}, json, data));
+        getImagelist(json.imagelist, data, function(imagelist) {
+          this.parseManifest(Object.assign({}, json, imagelist));
+        }.bind(this))
       }.bind(this))
     }.bind(this),
     function(err) {
@@ -148,6 +151,7 @@ Data.prototype.parseManifest = function(json) {
   config.size.cell = json.config.sizes.cell;
   config.size.atlas = json.config.sizes.atlas;
   config.size.lodCell = json.config.sizes.lod;
+  config.data.imageSuffix = json.config.image_suffix || '';
   config.size.points = json.point_sizes;
   // update the point size DOM element
   world.elems.pointSize.min = 0;
@@ -174,9 +178,8 @@ Data.prototype.parseManifest = function(json) {
     }));
   };
   // add cells to the world
-  layout.getLayoutPath.bind(layout)
-  get(getPath(layout.getLayoutPath()), function(data) {
-    this.addCells(data);
+  getPositions(layout.getLayoutPath(), function(positions) {
+    this.addCells(positions);
     this.hotspots.initialize();
   }.bind(this))
 }
@@ -203,23 +206,21 @@ Data.prototype.addCells = function(positions) {
   }
   // create all cells
   var idx = 0; // index of cell among all cells
-  for (var i=0; i<this.json.cell_sizes.length; i++) { // atlas index
-    for (var j=0; j<this.json.cell_sizes[i].length; j++) { // cell index within atlas
+  for (var i=0; i<this.json.atlas.counts.length; i++) { // atlas index
+    for (var j=0; j<this.json.atlas.counts[i]; j++) { // cell index within atlas
       drawcall.vertices++;
       var texIdx = Math.floor(i/config.atlasesPerTex),
-          worldPos = positions[idx], // position of cell in world -1:1
-          atlasPos = this.json.atlas.positions[i][j], // idx-th cell position in atlas
-          atlasOffset = getAtlasOffset(i),
-          size = this.json.cell_sizes[i][j];
+          worldPos = idx * positions.dims, // offset of cell's position in world -1:1
+          atlasOffset = getAtlasOffset(i);
       this.cells.push(new Cell({
         idx: idx, // index of cell among all cells
-        w:  size[0], // width of cell in lod atlas
-        h:  size[1], // height of cell in lod atlas
-        x:  worldPos[0], // x position of cell in world
-        y:  worldPos[1], // y position of cell in world
-        z:  worldPos[2] || null, // z position of cell in world
-        dx: atlasPos[0] + atlasOffset.x, // x offset of cell in atlas
-        dy: atlasPos[1] + atlasOffset.y, // y offset of cell in atlas
+        w:  this.json.cell_sizes[idx*2], // width of cell in lod atlas
+        h:  this.json.cell_sizes[idx*2+1], // height of cell in lod atlas
+        x:  positions.data[worldPos], // x position of cell in world
+        y:  positions.data[worldPos+1], // y position of cell in world
+        z:  (positions.dims > 2 && positions.data[worldPos+2]) || null, // z position of cell in world
+        dx: this.json.atlas.positions[idx*2] + atlasOffset.x, // x offset of cell in atlas
+        dy: this.json.atlas.positions[idx*2+1] + atlasOffset.y, // y offset of cell in atlas
       }))
       idx++;
     }
@@ -228,6 +229,99 @@ Data.prototype.addCells = function(positions) {
   lod.indexCells();
 }
 
+// fetch the indices of the cells most similar to the cell at index `idx`
+Data.prototype.getSimilarCells = function(idx, onSuccess) {
+  if (!this.json.neighbors) return onSuccess([]);
+  // keep only indices of cells in the plot
+  var handleRow = function(row) {
+    onSuccess(Array.prototype.filter.call(row, function(i) {
+      return i < this.cells.length;
+    }.bind(this)));
+  }.bind(this);
+  if (!this.neighbors) {
+    get(getPath(this.json.neighbors), function(header) {
+      this.neighbors = {header: header, rows: null};
+      this.getSimilarCells(idx, onSuccess);
+    }.bind(this));
+  } else if (this.neighbors.rows) {
+    var k = this.neighbors.header.shape[1];
+    handleRow(this.neighbors.rows.subarray(idx*k, (idx+1)*k));
+  } else {
+    getBufferRow(this.json.neighbors, this.neighbors.header, idx, function(row, all) {
+      // servers that ignore range requests return the full table, so keep it
+      if (all) this.neighbors.rows = all;
+      handleRow(row);
+    }.bind(this));
+  }
+}
+
+// pass the metadata records of the cells at `indices` to `onSuccess`, in order
+Data.prototype.getMetadata = function(indices, onSuccess) {
+  var records = new Array(indices.length),
+      pending = indices.length;
+  if (!pending) return onSuccess(records);
+  // metadata saved one file per image
+  if (!this.json.metadata_index) {
+    indices.forEach(function(idx, i) {
+      var done = function(json) {
+        records[i] = json || {};
+        if (--pending == 0) onSuccess(records);
+      }
+      get(config.data.dir + '/metadata/file/' + this.json.images[idx] + '.json', done, function() { done() });
+    }.bind(this));
+    return;
+  }
+  // load the index of packed records, or just its row for a single record
+  if (!this.metadataIndex) {
+    return get(getPath(this.json.metadata_index), function(header) {
+      this.metadataIndex = {header: header, rows: null};
+      this.getMetadata(indices, onSuccess);
+    }.bind(this));
+  }
+  var header = this.metadataIndex.header;
+  if (!this.metadataIndex.rows && indices.length == 1) {
+    return getBufferRow(this.json.metadata_index, header, indices[0], function(row, all) {
+      if (all) this.metadataIndex.rows = all;
+      this.getPackedRecords(indices, function() { return row }, onSuccess);
+    }.bind(this));
+  }
+  if (!this.metadataIndex.rows) {
+    return getBuffer(this.json.metadata_index, header, function(rows) {
+      this.metadataIndex.rows = rows;
+      this.getMetadata(indices, onSuccess);
+    }.bind(this));
+  }
+  this.getPackedRecords(indices, function(idx) {
+    return this.metadataIndex.rows.subarray(idx*2, idx*2+2);
+  }.bind(this), onSuccess);
+}
+
+// fetch the packed records at `indices` with one range request per shard
+Data.prototype.getPackedRecords = function(indices, getRange, onSuccess) {
+  var header = this.metadataIndex.header,
+      records = new Array(indices.length),
+      shards = {};
+  // group the records by the shard that holds them
+  indices.forEach(function(idx, i) {
+    var shard = Math.floor(idx / header.records_per_shard);
+    (shards[shard] = shards[shard] || []).push(i);
+  });
+  var pending = Object.keys(shards).length,
+      dir = this.json.metadata_index.substring(0, this.json.metadata_index.lastIndexOf('/')+1);
+  Object.keys(shards).forEach(function(shard) {
+    // request the span of bytes that holds every record needed from this shard
+    var ranges = shards[shard].map(function(i) { return getRange(indices[i]) }),
+        start = Math.min.apply(null, ranges.map(function(r) { return r[0] })),
+        end = Math.max.apply(null, ranges.map(function(r) { return r[0] + r[1] }));
+    getBytes(getPath(dir + header.shards[shard]), start, end-1, function(bytes, offset) {
+      shards[shard].forEach(function(i, j) {
+        records[i] = JSON.parse(decodeBytes(bytes, ranges[j][0] - offset, ranges[j][1]));
+      });
+      if (--pending == 0) onSuccess(records);
+    });
+  });
+}
+
 /**
 * Texture: Each texture contains one or more atlases, and each atlas contains
 *   many Cells, where each cell represents a single input image.
@@ -407,8 +501,8 @@ Cell.prototype.updateParentBoundingBox = function() {
 // return the index of this atlas among all atlases
 Cell.prototype.getIndexOfAtlas = function() {
   var i=0; // accumulate cells per atlas until we find this cell's atlas
-  for (var j=0; j<data.json.atlas.positions.length; j++) {
-    i += data.json.atlas.positions[j].length;
+  for (var j=0; j<data.json.atlas.counts.length; j++) {
+    i += data.json.atlas.counts[j];
     if (i > this.idx) return j;
   }
   return j;
@@ -419,7 +513,7 @@ Cell.prototype.getIndexInAtlas = function() {
   var atlasIdx = this.getIndexOfAtlas();
   var i=0; // determine the number of cells in all atlases prior to current
   for (var j=0; j<atlasIdx; j++) {
-    i += data.json.atlas.positions[j].length;
+    i += data.json.atlas.counts[j];
   }
   return this.idx - i;
 }
@@ -434,7 +528,7 @@ Cell.prototype.getIndexInTexture = function() {
   var i=0; // index of starting cell in atlas within texture
   for (var j=0; j<this.getIndexOfAtlas(); j++) {
     if ((j%config.atlaesPerTex)==0) i = 0;
-    i += data.json.atlas.positions[i].length;
+    i += data.json.atlas.counts[j];
   }
   return i + this.getIndexInAtlas();
 }
@@ -463,12 +557,10 @@ Cell.prototype.activate = function() {
 
 // deactivate the cell in LOD
 Cell.prototype.deactivate = function() {
-  var atlasIndex = this.getIndexOfAtlas(),
-      indexInAtlas = this.getIndexInAtlas(),
-      atlasOffset = getAtlasOffset(atlasIndex)
-      d = data.json.atlas.positions[atlasIndex][indexInAtlas];
-  this.dx = d[0] + atlasOffset.x;
-  this.dy = d[1] + atlasOffset.y;
+  var atlasOffset = getAtlasOffset(this.getIndexOfAtlas()),
+      d = data.json.atlas.positions;
+  this.dx = d[this.idx*2] + atlasOffset.x;
+  this.dy = d[this.idx*2+1] + atlasOffset.y;
   this.texIdx = this.getIndexOfTexture();
   ['textureIndex', 'offset'].forEach(this.setBuffer.bind(this));
 }
@@ -716,14 +808,15 @@ Layout.prototype.set = function(layout, enableDelay) {
   data.hotspots.setCreateHotspotVisibility(false);
   // begin the new layout transition
   setTimeout(function() {
-    get(getPath(this.getLayoutPath()), function(pos) {
+    getPositions(this.getLayoutPath(), function(pos) {
       // clear the LOD mechanism
       lod.clear();
       // set the target locations of each point
       for (var i=0; i<data.cells.length; i++) {
-        data.cells[i].tx = pos[i][0];
-        data.cells[i].ty = pos[i][1];
-        data.cells[i].tz = pos[i][2] || data.cells[i].getZ(pos[i][0], pos[i][1]);
+        var d = i * pos.dims;
+        data.cells[i].tx = pos.data[d];
+        data.cells[i].ty = pos.data[d+1];
+        data.cells[i].tz = (pos.dims > 2 && pos.data[d+2]) || data.cells[i].getZ(pos.data[d], pos.data[d+1]);
         data.cells[i].setBuffer('targetTranslation');
       }
       // update the transition uniforms and targetPosition buffers on each mesh
@@ -1988,26 +2081,22 @@ Lasso.prototype.getSelectedMetadata = function(callback) {
   // conditionally fetch the metadata for each selected image
   var rows = [];
   if (data.json.metadata) {
-    for (var i=0; i<images.length; i++) {
-      var metadata = {};
-      get(config.data.dir + '/metadata/file/' + images[i] + '.json', function(data) {
-        metadata[data.filename] = data;
-        // if all metadata has loaded prepare data download
-        if (Object.keys(metadata).length == images.length) {
-          var keys = Object.keys(metadata);
-          for (var i=0; i<keys.length; i++) {
-            var m = metadata[keys[i]];
-            rows.push([
-              m.filename || '',
-              (m.tags || []).join('|'),
-              m.description,
-              m.permalink,
-            ])
-          }
-          callback(rows);
-        }
-      }.bind(this));
+    var indices = [];
+    for (var i=0; i<data.json.images.length; i++) {
+      if (this.selected[data.json.images[i]]) indices.push(i);
     }
+    data.getMetadata(indices, function(metadata) {
+      for (var i=0; i<metadata.length; i++) {
+        var m = metadata[i];
+        rows.push([
+          m.filename || '',
+          (m.tags || []).join('|'),
+          m.description,
+          m.permalink,
+        ])
+      }
+      callback(rows);
+    });
   } else {
     for (var i=0; i<images.length; i++) rows.push([images[i]]);
     callback(rows);
@@ -2031,7 +2120,7 @@ Lasso.prototype.downloadSelected = function() {
       var images = this.getSelectedFilenames();
       var nAdded = 0;
       for (var i=0; i<images.length; i++) {
-        var imagePath = getPath('data/originals/' + images[i]);
+        var imagePath = getPath('data/originals/' + images[i] + config.data.imageSuffix);
         imageToDataUrl(imagePath, function(result) {
           var imageFilename = result.src.split('originals/')[1];
           var base64 = result.dataUrl.split(';base64,')[1];
@@ -2600,7 +2689,7 @@ Modal.prototype.showCells = function(cellIndices, cellIdx) {
   // parse data attributes
   var filename = data.json.images[self.cellIndices[self.cellIdx]];
   // conditionalize the path to the image
-  var src = config.data.dir + '/originals/' + filename;
+  var src = config.data.dir + '/originals/' + filename + config.data.imageSuffix;
   // define function to show the modal
   function showModal(json) {
     var json = json || {};
@@ -2608,6 +2697,7 @@ Modal.prototype.showCells = function(cellIndices, cellIdx) {
     var target = document.querySelector('#selected-image-modal');
     var templateData = {
       multiImage: self.cellIndices.length > 1,
+      similar: !!data.json.neighbors,
       meta: Object.assign({}, json || {}, {
         src: src,
         filename: json.filename || filename,
@@ -2625,13 +2715,25 @@ Modal.prototype.showCells = function(cellIndices, cellIdx) {
   image.id = 'selected-image';
   image.onload = function() {
     showModal({image: image})
-    get(config.data.dir + '/metadata/file/' + filename + '.json', function(json) {
-      showModal(Object.assign({}, json, {image: image}));
+    if (!data.json.metadata) return;
+    data.getMetadata([self.cellIndices[self.cellIdx]], function(json) {
+      showModal(Object.assign({}, json[0], {image: image}));
     });
   }
   image.src = src;
 }
 
+// show the cell displayed in the modal followed by the cells most similar to it
+Modal.prototype.showSimilarCells = function() {
+  var cellIdx = this.cellIndices[this.cellIdx];
+  data.getSimilarCells(cellIdx, function(similar) {
+    this.fadeOutContent();
+    setTimeout(function() {
+      this.showCells([cellIdx].concat(similar), 0);
+    }.bind(this), 250)
+  }.bind(this))
+}
+
 Modal.prototype.close = function() {
   var elem = document.querySelector('#selected-image-modal .modal-top');
   if (!elem) return;
@@ -2827,7 +2929,7 @@ LOD.prototype.fetchNextImage = function() {
           this.state.cellsToActivate = this.state.cellsToActivate.concat(cellIdx);
         }
       }.bind(this, cellIdx);
-      image.src = config.data.dir + '/thumbs/' + data.json.images[cellIdx];
+      image.src = config.data.dir + '/thumbs/' + data.json.images[cellIdx] + config.data.imageSuffix;
     };
   // there was no image to fetch, so add neighbors to fetch queue if possible
   } else if (this.state.neighborsRequested < this.state.radius) {
@@ -2974,6 +3076,7 @@ Filters.prototype.filterImages = function() {
 
 function Filter(obj) {
   this.values = obj.filter_values || [];
+  this.options = obj.options || null; // d[option] = [byte offset, byte length] of its images in options.jsonl
   if (this.values.length <= 1) return;
   this.selected = null;
   this.name = obj.filter_name || '';
@@ -3080,17 +3183,29 @@ Filter.prototype.filterImages = function() {
   } else {
     var filename = this.selected.replace(/\//g, '-').replace(/ /g, '__') + '.json',
         path = getPath(config.data.dir + '/metadata/options/' + filename);
-    get(path, function(json) {
-      var vals = json.reduce(function(obj, i) {
-        obj[i] = true;
-        return obj;
-      }, {})
-      this.imageSelected = function(image) {
-        return image in vals;
-      }
-      filters.filterImages();
-    }.bind(this))
+    // packed options are all saved in one file, so fetch the range of the selected option
+    if (this.options) {
+      var range = this.options[this.selected];
+      path = getPath(config.data.dir + '/metadata/options/options.jsonl');
+      return getBytes(path, range[0], range[0] + range[1] - 1, function(bytes, offset) {
+        var json = JSON.parse(decodeBytes(bytes, range[0] - offset, range[1]));
+        this.setOptionImages(json);
+      }.bind(this));
+    }
+    get(path, this.setOptionImages.bind(this));
+  }
+}
+
+// select the images in list `json` of filenames
+Filter.prototype.setOptionImages = function(json) {
+  var vals = json.reduce(function(obj, i) {
+    obj[i] = true;
+    return obj;
+  }, {})
+  this.imageSelected = function(image) {
+    return image in vals;
   }
+  filters.filterImages();
 }
 
 /**
@@ -3737,6 +3852,145 @@ function get(url, onSuccess, onErr) {
   xhr.send();
 };
 
+/**
+* Fetch the positions in a layout saved as JSON or as a binary buffer
+*
+* @param {str} path: the path to the layout's JSON file
+* @param {func} onSuccess: callback passed {data: flat array of positions, dims: values per point}
+**/
+
+function getPositions(path, onSuccess) {
+  get(getPath(path), function(json) {
+    if (json.buffer) {
+      getBuffer(path, json, function(arr) {
+        onSuccess({data: arr, dims: json.shape[1]});
+      })
+    } else {
+      var dims = json.length ? json[0].length : 2;
+      onSuccess({data: flattenArray(json, dims, Float32Array), dims: dims});
+    }
+  })
+}
+
+/**
+* Flatten the cell sizes and atlas positions in an imagelist into typed arrays
+*
+* @param {str} path: the path to the imagelist's JSON file
+* @param {obj} json: the parsed imagelist
+* @param {func} onSuccess: callback passed the imagelist with flattened arrays
+**/
+
+function getImagelist(path, json, onSuccess) {
+  if (!json.atlas.counts) {
+    json.atlas.counts = json.cell_sizes.map(function(i) { return i.length });
+  }
+  if (json.cell_sizes.buffer) {
+    getBuffer(path, json.cell_sizes, function(sizes) {
+      getBuffer(path, json.atlas.positions, function(positions) {
+        json.cell_sizes = sizes;
+        json.atlas.positions = positions;
+        onSuccess(json);
+      })
+    })
+  } else {
+    // flatten the per-atlas lists of [x, y] pairs
+    json.cell_sizes = flattenArray([].concat.apply([], json.cell_sizes), 2, Uint16Array);
+    json.atlas.positions = flattenArray([].concat.apply([], json.atlas.positions), 2, Uint16Array);
+    onSuccess(json);
+  }
+}
+
+// return a typed array with the first `dims` values of each array in `arr`
+function flattenArray(arr, dims, type) {
+  var flat = new type(arr.length * dims);
+  for (var i=0; i<arr.length; i++) {
+    for (var j=0; j<dims; j++) flat[i*dims + j] = arr[i][j];
+  }
+  return flat;
+}
+
+/**
+* Fetch a binary buffer saved beside a JSON file
+*
+* @param {str} path: the path to the JSON file that contains `header`
+* @param {obj} header: object with the buffer's filename, format, and scale
+* @param {func} onSuccess: callback passed a typed array with the buffer's values
+**/
+
+function getBuffer(path, header, onSuccess) {
+  var url = getPath(path);
+  url = url.substring(0, url.lastIndexOf('/')+1) + header.buffer;
+  var xhr = new XMLHttpRequest();
+  xhr.onload = function(e) {
+    var buffer = e.target.response;
+    if (header.format == 'uint16') return onSuccess(new Uint16Array(buffer));
+    if (header.format == 'uint32') return onSuccess(new Uint32Array(buffer));
+    if (header.format == 'float32') return onSuccess(new Float32Array(buffer));
+    // restore the scale of quantized int16 buffers
+    var arr = new Int16Array(buffer),
+        scaled = new Float32Array(arr.length);
+    for (var i=0; i<arr.length; i++) scaled[i] = arr[i] * header.scale;
+    onSuccess(scaled);
+  };
+  xhr.open('GET', url, true);
+  xhr.responseType = 'arraybuffer';
+  xhr.send();
+}
+
+/**
+* Fetch one row of a 2D binary buffer saved beside a JSON file
+*
+* @param {str} path: the path to the JSON file that contains `header`
+* @param {obj} header: object with the buffer's filename, format, and shape
+* @param {int} row: the index of the row to fetch
+* @param {func} onSuccess: callback passed a typed array with the row's values,
+*   and the full buffer if the server returned the whole buffer
+**/
+
+function getBufferRow(path, header, row, onSuccess) {
+  var types = {uint16: Uint16Array, uint32: Uint32Array, float32: Float32Array},
+      type = types[header.format],
+      k = header.shape[1],
+      start = row * k * type.BYTES_PER_ELEMENT,
+      end = start + k * type.BYTES_PER_ELEMENT - 1,
+      url = getPath(path);
+  url = url.substring(0, url.lastIndexOf('/')+1) + header.buffer;
+  var xhr = new XMLHttpRequest();
+  xhr.onload = function(e) {
+    var arr = new type(e.target.response);
+    xhr.status === 206
+      ? onSuccess(arr)
+      : onSuccess(arr.subarray(row*k, (row+1)*k), arr);
+  };
+  xhr.open('GET', url, true);
+  xhr.setRequestHeader('Range', 'bytes=' + start + '-' + end);
+  xhr.responseType = 'arraybuffer';
+  xhr.send();
+}
+
+/**
+* Fetch bytes `start` through `end` (inclusive) of the file at `url`
+*
+* @param {func} onSuccess: callback passed a Uint8Array with the bytes and the
+*   offset of its first byte in the file (0 if the server returned the whole file)
+**/
+
+function getBytes(url, start, end, onSuccess) {
+  var xhr = new XMLHttpRequest();
+  xhr.onload = function(e) {
+    onSuccess(new Uint8Array(e.target.response), xhr.status === 206 ? start : 0);
+  };
+  xhr.open('GET', url, true);
+  xhr.setRequestHeader('Range', 'bytes=' + start + '-' + end);
+  xhr.responseType = 'arraybuffer';
+  xhr.send();
+}
+
+// return the utf-8 string in the `length` bytes of Uint8Array `bytes` from `start`
+function decodeBytes(bytes, start, length) {
+  return new TextDecoder('utf-8').decode(bytes.subarray(start, start + length));
+}
+
 // extract content from gzipped bytes
 function gunzip(data) {
   var bytes = [];
@@ -40,21 +40,20 @@ setup(
     'Cython>=0.29.21',
     'glob2>=0.6',
     'h5py~=3.1.0',
-    'iiif-downloader>=0.0.6',
     'numba==0.53',
     'numpy==1.19.5',
     'Pillow>=6.1.0',
     'pointgrid>=0.0.2',
+    'pynndescent>=0.5.4',
     'python-dateutil>=2.8.0',
     'scikit-learn==0.24.2',
     'scipy==1.4.0',
     'six==1.15.0',
     'tensorflow==2.5.0',
     'tqdm==4.61.1',
-    'umap-learn==0.5.1',
+    'umap-learn==0.5.2',
     'yale-dhlab-rasterfairy>=1.0.3',
-    'yale-dhlab-keras-preprocessing>=1.1.1',
-    'matplotlib'
+    'yale-dhlab-keras-preprocessing>=1.1.1'
   ],
   entry_points={
     'console_scripts': [
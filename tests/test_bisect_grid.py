@@ -0,0 +1,23 @@
+from pixplot.pixplot import bisect_grid, preprocess_kwargs, config
+import numpy as np
+import pytest
+
+
+def test_bisect_grid_assigns_each_point_a_distinct_cell():
+  points = np.random.RandomState(24).rand(50, 2)
+  for leaf_size in [1, 7, 256]:
+    pos = bisect_grid(points, leaf_size=leaf_size)
+    assert pos.shape == (50, 2)
+    assert len(set(map(tuple, pos.tolist()))) == 50
+
+
+def test_bisect_grid_rejects_leaf_size_below_one():
+  points = np.random.RandomState(24).rand(10, 2)
+  for leaf_size in [0, -1]:
+    with pytest.raises(Exception, match='leaf_size'):
+      bisect_grid(points, leaf_size=leaf_size)
+
+
+def test_grid_quality_below_one_is_rejected():
+  with pytest.raises(Exception, match='--grid_quality'):
+    preprocess_kwargs(**dict(config, grid_quality=0))
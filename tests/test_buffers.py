@@ -0,0 +1,35 @@
+from pixplot.pixplot import write_buffer, read_buffer, get_buffer_path
+import numpy as np
+import pytest
+import os
+
+
+@pytest.mark.parametrize('fmt', ['float32', 'uint16', 'uint32'])
+def test_buffers_round_trip(tmp_path, fmt):
+  arr = np.array([[0, 1], [2, 3], [65535, 4]])
+  header = write_buffer(str(tmp_path / 'layout.bin'), arr, fmt)
+  assert header['format'] == fmt and header['shape'] == [3, 2] and header['buffer'] == 'layout.bin'
+  assert os.path.getsize(str(tmp_path / 'layout.bin')) == arr.size * np.dtype(fmt).itemsize
+  assert np.array_equal(read_buffer(str(tmp_path), header), arr)
+
+
+def test_int16_buffers_are_scaled_to_the_full_range(tmp_path):
+  arr = np.array([[-0.5, 0.25], [0.125, 1.0]])
+  header = write_buffer(str(tmp_path / 'layout.bin'), arr, 'int16')
+  assert np.abs(np.fromfile(str(tmp_path / 'layout.bin'), dtype='<i2')).max() == 32767
+  assert np.allclose(read_buffer(str(tmp_path), header), arr, atol=header['scale'])
+  # an all-zero buffer keeps a scale that restores it
+  header = write_buffer(str(tmp_path / 'zeros.bin'), np.zeros((2, 2)), 'int16')
+  assert header['scale'] == 1.0 and not read_buffer(str(tmp_path), header).any()
+
+
+def test_the_header_hash_follows_the_buffer(tmp_path):
+  a = write_buffer(str(tmp_path / 'a.bin'), [[1, 2]], 'float32')
+  b = write_buffer(str(tmp_path / 'b.bin'), [[1, 2]], 'float32')
+  c = write_buffer(str(tmp_path / 'c.bin'), [[1, 3]], 'float32')
+  assert a['hash'] == b['hash'] != c['hash']
+
+
+def test_buffer_paths_sit_next_to_their_json():
+  assert get_buffer_path('output/data/layouts/umap.json') == 'output/data/layouts/umap.bin'
+  assert get_buffer_path('output/data/layouts/umap.json.gz') == 'output/data/layouts/umap.bin'
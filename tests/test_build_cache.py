@@ -0,0 +1,79 @@
+from pixplot.pixplot import BuildCache, get_build_record, set_build_record
+import pytest
+import os
+
+
+@pytest.fixture
+def kwargs(tmp_path):
+  out_dir = str(tmp_path / 'output')
+  os.makedirs(out_dir)
+  return {
+    'out_dir': out_dir,
+    'use_cache': True,
+    'image_paths': ['a.jpg', 'b.jpg'],
+    'image_hashes': {'a.jpg': 'hash-a', 'b.jpg': 'hash-b'},
+    'n_neighbors': 15,
+    'n_similar': 30,
+    'min_dist': 0.01,
+    'n_components': 2,
+    'metric': 'correlation',
+    'seed': 24,
+    'layout_format': 'json',
+    'grid_engine': 'bisect',
+    'grid_quality': 'exact',
+    'vector_dtype': 'float32',
+  }
+
+
+def build(stage, kwargs, *inputs):
+  '''Run `stage` through a new BuildCache and return [outputs, whether the outputs were reused]'''
+  kwargs = dict(kwargs, build_cache=BuildCache(**kwargs))
+  for upstream in ['vectors', 'umap']:
+    if upstream != stage:
+      get_build_record(upstream, **kwargs)
+  outputs = get_build_record(stage, *inputs, **kwargs)
+  if outputs is not None:
+    return [outputs, True]
+  path = os.path.join(kwargs['out_dir'], stage + '.json')
+  with open(path, 'w') as f:
+    f.write('{}')
+  return [set_build_record(stage, {'path': path}, [path], **kwargs), False]
+
+
+def test_outputs_are_reused_until_a_config_key_changes(kwargs):
+  assert build('umap', kwargs)[1] is False
+  assert build('umap', kwargs) == [{'path': os.path.join(kwargs['out_dir'], 'umap.json')}, True]
+  assert build('umap', dict(kwargs, n_similar=40))[1] is False
+  # keys the stage doesn't read don't invalidate it
+  assert build('umap', dict(kwargs, n_similar=40, heightmap_size=512))[1] is True
+
+
+def test_changed_images_invalidate_the_stages_that_read_them(kwargs):
+  build('vectors', kwargs)
+  changed = dict(kwargs, image_hashes={'a.jpg': 'hash-a', 'b.jpg': 'hash-c'})
+  assert build('vectors', changed)[1] is False
+  assert build('vectors', kwargs)[1] is False
+
+
+def test_a_changed_upstream_stage_invalidates_downstream_stages(kwargs):
+  build('umap', kwargs)
+  build('grid', kwargs)
+  assert build('grid', kwargs)[1] is True
+  # grid reads the digest of umap, which changes with umap's own config
+  assert build('grid', dict(kwargs, min_dist=0.2))[1] is False
+  # and the digest of umap reads the digest of vectors in turn
+  assert build('umap', dict(kwargs, vector_dtype='float16'))[1] is False
+
+
+def test_extra_inputs_are_part_of_the_digest(kwargs):
+  build('heightmap', kwargs, [[0, 0], [1, 1]])
+  assert build('heightmap', kwargs, [[0, 0], [1, 1]])[1] is True
+  assert build('heightmap', kwargs, [[0, 0], [1, 2]])[1] is False
+
+
+def test_missing_outputs_or_use_cache_false_force_a_rebuild(kwargs):
+  outputs, _ = build('umap', kwargs)
+  assert build('umap', dict(kwargs, use_cache=False))[1] is False
+  assert build('umap', kwargs)[1] is True
+  os.remove(outputs['path'])
+  assert build('umap', kwargs)[1] is False
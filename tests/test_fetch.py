@@ -0,0 +1,111 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pixplot.pixplot import HostPool, fetch_url, download_remote_images, get_manifest_image_urls
+import threading
+import pytest
+import json
+import os
+
+
+class Server(ThreadingHTTPServer):
+  daemon_threads = True
+
+  def __init__(self):
+    super().__init__(('127.0.0.1', 0), Handler)
+    self.connections = 0
+    self.paths = [] # the path of each request served
+    self.fail = set() # paths whose next request gets a 503
+
+  def finish_request(self, request, client_address):
+    self.connections += 1
+    super().finish_request(request, client_address)
+
+  def url(self, path):
+    return 'http://{}:{}{}'.format(self.server_address[0], self.server_address[1], path)
+
+
+class Handler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def log_message(self, *args):
+    pass
+
+  def send(self, status, content_type, body, headers={}):
+    self.send_response(status)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body)))
+    for k, v in headers.items(): self.send_header(k, v)
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_GET(self):
+    server = self.server
+    server.paths.append(self.path)
+    if self.path in server.fail:
+      server.fail.discard(self.path)
+      self.send(503, 'text/plain', b'try again')
+    elif self.path.startswith('/image/'):
+      self.send(200, 'image/jpeg', self.path.encode('utf8'))
+    elif self.path.startswith('/redirect/'):
+      self.send(302, 'text/plain', b'', {'Location': '/image/' + self.path.split('/')[-1]})
+    elif self.path == '/manifest/2':
+      manifest = {'sequences': [{'canvases': [{'images': [{'resource': {'@id': server.url('/image/m2')}}]}]}]}
+      self.send(200, 'application/json', json.dumps(manifest).encode('utf8'))
+    elif self.path == '/manifest/3':
+      manifest = {'items': [{'items': [{'items': [{'body': {'id': server.url('/image/m3')}}]}]}]}
+      self.send(200, 'application/ld+json', json.dumps(manifest).encode('utf8'))
+    else:
+      self.send(404, 'text/plain', b'not found')
+
+
+@pytest.fixture
+def server():
+  server = Server()
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  yield server
+  server.shutdown()
+  server.server_close()
+
+
+def test_requests_to_a_host_reuse_one_connection_and_follow_redirects(server):
+  pool = HostPool(size=2)
+  for i in range(5):
+    response, body = pool.request(server.url('/redirect/{}'.format(i)))
+    assert response.status == 200 and body == '/image/{}'.format(i).encode('utf8')
+  pool.close()
+  assert len(server.paths) == 10
+  assert server.connections == 1
+
+
+def test_server_errors_are_retried_and_client_errors_are_not(server):
+  pool = HostPool()
+  server.fail.add('/image/a')
+  response, body = fetch_url(pool, server.url('/image/a'), backoff=0)
+  assert body == b'/image/a'
+  assert server.paths == ['/image/a', '/image/a']
+  with pytest.raises(Exception, match='HTTP 404'):
+    fetch_url(pool, server.url('/missing'), backoff=0)
+  assert server.paths.count('/missing') == 1
+  pool.close()
+
+
+def test_manifest_image_urls_are_read_from_presentation_2_and_3():
+  assert get_manifest_image_urls({'sequences': [{'canvases': [{'images': [{'resource': {'@id': 'a'}}]}]}]}) == ['a']
+  assert get_manifest_image_urls({'items': [{'items': [{'items': [{'body': {'id': 'b'}}]}]}]}) == ['b']
+
+
+def test_downloads_resume_without_fetching_finished_urls_again(server, tmp_path):
+  urls = [server.url(i) for i in ['/manifest/2', '/manifest/3', '/image/x', '/redirect/y', '/missing']]
+  kwargs = {'download_dir': str(tmp_path), 'fetch_workers': 4, 'fetch_per_host': 2}
+  paths = download_remote_images(urls, **kwargs)
+  assert len(paths) == 4 and paths == sorted(paths)
+  assert sorted(open(i, 'rb').read() for i in paths) == [b'/image/m2', b'/image/m3', b'/image/x', b'/image/y']
+  # a second run only retries the url that failed
+  served = len(server.paths)
+  assert download_remote_images(urls, **kwargs) == paths
+  assert server.paths[served:] == ['/missing']
+  # an image removed from disk is downloaded again
+  os.remove(paths[0])
+  served = len(server.paths)
+  assert download_remote_images(urls, **kwargs) == paths
+  assert len(server.paths) - served in [2, 3] # the lost image (via its manifest or redirect) and /missing
+  assert not [i for i in os.listdir(str(tmp_path / 'images')) if i.endswith('.part')]
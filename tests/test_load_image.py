@@ -0,0 +1,33 @@
+from pixplot.pixplot import load_image
+import PIL.Image
+import pytest
+
+
+@pytest.fixture(params=['JPEG', 'PNG'])
+def image(request, tmp_path):
+  path = str(tmp_path / ('image.' + request.param.lower()))
+  PIL.Image.new('L', (800, 600), 128).save(path, request.param)
+  return path
+
+
+def test_images_load_at_full_size_without_a_decode_size(image):
+  img, size = load_image(image)
+  assert size == (800, 600) and img.size == (800, 600) and img.mode == 'RGB'
+
+
+@pytest.mark.parametrize('decode_size', [100, 150, 299, 600, 1000])
+def test_images_decode_at_the_smallest_size_that_covers_decode_size(image, decode_size):
+  img, size = load_image(image, decode_size=decode_size)
+  assert size == (800, 600) and img.mode == 'RGB'
+  # both sides are at least decode_size unless the image is smaller, and no
+  # further whole-factor reduction would keep them there
+  assert min(img.size) >= min(decode_size, 600)
+  assert min(img.size) < 2 * decode_size or img.size == (800, 600)
+
+
+def test_jpegs_are_scaled_as_they_are_decoded(tmp_path):
+  path = str(tmp_path / 'image.jpg')
+  PIL.Image.new('RGB', (800, 600)).save(path)
+  img, size = load_image(path, decode_size=100)
+  # draft decodes at 1/4 scale, the largest that keeps the short side above 100
+  assert img.size == (200, 150)
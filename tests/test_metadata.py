@@ -0,0 +1,60 @@
+from pixplot.pixplot import MetadataTable, Metadata, join_metadata, select_metadata, get_metadata_column
+import numpy as np
+import json
+
+
+def write_csv(path, lines):
+  with open(str(path), 'w') as out:
+    out.write('\n'.join(lines) + '\n')
+  return str(path)
+
+
+def test_images_are_joined_to_their_csv_rows_by_clean_filename(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  metadata = write_csv(tmp_path / 'metadata.csv', [
+    'Filename,Category,Year',
+    'b.jpg,maps,1901',
+    'a.jpg,botany,1900',
+    'c.jpg,maps',
+  ])
+  paths = ['images/a.jpg', 'other/b.jpg', 'images/c.jpg', 'images/d.jpg']
+  images, records = join_metadata(paths, metadata=metadata)
+  # images without a row are dropped and listed for the user
+  assert images == ['images/a.jpg', 'other/b.jpg', 'images/c.jpg']
+  assert (tmp_path / 'missing-metadata.txt').read_text() == 'd.jpg'
+  # headers are lowercased, and a category without tags is used as the tags
+  assert records[0] == {'filename': 'a.jpg', 'category': 'botany', 'year': '1900', 'tags': 'botany'}
+  # short rows leave the missing fields empty
+  assert records[2]['year'] == ''
+  assert [i['filename'] for i in records] == ['a.jpg', 'b.jpg', 'c.jpg']
+
+
+def test_categorical_columns_store_each_distinct_value_once(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  rows = ['filename,category,lat'] + ['{}.jpg,{},{}'.format(i, ['maps', 'botany'][i % 2], i) for i in range(100)]
+  metadata = write_csv(tmp_path / 'metadata.csv', rows)
+  images, records = join_metadata(['{}.jpg'.format(i) for i in range(100)], metadata=metadata)
+  assert isinstance(records, Metadata)
+  assert records.table.values['category'] == ['maps', 'botany']
+  assert records.column('category')[:3].tolist() == ['maps', 'botany', 'maps']
+  np.testing.assert_array_equal(records.float_column('lat'), np.arange(100))
+  assert records.column('missing').tolist() == [None] * 100
+  # selecting a subset of the images keeps their records
+  subset = select_metadata(['7.jpg', '2.jpg'], image_paths=images, metadata=records)
+  assert [i['filename'] for i in subset] == ['7.jpg', '2.jpg']
+  assert get_metadata_column('category', image_paths=['7.jpg', '2.jpg'], metadata=subset).tolist() == ['botany', 'maps']
+
+
+def test_json_records_keep_values_of_different_types_apart():
+  table = MetadataTable()
+  table.append({'filename': 'a.jpg', 'flag': 1, 'tags': ['x']})
+  table.append({'filename': 'b.jpg', 'flag': True, 'year': 1900})
+  table.append({'filename': 'c.jpg', 'flag': 1, 'tags': ['x']})
+  table.close()
+  records = Metadata(table, [table.rows['c.jpg'], table.rows['b.jpg'], table.rows['a.jpg']])
+  assert records.column('flag').tolist() == [1, True, 1]
+  assert type(records[1]['flag']) is bool
+  # columns a record lacks are missing from its dict and nan in float columns
+  assert 'year' not in records[0]
+  assert np.isnan(records.float_column('year')[0]) and records.float_column('year')[1] == 1900
+  assert json.dumps(records[2], sort_keys=True) == json.dumps({'filename': 'a.jpg', 'flag': 1, 'tags': ['x']}, sort_keys=True)
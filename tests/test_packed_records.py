@@ -0,0 +1,33 @@
+from pixplot.pixplot import PackedRecordWriter, read_buffer
+import json
+
+
+def read_record(out_dir, header, ranges, idx):
+  '''Read record `idx` with the byte range a client would request'''
+  shard = header['shards'][idx // header['records_per_shard']]
+  offset, length = ranges[idx]
+  with open(str(out_dir / shard), 'rb') as f:
+    f.seek(int(offset))
+    return json.loads(f.read(int(length)).decode('utf8'))
+
+
+def test_records_are_read_back_from_their_index(tmp_path):
+  writer = PackedRecordWriter(str(tmp_path))
+  writer.records_per_shard = 3
+  records = [{'filename': 'img-{}.jpg'.format(i), 'tags': ['é'] * i, 'year': i or None} for i in range(7)]
+  for i in records:
+    writer.add(i)
+  with open(writer.close()) as f:
+    header = json.load(f)
+  assert header['shards'] == ['records-0.jsonl', 'records-1.jsonl', 'records-2.jsonl']
+  assert header['records_per_shard'] == 3 and header['format'] == 'uint32' and header['shape'] == [7, 2]
+  ranges = read_buffer(str(tmp_path), header)
+  assert [read_record(tmp_path, header, ranges, i) for i in range(7)] == records
+  # offsets restart in each shard
+  assert [int(ranges[i][0]) for i in [0, 3, 6]] == [0, 0, 0]
+
+
+def test_an_empty_writer_writes_an_empty_index(tmp_path):
+  with open(PackedRecordWriter(str(tmp_path)).close()) as f:
+    header = json.load(f)
+  assert header['shards'] == [] and header['shape'] == [0, 2]
@@ -0,0 +1,69 @@
+from pixplot.pixplot import scan_files, get_duplicate_names
+import pixplot.pixplot as pixplot
+import pytest
+import glob2
+import os
+
+
+@pytest.fixture
+def tree(tmp_path, monkeypatch):
+  '''Build a small input tree with hidden directories and a directory named like an image'''
+  for i in ['a/b', '.hidden', 'a/.thumbs', 'folder.jpg']:
+    os.makedirs(str(tmp_path / 'images' / i))
+  for i in ['A.JPG', 'x.jpg', 'a/y.jpg', 'a/n.png', 'a/b/z.jpg', '.hidden/h.jpg', 'a/.thumbs/t.jpg', '.dot.jpg']:
+    with open(str(tmp_path / 'images' / i), 'w') as f:
+      f.write(i)
+  monkeypatch.chdir(str(tmp_path))
+  return tmp_path
+
+
+def expected(pattern):
+  '''Return the files glob2 matches, leaving out the directories and dot-directories scan_files skips'''
+  return sorted(i for i in glob2.glob(pattern) if os.path.isfile(i) and not '/.' in i)
+
+
+@pytest.mark.parametrize('pattern', [
+  'images/*.jpg',
+  'images/**/*.jpg',
+  'images/**/*',
+  'images/*/*.jpg',
+  'images/a/*',
+  'images/a/b/z.jpg',
+  'images/a/[ny].*',
+])
+def test_matches_the_files_glob2_matches(tree, pattern):
+  assert sorted(scan_files(pattern, out_dir='output', n_workers=1)) == expected(pattern)
+
+
+def test_names_match_case_insensitively_and_wildcards_skip_dot_names(tree):
+  assert sorted(scan_files('images/*.jpg', out_dir='output')) == ['images/A.JPG', 'images/x.jpg']
+  # a dot-directory named in the pattern is still listed
+  assert list(scan_files('images/.hidden/*.jpg', out_dir='output')) == ['images/.hidden/h.jpg']
+  assert scan_files('images/missing/*.jpg', out_dir='output') == {}
+
+
+def test_rescans_list_only_the_directories_that_changed(tree, monkeypatch):
+  stats = scan_files('images/**/*.jpg', out_dir='output')
+  assert stats['images/x.jpg'][0] == len('x.jpg')
+  assert os.path.exists('output/cache/image-scan.json')
+  listed = []
+  scandir = os.scandir
+  monkeypatch.setattr(pixplot.os, 'scandir', lambda path: listed.append(path) or scandir(path))
+  assert scan_files('images/**/*.jpg', out_dir='output') == stats
+  assert listed == []
+  # a file added to a directory moves its mtime, so only that directory is listed again
+  with open('images/a/b/new.jpg', 'w') as f:
+    f.write('new')
+  os.utime('images/a/b', (0, 1))
+  assert 'images/a/b/new.jpg' in scan_files('images/**/*.jpg', out_dir='output')
+  assert listed == ['images/a/b']
+  # use_cache=False lists every directory
+  listed[:] = []
+  scan_files('images/**/*.jpg', out_dir='output', use_cache=False)
+  assert 'images/a/b' in listed and 'images' in listed
+
+
+def test_duplicate_names_are_grouped_by_clean_filename():
+  paths = ['a/cat.jpg', 'b/cat.jpg', 'c/dog.jpg', 'd/c%61t.jpg']
+  assert get_duplicate_names(paths) == {'cat.jpg': ['a/cat.jpg', 'b/cat.jpg', 'd/c%61t.jpg']}
+  assert get_duplicate_names(['a/cat.jpg', 'c/dog.jpg']) == {}
@@ -0,0 +1,58 @@
+from pixplot.pixplot import VectorStore
+import numpy as np
+import os
+
+
+def test_vectors_round_trip_through_the_memory_map(tmp_path):
+  vecs = np.random.RandomState(24).rand(5, 8).astype('float32')
+  store = VectorStore(str(tmp_path))
+  store.append(['a', 'b', 'c'], vecs[:3])
+  store.append(['d', 'e'], vecs[3:])
+  reopened = VectorStore(str(tmp_path))
+  assert isinstance(reopened.load(), np.memmap)
+  np.testing.assert_array_equal(reopened.get(['a', 'b', 'c', 'd', 'e']), vecs)
+  np.testing.assert_array_equal(reopened.get(['e', 'a']), vecs[[4, 0]])
+
+
+def test_float16_vectors_keep_their_dtype(tmp_path):
+  vecs = np.random.RandomState(24).rand(3, 4)
+  VectorStore(str(tmp_path), dtype='float16').append(['a', 'b', 'c'], vecs)
+  assert os.path.getsize(str(tmp_path / 'vectors.bin')) == 3 * 4 * 2
+  # the stored dtype wins over the dtype the store is opened with
+  reopened = VectorStore(str(tmp_path), dtype='float32')
+  assert reopened.dtype == np.float16
+  np.testing.assert_array_equal(reopened.get(['a', 'b', 'c']), vecs.astype('float16'))
+
+
+def test_a_partly_written_row_is_discarded(tmp_path):
+  vecs = np.random.RandomState(24).rand(3, 4).astype('float32')
+  VectorStore(str(tmp_path)).append(['a', 'b', 'c'], vecs)
+  # cut the last row short, as an interrupted run might
+  with open(str(tmp_path / 'vectors.bin'), 'r+b') as f:
+    f.truncate(2 * 16 + 5)
+  store = VectorStore(str(tmp_path))
+  assert store.n == 2 and 'c' not in store
+  assert os.path.getsize(str(tmp_path / 'vectors.bin')) == 2 * 16
+  with open(str(tmp_path / 'vectors.jsonl')) as f:
+    assert len(f.readlines()) == 2
+  np.testing.assert_array_equal(store.get(['a', 'b']), vecs[:2])
+
+
+def test_storing_a_key_again_replaces_its_row(tmp_path):
+  vecs = np.random.RandomState(24).rand(3, 4).astype('float32')
+  store = VectorStore(str(tmp_path))
+  store.append(['a', 'b'], vecs[:2])
+  store.append(['b', 'c', 'c'], [vecs[2], vecs[0], vecs[1]])
+  assert store.n == 3
+  assert os.path.getsize(str(tmp_path / 'vectors.bin')) == 3 * 16
+  np.testing.assert_array_equal(VectorStore(str(tmp_path)).get(['a', 'b', 'c']), vecs[[0, 2, 1]])
+
+
+def test_a_header_without_vectors_is_a_cache_miss(tmp_path):
+  store = VectorStore(str(tmp_path))
+  store.append(['a'], [np.ones(4)])
+  os.remove(str(tmp_path / 'vectors.bin'))
+  store = VectorStore(str(tmp_path))
+  assert store.n == 0 and store.dim is None
+  store.append(['a'], [np.zeros(4)])
+  np.testing.assert_array_equal(store.get(['a']), [np.zeros(4)])